@@ -4,8 +4,9 @@ tools_prompt = """
 2. schedule_meeting(attendees, subject, duration_minutes, preferred_day, start_time): 
    预约日历会议。注意：preferred_day 必须是一个 datetime 对象。
 3. check_calendar_availability(day): 查询指定日期的空闲时间段。
-4. Question(content): 如果信息不足或需要确认，向用户询问后续问题。
-5. Done: 当邮件已发送或任务彻底完成时调用此工具结束流程。
+4. search_email(query, sender): 检索本地历史邮件，可用于查看与发件人之前的往来记录。
+5. Question(content): 如果信息不足或需要确认，向用户询问后续问题。
+6. Done: 当邮件已发送或任务彻底完成时调用此工具结束流程。
 
 注意：在执行敏感操作（如发邮件和定会议）前，你的草稿会被送去人工审核。
 """
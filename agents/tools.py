@@ -1,12 +1,12 @@
-import os
-import smtplib
-from email.header import Header
-from email.mime.text import MIMEText
+from email.utils import parseaddr
 
 from dotenv import load_dotenv
 from langchain.tools import tool
 from pydantic import BaseModel
 
+from utils.mail_index import get_mail_index
+from utils.smtp_outbox import get_outbox
+
 load_dotenv()
 
 
@@ -23,24 +23,51 @@ def write_email(to: str, subject: str, content: str) -> str:
     Returns:
 
     """
-    smtp_server = "smtp.163.com"
-    smtp_port = 465
-    sender_email = os.getenv("MAIL_USER")
-    sender_password = os.getenv("MAIL_PASS")
+    # 只负责放进持久化发件箱，真正的 SMTP 发送、失败重试和限流由后台线程完成，不阻塞图节点
+    try:
+        outbox_id = get_outbox().enqueue(to, subject, content)
+    except Exception as e:
+        return f"发送失败，错误消息:{str(e)}"
+    return f"已加入发送队列（编号 {outbox_id}），将在后台发送"
 
-    message = MIMEText(content, 'plain', 'utf-8')
-    message['From'] = sender_email
-    message['To'] = to
-    message['Subject'] = Header(subject, 'utf-8')
 
+def send_email_once(thread_id: str, tool_call_id: str, args: dict) -> str:
+    """
+    人工审核通过后的发信入口：按 (thread_id, tool_call_id) 记账，重复的 resume 不会再发第二封。
+    缺少 thread_id 时（本地手工调用）退回普通的 write_email。
+    """
+    if not thread_id or not tool_call_id:
+        return write_email.invoke(args)
     try:
-        with smtplib.SMTP_SSL(smtp_server, smtp_port) as server:
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, [to], message.as_string())
-            # server.quit()
-            return f"发送成功"
+        outbox_id, created = get_outbox().enqueue_once(
+            thread_id, tool_call_id, args.get("to"), args.get("subject"), args.get("content"))
     except Exception as e:
         return f"发送失败，错误消息:{str(e)}"
+    if not created:
+        return f"该邮件此前已加入发送队列（编号 {outbox_id}），不会重复发送"
+    return f"已加入发送队列（编号 {outbox_id}），将在后台发送"
+
+
+@tool
+def search_email(query: str, sender: str = "") -> str:
+    """
+    在本地邮箱镜像中全文检索历史邮件（支持中文），用于查找与某位发件人之前的往来记录。
+
+    Args:
+        query:检索关键词
+        sender:可选，只检索该地址发来的邮件，例如原邮件的发件人
+
+    Returns:
+
+    """
+    sender_email = parseaddr(sender)[1] if sender else ""
+    hits = get_mail_index().search(query, sender=sender_email or None)
+    if not hits:
+        return "没有找到相关的历史邮件。"
+    lines = []
+    for hit in hits:
+        lines.append(f"- [{hit['date'][:10] or '日期未知'}] {hit['author']} | {hit['subject']}\n  {hit['snippet']}")
+    return "找到以下相关历史邮件：\n" + "\n".join(lines)
 
 
 @tool
@@ -0,0 +1,161 @@
+"""
+图执行的负载测试：同一批邮件分别用「线程池 + 同步图」和「事件循环 + 异步图」跑完
+分拣 -> 起草 -> 审核中断 -> 确认发送，比较吞吐量和占用的线程数。
+
+不调用真实的 LLM：以 LLM_MODE=replay 运行，每次调用固定等待给定的延迟。压测用的邮件每次都不一样，
+默认 LLM_REPLAY_FALLBACK=synthetic，按绑定的工具生成确定的响应，不需要磁带：分拣是 respond、起草是 write_email，
+每封邮件都是两次 LLM 调用加一次中断恢复，测出来的就是图本身的并发能力。
+
+想用真实模型的响应：先录一遍磁带（需要 OPENAI_API_KEY）: python -m benchmarks.load_test_graph record [邮件数]
+再按调用类型轮流回放录音: LLM_REPLAY_FALLBACK=1 python -m benchmarks.load_test_graph
+
+用法: python -m benchmarks.load_test_graph [邮件数] [模拟 LLM 延迟秒数] [线程池大小]
+"""
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.fake_smtp import FakeSMTPServer
+
+tmp_dir = tempfile.mkdtemp()
+os.environ["OUTBOX_PATH"] = os.path.join(tmp_dir, "outbox.db")
+os.environ["MAIL_MIRROR_PATH"] = os.path.join(tmp_dir, "mirror.db")
+os.environ["TRIAGE_EXAMPLES_PATH"] = os.path.join(tmp_dir, "examples.db")
+os.environ["TRIAGE_CACHE_PATH"] = os.path.join(tmp_dir, "triage_cache.db")
+# 确认发送会被本地分拣模型学习，不关掉的话后面几轮就不再调用分拣 LLM 了
+os.environ["TRIAGE_MODEL_MIN_EXAMPLES"] = str(10 ** 9)
+# 发件箱连本地假 SMTP 服务器，邮件真的走完 SMTP 会话，只是不会发出去
+smtp_server = FakeSMTPServer().start()
+os.environ["SMTP_SERVER"] = "127.0.0.1"
+os.environ["SMTP_PORT"] = str(smtp_server.port)
+os.environ["SMTP_USE_SSL"] = "0"
+os.environ.setdefault("MAIL_USER", "me@163.com")
+# 必须在导入 core 之前设置，core.gp 在导入时就会创建起草用的模型
+RECORD = len(sys.argv) > 1 and sys.argv[1] == "record"
+LLM_LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 and not RECORD else 0.2
+os.environ["LLM_MODE"] = "record" if RECORD else "replay"
+os.environ["LLM_REPLAY_LATENCY"] = str(LLM_LATENCY)
+os.environ.setdefault("LLM_REPLAY_FALLBACK", "synthetic")
+
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.store.memory import InMemoryStore
+from langgraph.types import Command
+
+from core.gp import workflow, async_workflow
+from core.llm_cassette import get_cassette
+from core.rendered_prompts import get_rendered_prompts
+from utils.metrics import metrics
+from utils.smtp_outbox import get_outbox
+
+ACCEPT = Command(resume={"type": "accept"})
+
+
+def make_emails(n: int, tag: str):
+    # 每封邮件的发件人和主题都不同，不会命中规则、分拣缓存和本地模型
+    return [{
+        "author": f"同学{i} <student{i}@{tag}.example.org>",
+        "to": "me@163.com",
+        "subject": f"{tag} 第 {i} 组课程设计的问题",
+        "email_thread": f"你好，我是第 {i} 组的同学，想问一下实验报告的格式要求。",
+        "thread_id": f"{tag}-{i}",
+        "user_id": "ou_load",
+    } for i in range(n)]
+
+
+def run_threaded(emails, pool_size: int):
+    app = workflow.compile(store=InMemoryStore(), checkpointer=MemorySaver())
+
+    def process(email_input):
+        config = {"configurable": {"thread_id": email_input["thread_id"]}}
+        for _ in app.stream({"email_input": email_input}, config=config):
+            pass
+        assert app.get_state(config).interrupts, "没有停在审核中断上"
+        for _ in app.stream(ACCEPT, config=config):
+            pass
+
+    with ThreadPoolExecutor(max_workers=pool_size) as pool:
+        list(pool.map(process, emails))
+
+
+async def run_async(emails, concurrency: int):
+    app = async_workflow.compile(store=InMemoryStore(), checkpointer=MemorySaver())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(email_input):
+        config = {"configurable": {"thread_id": email_input["thread_id"]}}
+        async with semaphore:
+            async for _ in app.astream({"email_input": email_input}, config=config):
+                pass
+            assert (await app.aget_state(config)).interrupts, "没有停在审核中断上"
+            async for _ in app.astream(ACCEPT, config=config):
+                pass
+
+    await asyncio.gather(*(process(email_input) for email_input in emails))
+
+
+def measure(label: str, fn):
+    peak_threads = threading.active_count()
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak_threads
+        while not done.wait(0.01):
+            peak_threads = max(peak_threads, threading.active_count())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    # 节点里的 print 太多，压测时不输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        count = fn()
+    seconds = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    print(f"{label:<28} {count} 封, 耗时 {seconds:6.2f} s, {count / seconds:7.1f} 封/s, 峰值线程数 {peak_threads}")
+    return count / seconds
+
+
+def main(n: int, pool_size: int):
+    print(f"每次 LLM 调用模拟延迟 {LLM_LATENCY * 1000:.0f} ms，每封邮件 2 次调用 + 1 次中断恢复")
+    threaded = measure(f"线程池 ({pool_size} 线程)",
+                       lambda: run_threaded(make_emails(n, "threaded"), pool_size) or n)
+    same_limit = measure(f"异步图 (并发上限 {pool_size})",
+                         lambda: asyncio.run(run_async(make_emails(n, "async-limited"), pool_size)) or n)
+    unlimited = measure(f"异步图 (并发上限 {n})",
+                        lambda: asyncio.run(run_async(make_emails(n, "async"), n)) or n)
+    print(f"同样并发上限下 异步/线程 = {same_limit / threaded:.2f}x, 放开并发上限后 = {unlimited / threaded:.2f}x")
+    print(f"磁带回放: 精确命中 {metrics.get('cassette.exact_hits')} 次, 按调用类型替代 {metrics.get('cassette.fallback_hits')} 次, "
+          f"模拟响应 {metrics.get('cassette.synthetic')} 次")
+    for template, stats in get_rendered_prompts().stats().items():
+        if isinstance(stats, dict):
+            print(f"{template}: 复用 {stats['hits']} 次, 渲染 {stats['misses']} 次, 复用率 {stats['reuse_rate']:.0%}")
+
+    outbox = get_outbox()
+    queued = outbox.count()
+    assert queued == 3 * n, f"发件箱应有 {3 * n} 封，实际 {queued}"
+    outbox.stop(timeout=1)
+    print(f"发件箱入队 {queued} 封，按限流已发到假 SMTP 服务器 {len(smtp_server.messages)} 封")
+    smtp_server.stop()
+
+
+def record(n: int):
+    """用真实模型把 n 封邮件走一遍完整流程（分拣 -> 起草 -> 确认发送），录成新的磁带"""
+    cassette = get_cassette()
+    cassette.clear()
+    run_threaded(make_emails(n, "record"), 1)
+    print(f"已录制 {len(cassette)} 次调用到 {cassette.path}")
+    get_outbox().stop(timeout=1)
+    smtp_server.stop()
+
+
+if __name__ == '__main__':
+    if RECORD:
+        record(int(sys.argv[2]) if len(sys.argv) > 2 else 3)
+        sys.exit(0)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[3]) if len(sys.argv) > 3 else 32)
@@ -0,0 +1,203 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from langgraph.store.base import BaseStore
+from pydantic import ValidationError
+
+from agents.agent_prompt import (
+    triage_system_prompt,
+    triage_user_prompt,
+    batch_triage_user_prompt,
+    batch_triage_item_prompt,
+    default_background,
+    default_triage_instructions,
+)
+from core.memory import get_user_memory
+from core.models import get_structured_llm, invoke_with_escalation, model_for, usage_config, \
+    TRIAGE_ESCALATION_THRESHOLD
+from core.scheme import RouterScheme, BatchRouterItem, BatchRouterScheme
+from utils.helpers import email_fingerprint, count_tokens, compact_email_thread, TRIAGE_TOKEN_BUDGET
+from utils.metrics import metrics
+from utils.triage_cache import get_triage_cache, preferences_version
+from utils.triage_model import get_triage_model
+from utils.triage_rules import get_triage_rules
+
+load_dotenv()
+
+# 每次批量调用里邮件部分的 token 上限，系统提示词另算
+TRIAGE_BATCH_TOKEN_BUDGET = int(os.getenv("TRIAGE_BATCH_TOKEN_BUDGET", "6000"))
+TRIAGE_BATCH_MAX_ITEMS = int(os.getenv("TRIAGE_BATCH_MAX_ITEMS", "20"))
+# 批量结果里不可用的邮件退回单封分拣时，同时在跑的单封调用数
+TRIAGE_FALLBACK_CONCURRENCY = max(1, int(os.getenv("TRIAGE_FALLBACK_CONCURRENCY", "4")))
+
+
+def chunk_by_budget(sizes: List[int], budget: int = TRIAGE_BATCH_TOKEN_BUDGET,
+                    max_items: int = TRIAGE_BATCH_MAX_ITEMS) -> List[List[int]]:
+    """按顺序把邮件装进批次，装满 token 预算或条数上限就另起一批；单封超预算的邮件单独成批"""
+    chunks, current, used = [], [], 0
+    for i, size in enumerate(sizes):
+        if current and (used + size > budget or len(current) >= max_items):
+            chunks.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _render_item(index: int, email_input: Dict) -> str:
+    return batch_triage_item_prompt.format(
+        index=index,
+        author=email_input.get("author", ""),
+        to=email_input.get("to", ""),
+        subject=email_input.get("subject", ""),
+        email_thread=compact_email_thread(email_input.get("email_thread", ""), TRIAGE_TOKEN_BUDGET),
+    )
+
+
+def _triage_one(system_prompt: str, email_input: Dict) -> RouterScheme:
+    """单封分拣，和 triage_router 里的 LLM 调用完全一致，用于单封成批和批量结果缺失时的兜底"""
+    user_prompt = triage_user_prompt.format(
+        author=email_input.get("author", ""),
+        to=email_input.get("to", ""),
+        subject=email_input.get("subject", ""),
+        email_thread=compact_email_thread(email_input.get("email_thread", ""), TRIAGE_TOKEN_BUDGET),
+    )
+    return invoke_with_escalation(RouterScheme, [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ])
+
+
+def _raw_items(response: Dict) -> List:
+    """
+    取出批量调用原始输出里的 results 列表，不做整体校验：一项字段不合法不能连累同批其他邮件。
+    function calling 方式在 tool_calls 的参数里，json_schema 方式在消息正文里。
+    """
+    raw = response["raw"]
+    if getattr(raw, "tool_calls", None):
+        args = raw.tool_calls[0]["args"]
+    else:
+        try:
+            args = json.loads(raw.content)
+        except (TypeError, ValueError):
+            return []
+    results = args.get("results") if isinstance(args, dict) else None
+    return results if isinstance(results, list) else []
+
+
+def _valid_items(raw_items: List, count: int) -> Dict[int, RouterScheme]:
+    """逐项校验，返回 {批内编号: 结果}；不合法、编号越界或重复、置信度低于升级阈值的项都不要"""
+    by_index: Dict[int, RouterScheme] = {}
+    for raw_item in raw_items:
+        try:
+            item = BatchRouterItem.model_validate(raw_item)
+        except ValidationError as e:
+            print(f"批量分拣结果中有一项不合法，该邮件单独重试: {e.errors()[0]['msg']}")
+            metrics.incr("triage_batch.invalid_items")
+            continue
+        if 1 <= item.index <= count and item.index not in by_index \
+                and item.confidence >= TRIAGE_ESCALATION_THRESHOLD:
+            by_index[item.index] = RouterScheme(reasoning=item.reasoning, classification=item.classification,
+                                                confidence=item.confidence)
+    return by_index
+
+
+def triage_batch(emails: List[Dict], triage_instructions: str, background: str = default_background,
+                 token_budget: int = TRIAGE_BATCH_TOKEN_BUDGET,
+                 max_items: int = TRIAGE_BATCH_MAX_ITEMS) -> List[RouterScheme]:
+    """
+    一次结构化调用分拣多封邮件，返回与 emails 一一对应的 RouterScheme 列表。
+    批量调用用分拣小模型，结果逐项校验；缺失、不合法、重复、置信度低于升级阈值或整批调用失败的邮件，
+    并发地退回单封调用（会按需升级到大模型）。
+    """
+    system_prompt = triage_system_prompt.format(background=background, triage_instructions=triage_instructions)
+    sizes = [count_tokens(_render_item(i + 1, email_input)) for i, email_input in enumerate(emails)]
+    results: List[Optional[RouterScheme]] = [None] * len(emails)
+
+    for chunk in chunk_by_budget(sizes, token_budget, max_items):
+        if len(chunk) == 1:
+            results[chunk[0]] = _triage_one(system_prompt, emails[chunk[0]])
+            continue
+        # 批内从 1 开始编号，模型不需要知道全局下标
+        items = "".join(_render_item(n, emails[i]) for n, i in enumerate(chunk, start=1))
+        try:
+            response = get_structured_llm(BatchRouterScheme, model_for("triage"), include_raw=True).invoke([
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": batch_triage_user_prompt.format(count=len(chunk), emails=items)},
+            ], config=usage_config("triage_batch"))
+            metrics.incr("triage_batch.calls")
+            by_index = _valid_items(_raw_items(response), len(chunk))
+        except Exception as e:
+            print(f"批量分拣失败，逐封重试: {e}")
+            metrics.incr("triage_batch.failed_calls")
+            by_index = {}
+
+        for n, i in enumerate(chunk, start=1):
+            if n in by_index:
+                results[i] = by_index[n]
+        missing = [i for n, i in enumerate(chunk, start=1) if n not in by_index]
+        if missing:
+            # 只有批量调用没给出可用结果的才算兜底，本来就单封成批的不算
+            metrics.incr("triage_batch.fallback", len(missing))
+            with ThreadPoolExecutor(max_workers=min(len(missing), TRIAGE_FALLBACK_CONCURRENCY)) as pool:
+                for i, result in zip(missing, pool.map(lambda i: _triage_one(system_prompt, emails[i]), missing)):
+                    results[i] = result
+        metrics.incr("triage_batch.items", len(by_index))
+    return results
+
+
+def prefetch_triage(emails: List[Dict], store: BaseStore) -> int:
+    """
+    积压了多封新邮件时，先把规则、缓存、本地模型都拿不准的那些批量分拣一遍，结果写进分拣缓存；
+    随后每封邮件进入图时，triage_router 直接命中缓存。返回本次批量分拣的邮件数。
+    分拣偏好是按用户的，不同用户的邮件分开批量。
+    """
+    by_user: Dict[Optional[str], List[Dict]] = {}
+    for email_input in emails:
+        by_user.setdefault(email_input.get("user_id"), []).append(email_input)
+    return sum(_prefetch_for_user(user_id, user_emails, store) for user_id, user_emails in by_user.items())
+
+
+def _prefetch_for_user(user_id: Optional[str], emails: List[Dict], store: BaseStore) -> int:
+    triage_instructions = get_user_memory(store, user_id, "triage_preferences", default_triage_instructions)
+    prefs_version = preferences_version(user_id, triage_instructions, default_background)
+    triage_cache = get_triage_cache()
+
+    pending = []
+    for email_input in emails:
+        fingerprint = email_fingerprint(email_input)
+        # 和 triage_router 的顺序一致；这里只是看一眼缓存里有没有，不计入命中率，真正的命中在 triage_router 里统计
+        if triage_cache.contains(fingerprint, prefs_version) \
+                or get_triage_model(email_input.get("user_id")).predict(email_input) \
+                or get_triage_rules().evaluate(email_input):
+            continue
+        pending.append((fingerprint, email_input))
+    if len(pending) < 2:
+        # 只剩一封就没有合并的意义，交给 triage_router 正常处理
+        return 0
+
+    results = triage_batch([email_input for _, email_input in pending], triage_instructions)
+    for (fingerprint, _), result in zip(pending, results):
+        triage_cache.put(fingerprint, prefs_version, result.model_dump())
+    return len(pending)
+
+
+if __name__ == '__main__':
+    backlog = [
+        {"author": f"同学{i} <s{i}@qq.com>", "to": "me@163.com", "subject": f"课程设计第 {i} 组的问题",
+         "email_thread": "老师让我们周五前交报告，想问一下你们组的进度，另外实验数据能不能共享一下？" * 3}
+        for i in range(30)
+    ]
+    system_tokens = count_tokens(triage_system_prompt.format(
+        background=default_background, triage_instructions=default_triage_instructions))
+    sizes = [count_tokens(_render_item(i + 1, e)) for i, e in enumerate(backlog)]
+    chunks = chunk_by_budget(sizes)
+    single = len(backlog) * system_tokens + sum(sizes)
+    batched = len(chunks) * system_tokens + sum(sizes)
+    print(f"{len(backlog)} 封邮件 -> {len(chunks)} 次调用，每批 {[len(c) for c in chunks]} 封")
+    print(f"输入 token 估算: 逐封 {single}, 批量 {batched}, 节省 {1 - batched / single:.0%}")
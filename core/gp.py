@@ -1,3 +1,5 @@
+import asyncio
+from datetime import datetime
 from typing import Literal
 
 from dotenv import load_dotenv
@@ -17,16 +19,26 @@ from agents.agent_prompt import (
 
 )
 from agents.tool_prompt import tools_prompt
-from agents.tools import write_email, Question, Done
-from core.models import get_llm
+from agents.tools import write_email, search_email, Question, Done, send_email_once
+from core.models import get_tool_llm, invoke_with_escalation, ainvoke_with_escalation, model_for, usage_config
 from core.scheme import StateInput
 from core.scheme import RouterScheme, State
 from utils.helpers import format_for_display
-from utils.helpers import parse_email, format_email_markdown
-from core.memory import get_memory, update_memory, load_from_disk
+from utils.helpers import parse_email, format_email_markdown, email_fingerprint
+from utils.helpers import compact_email_thread, count_tokens, TRIAGE_TOKEN_BUDGET, DRAFT_TOKEN_BUDGET
+from utils.helpers import CONVERSATION_HISTORY_LIMIT, HISTORY_TOKEN_BUDGET
+from utils.metrics import metrics
+from core.memory import get_user_snapshot, aget_user_snapshot, user_namespace, load_from_disk, PreferenceSnapshot
+from core.rendered_prompts import get_rendered_prompts
+from core.memory_queue import get_memory_queue
+from utils.mail_mirror import mark_email_status, get_mail_mirror
+from utils.triage_cache import get_triage_cache, preferences_version
+from utils.triage_rules import get_triage_rules
+from utils.triage_model import record_decision, get_triage_model
 
 tools = [
     write_email,
+    search_email,
     Question,
     Done,
 ]
@@ -34,60 +46,143 @@ tools_by_name = {}
 for tool in tools:
     name = tool.name
     tools_by_name[name] = tool
+# 需要用户在飞书上审核后才能执行的工具
+HITL_TOOLS = ["write_email"]
 
 load_dotenv()
-llm = get_llm()
 
-llm_router = llm.with_structured_output(RouterScheme)
-llm_tools = llm.bind_tools(tools, tool_choice="required")
+llm_tools = get_tool_llm(tools, model_for("response"), tool_choice="required")
 
 
-def triage_router(state: State, store: BaseStore) -> Command[
-    Literal["triage_interrupt_handler", "response_agent", "__end__"]]:
-    # author, to, subject, email_thread = parse_email(state["email_input"])
-    email_input = state.get("email_input")
-    if not email_input:
-        # 如果状态里没有 email_input，说明可能是从中断直接恢复的，或者流程已经结束
-        # 这种情况下，如果分类已经是 ignore/accept，我们直接结束
-        if state.get("classification") in ["ignore", "accept"]:
-            return Command(goto="__end__", update={})
-        # 否则抛出一个更有意义的错误
-        raise ValueError("无法从 State 中获取 email_input 数据")
+def _user_id(state: State):
+    """偏好按飞书用户隔离，user_id 在拉取邮件时写进了 email_input"""
+    return (state.get("email_input") or {}).get("user_id")
+
+
+class _Call:
+    """
+    节点里一次会阻塞的调用（读偏好、读写 SQLite、调用 LLM、发信入队）。
+    每个节点只写一个生成器版本，遇到这类调用就 yield 一个 _Call（或一组，异步图里并发执行）：
+    同步图直接调用 fn，异步图 await afn，没有 afn 的放到线程里执行。
+    interrupt() 在生成器里直接调用，始终处在节点自己的上下文中。
+    """
+
+    def __init__(self, fn, *args, afn=None):
+        self.fn, self.args, self.afn = fn, args, afn
+
+    def run(self):
+        return self.fn(*self.args)
+
+    async def arun(self):
+        if self.afn is not None:
+            return await self.afn(*self.args)
+        return await asyncio.to_thread(self.fn, *self.args)
 
+
+def _drive(steps):
+    """同步图的节点：依次执行生成器 yield 出来的调用并把结果送回去，返回生成器的返回值"""
+    result = None
+    while True:
+        try:
+            call = steps.send(result)
+        except StopIteration as done:
+            return done.value
+        result = [c.run() for c in call] if isinstance(call, list) else call.run()
+
+
+async def _adrive(steps):
+    """异步图的节点：同 _drive，等待时不占线程"""
+    result = None
+    while True:
+        try:
+            call = steps.send(result)
+        except StopIteration as done:
+            return done.value
+        result = await asyncio.gather(*(c.arun() for c in call)) if isinstance(call, list) else await call.arun()
+
+
+def _prepare_triage(state: State, store: BaseStore, triage_prefs: PreferenceSnapshot):
+    """
+    分拣前的准备工作：压缩正文、拼提示词，
+    依次尝试分拣缓存（内容相同且偏好没变）、按用户的审核决策训练的本地模型、规则分拣。
+    前两个都反映了用户自己的偏好和反馈，排在通用规则前面，用户纠正过的分类不会再被规则盖掉。
+    """
+    email_input = state["email_input"]
     author, to, subject, email_thread = parse_email(email_input)
-    email_markdown = format_email_markdown(subject, author, to, email_thread)
-    current_triage_prefs = get_memory(
-        store,
-        ("email_assistant", "triage_preferences"),
-        default_triage_instructions
-    )
+    # 分拣和起草各有各的正文 token 预算，超长的转发链、群发邮件先压缩再拼进提示词
+    triage_thread = compact_email_thread(email_thread, TRIAGE_TOKEN_BUDGET)
+    draft_thread = compact_email_thread(email_thread, DRAFT_TOKEN_BUDGET)
+    metrics.incr("tokens.saved.triage", count_tokens(email_thread) - count_tokens(triage_thread))
 
     user_prompt = triage_user_prompt.format(
         author=author,
         to=to,
         subject=subject,
-        email_thread=email_thread
+        email_thread=triage_thread
     )
-    system_prompt = triage_system_prompt.format(
-        background=default_background,
-        triage_instructions=current_triage_prefs
+    # 同一用户同一版分拣偏好的系统提示词只拼一次
+    system_prompt = get_rendered_prompts().render(
+        "triage_system_prompt",
+        (id(store), _user_id(state), triage_prefs.version),
+        lambda: triage_system_prompt.format(
+            background=default_background,
+            triage_instructions=triage_prefs.preferences
+        )
     )
 
-    result = llm_router.invoke(
-        [
+    triage_cache = get_triage_cache()
+    fingerprint = email_fingerprint(email_input)
+    prefs_version = preferences_version(_user_id(state), triage_prefs.preferences, default_background)
+    fast_result = triage_cache.get(fingerprint, prefs_version) \
+        or get_triage_model(_user_id(state)).predict(email_input) \
+        or get_triage_rules().evaluate(email_input)
+    return {
+        "author": author,
+        "email_markdown": format_email_markdown(subject, author, to, draft_thread),
+        "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
-        ]
+        ],
+        "fingerprint": fingerprint,
+        "prefs_version": prefs_version,
+        # 早期写入缓存的结果没有 confidence 字段
+        "fast_result": RouterScheme(**{"confidence": 1.0, **fast_result}) if fast_result else None,
+    }
+
+
+def _conversation_context(email_input: dict) -> str:
+    """
+    同一会话里之前的来信。每封来信有自己的 checkpoint，会话上下文按镜像里的会话索引取，
+    每封压缩到 HISTORY_TOKEN_BUDGET 以内。不是从邮箱同步来的邮件（没有会话 ID）返回空串。
+    """
+    if not email_input.get("conversation_id"):
+        return ""
+    history = get_mail_mirror().conversation_history(email_input, CONVERSATION_HISTORY_LIMIT)
+    return "\n".join(
+        format_email_markdown(earlier["subject"], earlier["author"], earlier["to"],
+                              compact_email_thread(earlier["email_thread"], HISTORY_TOKEN_BUDGET))
+        for earlier in history
     )
+
+
+def _route_triage(state: State, prepared: dict, result: RouterScheme, from_llm: bool) -> Command:
+    email_input = state["email_input"]
+    if from_llm:
+        get_triage_cache().put(prepared["fingerprint"], prepared["prefs_version"], result.model_dump())
+    else:
+        print(f"跳过 LLM 调用：{result.reasoning}")
     classification = result.classification
+    mark_email_status(email_input, "done" if classification == "ignore" else "triaged", classification)
     if classification == "respond":
         print(f"分类结果：回复 - 这封邮件需要撰写回信")
         goto = "response_agent"
+        content = f"请回复下面这封邮件。\n注意：调用写信工具时，'to'(收件人) 参数是原邮件的发件人({prepared['author']})，绝对不能发给原来的【收件人】！\n\n{prepared['email_markdown']}"
+        history = _conversation_context(email_input)
+        if history:
+            content += f"\n\n同一会话中之前的来信（仅作为背景，只需要回复上面这一封）：\n{history}"
         update = {
             "classification": classification,
-            "messages": [{"role": "user",
-                          "content": f"请回复下面这封邮件。\n注意：调用写信工具时，'to'(收件人) 参数是原邮件的发件人({author})，绝对不能发给原来的【收件人】！\n\n{email_markdown}"
-                          }],
+            "messages": [{"role": "user", "content": content}],
         }
 
     elif classification == "ignore":
@@ -108,10 +203,52 @@ def triage_router(state: State, store: BaseStore) -> Command[
     return Command(goto=goto, update=update)
 
 
-def triage_interrupt_handler(state: State, store: BaseStore) -> Command[Literal["response_agent", "__end__"]]:
-    email_input = state["email_input"]
+def _missing_email_input(state: State) -> Command:
+    # 如果状态里没有 email_input，说明可能是从中断直接恢复的，或者流程已经结束
+    # 这种情况下，如果分类已经是 ignore/accept，我们直接结束
+    if state.get("classification") in ["ignore", "accept"]:
+        return Command(goto="__end__", update={})
+    # 否则抛出一个更有意义的错误
+    raise ValueError("无法从 State 中获取 email_input 数据")
+
+
+def _triage_router(state: State, store: BaseStore):
+    if not state.get("email_input"):
+        return _missing_email_input(state)
+    triage_prefs = yield _Call(get_user_snapshot, store, _user_id(state), "triage_preferences",
+                               default_triage_instructions, afn=aget_user_snapshot)
+    # 准备和路由里有 SQLite 读写（分拣缓存、本地模型、邮件镜像）和 tiktoken（首次使用要下载词表）
+    prepared = yield _Call(_prepare_triage, state, store, triage_prefs)
+    if prepared["fast_result"]:
+        return (yield _Call(_route_triage, state, prepared, prepared["fast_result"], False))
+    # 先用小模型分拣，置信度不够再升级到大模型
+    result = yield _Call(invoke_with_escalation, RouterScheme, prepared["messages"], afn=ainvoke_with_escalation)
+    return (yield _Call(_route_triage, state, prepared, result, True))
+
+
+def triage_router(state: State, store: BaseStore) -> Command[
+    Literal["triage_interrupt_handler", "response_agent", "__end__"]]:
+    return _drive(_triage_router(state, store))
+
+
+async def atriage_router(state: State, store: BaseStore) -> Command[
+    Literal["triage_interrupt_handler", "response_agent", "__end__"]]:
+    return await _adrive(_triage_router(state, store))
+
+
+def _notify_markdown(email_input: dict) -> str:
     author, to, subject, email_thread = parse_email(email_input)
-    email_markdown = format_email_markdown(subject, author, to, email_thread)
+    return format_email_markdown(subject, author, to, compact_email_thread(email_thread, DRAFT_TOKEN_BUDGET))
+
+
+def _triage_interrupt_handler(state: State, store: BaseStore):
+    """
+    发出“通知”审核卡片并等待用户操作，用户的反馈交给偏好整理队列（入队不阻塞），
+    用户的决定作为本地分拣模型的样本。
+    """
+    email_input = state["email_input"]
+    email_markdown = yield _Call(_notify_markdown, email_input)
+    subject = parse_email(email_input)[2]
     curr_thread_id = email_input.get("thread_id")
     curr_user_id = email_input.get("user_id")
 
@@ -140,6 +277,7 @@ def triage_interrupt_handler(state: State, store: BaseStore) -> Command[Literal[
     res = interrupt([request])
     response = res[0] if isinstance(res, list) else res
 
+    learning = None
     if response["type"] == "response":
         user_input = response["args"]
 
@@ -152,7 +290,8 @@ def triage_interrupt_handler(state: State, store: BaseStore) -> Command[Literal[
             "role": "user",
             "content": f"原邮件主题：{subject}\n系统原分类：{state['classification']}\n用户的纠正或指导意见：{user_input}\n请根据此意见，提取并更新邮件的处理或回复偏好。"
         }]
-        update_memory(store, ("email_assistant", "triage_preferences"), learning_message)
+        learning = (user_namespace(curr_user_id, "triage_preferences"), learning_message)
+        decision = "respond"
 
         goto = "response_agent"
 
@@ -161,154 +300,188 @@ def triage_interrupt_handler(state: State, store: BaseStore) -> Command[Literal[
             "role": "user",
             "content": "用户忽略了这封邮件。请更新分拣偏好，确保以后类似邮件直接被归类为'ignore'，不要再打扰用户。"
         }]
-        update_memory(store, ("email_assistant", "triage_preferences"), messages + learning_message)
+        learning = (user_namespace(curr_user_id, "triage_preferences"), messages + learning_message)
+        decision = "ignore"
 
         # 流程直接结束
         goto = END
 
     elif response["type"] == "accept":
         print("通知已阅，流程结束。")
+        decision = "notify"
         goto = END
 
     else:
         raise ValueError(f"无法识别的响应类型: {response['type']}")
+    if learning:
+        get_memory_queue().submit(store, *learning)
+    yield _Call(record_decision, email_input, decision, "triage_interrupt")
+    return Command(goto=goto, update={"messages": messages})
 
-    update = {
-        "messages": messages,
-    }
 
-    return Command(goto=goto, update=update)
+def triage_interrupt_handler(state: State, store: BaseStore) -> Command[Literal["response_agent", "__end__"]]:
+    return _drive(_triage_interrupt_handler(state, store))
+
+
+async def atriage_interrupt_handler(state: State, store: BaseStore) -> Command[
+    Literal["response_agent", "__end__"]]:
+    return await _adrive(_triage_interrupt_handler(state, store))
+
+
+def _response_agent(state: State, store: BaseStore):
+    response_prefs, cal_prefs = yield [
+        _Call(get_user_snapshot, store, _user_id(state), "response_preferences", default_response_preferences,
+              afn=aget_user_snapshot),
+        _Call(get_user_snapshot, store, _user_id(state), "cal_preferences", default_cal_preferences,
+              afn=aget_user_snapshot),
+    ]
+    today = datetime.now().strftime("%Y-%m-%d")
+    # 反复打回重写时偏好版本和日期都没变，直接复用上次拼好的系统提示词
+    prompt_content = get_rendered_prompts().render(
+        "agent_system_prompt",
+        (id(store), _user_id(state), response_prefs.version, cal_prefs.version, today),
+        lambda: agent_system_prompt.format(
+            tools_prompt=tools_prompt,
+            background=default_background,
+            response_preferences=response_prefs.preferences,  # 注入专属写信偏好
+            cal_preferences=cal_prefs.preferences,  # 注入专属日程偏好
+            today=today
+        )
+    )
+    full_messages = [{"role": "system", "content": prompt_content}] + state["messages"]
+    ai_message = yield _Call(llm_tools.invoke, full_messages, usage_config("response"), afn=llm_tools.ainvoke)
+    return {"messages": [ai_message]}
 
 
 def response_agent(state: State, store: BaseStore):
-    current_response_prefs = get_memory(
-        store,
-        ("email_assistant", "response_preferences"),
-        default_response_preferences
-    )
-    current_cal_prefs = get_memory(
-        store,
-        ("email_assistant", "cal_preferences"),
-        default_cal_preferences
-    )
-    prompt_content = agent_system_prompt.format(
-        tools_prompt=tools_prompt,
-        background=default_background,
-        response_preferences=current_response_prefs,  # 注入专属写信偏好
-        cal_preferences=current_cal_prefs  # 注入专属日程偏好
-    )
-    system_message = {"role": "system", "content": prompt_content}
-    full_messages = [system_message] + state["messages"]
-    ai_message = llm_tools.invoke(full_messages)
-    return {"messages": [ai_message]}
+    return _drive(_response_agent(state, store))
 
 
-def interrupt_handler(state: State, store: BaseStore) -> Command[Literal["response_agent", "__end__"]]:
-    result = []
-    response = None
-    goto = "response_agent"
+async def aresponse_agent(state: State, store: BaseStore):
+    return await _adrive(_response_agent(state, store))
 
-    for tool_call in state["messages"][-1].tool_calls:
-        hitl_tools = ["write_email"]
-        if tool_call["name"] not in hitl_tools:
-            tool = tools_by_name[tool_call["name"]]
-            observation = tool.invoke(tool_call["args"])
-            result.append({
-                "role": "tool",
-                "content": observation,
-                "tool_call_id": tool_call["id"]
-            })
-            continue
 
-        email_input = state["email_input"]
-        author, to, subject, email_thread = parse_email(email_input)
-        original_email_markdown = format_email_markdown(subject, author, to, email_thread)
-        curr_thread_id = email_input.get("thread_id")
-        curr_user_id = email_input.get("user_id")
-        tool_display = format_for_display(tool_call)
-        description = original_email_markdown + tool_display
-
-        config = {
-            "allow_ignore": True,
-            "allow_respond": True,
-            "allow_edit": True,
-            "allow_accept": True,
-        }
+def _tool_message(tool_call: dict, observation) -> dict:
+    return {"role": "tool", "content": observation, "tool_call_id": tool_call["id"]}
 
-        request = {
-            "action_request": {
-                "action": tool_call["name"],
-                "args": tool_call["args"]
-            },
-            "config": config,
-            "description": description,
-            "user_id": curr_user_id,  # 新增：收件人
-            "thread_id": curr_thread_id  # 新增：thread_id
+
+def _review_decision(state: State, tool_call: dict) -> tuple:
+    """发出审核中断，返回 (goto, 追加的消息, 需要学习的 (namespace, messages) 或 None, 需要发送的邮件参数或 None)"""
+    email_input = state["email_input"]
+    author, to, subject, email_thread = parse_email(email_input)
+    original_email_markdown = format_email_markdown(subject, author, to, email_thread)
+    curr_thread_id = email_input.get("thread_id")
+    curr_user_id = email_input.get("user_id")
+    tool_display = format_for_display(tool_call)
+    description = original_email_markdown + tool_display
+
+    config = {
+        "allow_ignore": True,
+        "allow_respond": True,
+        "allow_edit": True,
+        "allow_accept": True,
+    }
+
+    request = {
+        "action_request": {
+            "action": tool_call["name"],
+            "args": tool_call["args"]
+        },
+        "config": config,
+        "description": description,
+        "user_id": curr_user_id,  # 新增：收件人
+        "thread_id": curr_thread_id  # 新增：thread_id
+    }
+
+    res = interrupt([request])
+    # 如果恢复时传回的是 dict (飞书)，直接用；如果是 list (本地模拟)，取第一个
+    response = res[0] if isinstance(res, list) else res
+
+    if response["type"] == "response":
+        user_feedback = response["args"]
+        print(f"检测到针对邮件草稿的反馈: {user_feedback}")
+
+        learning_message = [{
+            "role": "user",
+            "content": f"用户对你生成的邮件草稿提出了修改意见：'{user_feedback}'。请将此偏好加入‘回复偏好’档案，以便下次生成的草稿更符合用户要求。"
+        }]
+        message = {
+            "role": "user",
+            "content": f"这是我对草稿的反馈意见，请参考并重新写一版：{user_feedback}"
         }
+        return "response_agent", message, (user_namespace(curr_user_id, "response_preferences"), learning_message), None
 
-        res = interrupt([request])
-        # 如果恢复时传回的是 dict (飞书)，直接用；如果是 list (本地模拟)，取第一个
-        response = res[0] if isinstance(res, list) else res
+    elif response["type"] == "edit":
+        # 这里的 new_args 现在是用户在飞书输入框里写的纯文本（即用户手动重写的邮件正文）
+        user_manual_content = response["args"]
+        print("检测到用户手动修改了邮件，正在分析修改习惯...")
 
-        if response["type"] == "response":
-            user_feedback = response["args"]
-            print(f"检测到针对邮件草稿的反馈: {user_feedback}")
+        # 提取 AI 原本打算发送的参数
+        original_args = tool_call["args"]
 
-            learning_message = [{
-                "role": "user",
-                "content": f"用户对你生成的邮件草稿提出了修改意见：'{user_feedback}'。请将此偏好加入‘回复偏好’档案，以便下次生成的草稿更符合用户要求。"
-            }]
+        # 组装新的合法参数字典，保留原收件人和主题，替换正文
+        new_args = {
+            "to": original_args.get("to"),
+            "subject": original_args.get("subject"),
+            "content": user_manual_content  # 注入用户手动写的正文
+        }
+
+        learning_message = [{
+            "role": "user",
+            "content": f"原始生成的参数：{original_args}\n用户手动修改后的参数：{new_args}\n请分析用户的修改点（如语气、落款、格式），并更新‘回复偏好’档案。"
+        }]
+        return "__end__", None, (user_namespace(curr_user_id, "response_preferences"), learning_message), new_args
 
-            update_memory(store, ("email_assistant", "response_preferences"), learning_message)
+    elif response["type"] == "accept":
+        print("用户点击确认，直接发送原草稿...")
+        return "__end__", None, None, tool_call["args"]
 
-            result.append({
-                "role": "user",
-                "content": f"这是我对草稿的反馈意见，请参考并重新写一版：{user_feedback}"
-            })
-            goto = "response_agent"
+    # 【新增】：用户点击忽略，取消发送
+    elif response["type"] == "ignore":
+        print("用户忽略了此邮件，已取消发送...")
+        # 取消发送不代表这封邮件不该分拣为 respond（可能是草稿不满意、打算自己回），不作为分拣样本
+        # LangGraph 要求必须返回一个 ToolMessage 来闭环，所以我们模拟一个空结果
+        return "__end__", _tool_message(tool_call, "用户已取消操作，未发送邮件。"), None, None
 
-        elif response["type"] == "edit":
-            # 这里的 new_args 现在是用户在飞书输入框里写的纯文本（即用户手动重写的邮件正文）
-            user_manual_content = response["args"]
-            print("检测到用户手动修改了邮件，正在分析修改习惯...")
+    raise ValueError(f"无法识别的响应类型: {response['type']}")
 
-            # 提取 AI 原本打算发送的参数
-            original_args = tool_call["args"]
 
-            # 组装新的合法参数字典，保留原收件人和主题，替换正文
-            new_args = {
-                "to": original_args.get("to"),
-                "subject": original_args.get("subject"),
-                "content": user_manual_content  # 注入用户手动写的正文
-            }
+def _send_reviewed(state: State, tool_call: dict, send_args: dict) -> dict:
+    email_input = state["email_input"]
+    observation = send_email_once(email_input.get("thread_id"), tool_call["id"], send_args)
+    record_decision(email_input, "respond", "draft_review")
+    return _tool_message(tool_call, observation)
 
-            learning_message = [{
-                "role": "user",
-                "content": f"原始生成的参数：{original_args}\n用户手动修改后的参数：{new_args}\n请分析用户的修改点（如语气、落款、格式），并更新‘回复偏好’档案。"
-            }]
-            update_memory(store, ("email_assistant", "response_preferences"), learning_message)
 
-            tool = tools_by_name[tool_call["name"]]
-            observation = tool.invoke(new_args)
-            result.append({"role": "tool", "content": observation, "tool_call_id": tool_call["id"]})
-            goto = "__end__"
+def _interrupt_handler(state: State, store: BaseStore):
+    result = []
+    goto = "response_agent"
 
-        elif response["type"] == "accept":
-            print("用户点击确认，直接发送原草稿...")
+    for tool_call in state["messages"][-1].tool_calls:
+        if tool_call["name"] not in HITL_TOOLS:
             tool = tools_by_name[tool_call["name"]]
-            observation = tool.invoke(tool_call["args"])
-            result.append({"role": "tool", "content": observation, "tool_call_id": tool_call["id"]})
-            goto = "__end__"
+            observation = yield _Call(tool.invoke, tool_call["args"], afn=tool.ainvoke)
+            result.append(_tool_message(tool_call, observation))
+            continue
+
+        # write_email 草稿先给用户审核，用户的修改意见交给偏好整理队列（入队不阻塞）
+        goto, message, learning, send_args = _review_decision(state, tool_call)
+        if learning:
+            get_memory_queue().submit(store, *learning)
+        if send_args is not None:
+            message = yield _Call(_send_reviewed, state, tool_call, send_args)
+        if message:
+            result.append(message)
+
+    return Command(goto=goto, update={"messages": result})
+
+
+def interrupt_handler(state: State, store: BaseStore) -> Command[Literal["response_agent", "__end__"]]:
+    return _drive(_interrupt_handler(state, store))
 
-        # 【新增】：用户点击忽略，取消发送
-        elif response["type"] == "ignore":
-            print("用户忽略了此邮件，已取消发送...")
-            # LangGraph 要求必须返回一个 ToolMessage 来闭环，所以我们模拟一个空结果
-            result.append({"role": "tool", "content": "用户已取消操作，未发送邮件。", "tool_call_id": tool_call["id"]})
-            goto = "__end__"
 
-    update_data = {"messages": result}
-    return Command(goto=goto, update=update_data)
+async def ainterrupt_handler(state: State, store: BaseStore) -> Command[Literal["response_agent", "__end__"]]:
+    return await _adrive(_interrupt_handler(state, store))
 
 
 def should_continue(state: State) -> Literal["interrupt_handler", "__end__"]:
@@ -323,20 +496,30 @@ def should_continue(state: State) -> Literal["interrupt_handler", "__end__"]:
     return "interrupt_handler"
 
 
-workflow = StateGraph(State, input_schema=StateInput)
-workflow.add_node("triage_router", triage_router)
-workflow.add_node("response_agent", response_agent)
-workflow.add_node("triage_interrupt_handler", triage_interrupt_handler)
-workflow.add_node("interrupt_handler", interrupt_handler)
-workflow.add_edge(START, "triage_router")
-workflow.add_conditional_edges(
-    "response_agent",
-    should_continue,
-    {
-        "interrupt_handler": "interrupt_handler",
-        "__end__": END
-    }
-)
+def build_workflow(use_async: bool = False) -> StateGraph:
+    """
+    同样的图结构，use_async=True 时节点换成 async 版本（和同步版本共用一个生成器实现），需要用 ainvoke/astream 驱动；
+    飞书服务端用异步版本，让大量等待 LLM 的流程共用一个事件循环。
+    """
+    graph = StateGraph(State, input_schema=StateInput)
+    graph.add_node("triage_router", atriage_router if use_async else triage_router)
+    graph.add_node("response_agent", aresponse_agent if use_async else response_agent)
+    graph.add_node("triage_interrupt_handler", atriage_interrupt_handler if use_async else triage_interrupt_handler)
+    graph.add_node("interrupt_handler", ainterrupt_handler if use_async else interrupt_handler)
+    graph.add_edge(START, "triage_router")
+    graph.add_conditional_edges(
+        "response_agent",
+        should_continue,
+        {
+            "interrupt_handler": "interrupt_handler",
+            "__end__": END
+        }
+    )
+    return graph
+
+
+workflow = build_workflow()
+async_workflow = build_workflow(use_async=True)
 
 if __name__ == '__main__':
     import uuid
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from utils.metrics import metrics
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# live: 直接调用真实模型；record: 调用真实模型并把响应录进磁带；replay: 只从磁带回放，不访问网络
+LLM_MODE = os.getenv("LLM_MODE", "live").lower()
+LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH") or os.path.join(CURRENT_DIR, "cassettes", "graph_flow.json")
+# 回放时每次调用等待的秒数；不设置就按录制时实测的耗时等待
+LLM_REPLAY_LATENCY = os.getenv("LLM_REPLAY_LATENCY", "")
+# 回放时精确匹配不到怎么办：0（默认）直接报错，提示词一变就能发现；1 退回到同类调用的录音；
+# synthetic 按绑定的工具 / 结构化输出的 JSON Schema 生成一个确定的响应，没有磁带也能跑。
+# 只关心吞吐量、不关心响应内容的压测（如 benchmarks/load_test_graph.py）才打开
+LLM_REPLAY_FALLBACK = os.getenv("LLM_REPLAY_FALLBACK", "0").lower()
+EMAIL_ADDRESS = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+
+def _call_signature(model_name: str, tools: Sequence[Dict], tool_choice: Any) -> str:
+    """同一类调用（哪个模型、绑定了哪些工具/结构化输出）的标识，精确匹配不到时按它找替代的录音"""
+    names = sorted(tool["function"]["name"] for tool in tools)
+    return f"{model_name}|{','.join(names)}|{tool_choice or ''}"
+
+
+def _request_key(signature: str, messages: List[BaseMessage]) -> str:
+    """按调用类型和消息内容算指纹；tool_call id 每次运行都不一样，不参与计算"""
+    payload = [signature] + [
+        [m.type, m.content, [[tc["name"], tc["args"]] for tc in getattr(m, "tool_calls", None) or []]]
+        for m in messages
+    ]
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")) \
+        .hexdigest()
+
+
+def _synthetic_value(schema: Dict, name: str, messages: List[BaseMessage]) -> Any:
+    """按 JSON Schema 生成确定的取值：有默认值用默认值，枚举取第一项，数值取上限，数组只放一项"""
+    if "default" in schema:
+        return schema["default"]
+    if "enum" in schema:
+        return schema["enum"][0]
+    for option in schema.get("anyOf", []):
+        if option.get("type") != "null":
+            return _synthetic_value(option, name, messages)
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: _synthetic_value(sub, key, messages) for key, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_synthetic_value(schema.get("items", {}), name, messages)]
+    if kind == "integer":
+        return schema.get("minimum", 0)
+    if kind == "number":
+        return schema.get("maximum", 1.0)
+    if kind == "boolean":
+        return True
+    if name == "to":
+        # 写信工具的收件人取最后一条用户消息里出现的第一个地址，也就是提示词里给出的原发件人
+        for message in reversed(messages):
+            if message.type == "human":
+                match = EMAIL_ADDRESS.search(str(message.content))
+                if match:
+                    return match.group(0)
+        return "someone@example.com"
+    return f"模拟的 {name}"
+
+
+def synthetic_message(key: str, messages: List[BaseMessage], tools: Sequence[Dict], tool_choice: Any) -> AIMessage:
+    """
+    不看磁带、按绑定的工具生成一个确定的响应：tool_choice 指定了工具就调用它，否则调用第一个工具；
+    结构化输出（with_structured_output）在这里也是一次工具调用。同样的请求总是得到同样的响应。
+    """
+    if not tools or tool_choice == "none":
+        return AIMessage(content="这是一条模拟的回复。")
+    if isinstance(tool_choice, dict):
+        tool = next(tool for tool in tools if tool["function"]["name"] == tool_choice["function"]["name"])
+    else:
+        tool = tools[0]
+    function = tool["function"]
+    args = _synthetic_value(function.get("parameters", {}), "", messages)
+    return AIMessage(content="", tool_calls=[{"name": function["name"], "args": args, "id": f"call_{key[:24]}"}])
+
+
+class CassetteMiss(LookupError):
+    """回放时磁带里没有这次请求的录音：提示词、消息或绑定的工具和录制时不一样了"""
+
+
+class Cassette:
+    """
+    录音磁带：一个 JSON 文件，每条记录是一次模型调用的请求指纹和完整的 AIMessage（含 tool_calls 和 usage）。
+    回放时按请求指纹精确匹配，匹配不到就抛 CassetteMiss。fallback="1" 时改为按调用类型（模型 + 工具）
+    轮流使用录到的响应并打印警告；fallback="synthetic" 时返回 None，由调用方生成确定的模拟响应。
+    后两种只给不关心响应内容的压测用。
+    """
+
+    def __init__(self, path: str = LLM_CASSETTE_PATH, fallback: str = LLM_REPLAY_FALLBACK):
+        self.path = path
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._entries: List[Dict] = []
+        self._by_key: Dict[str, Dict] = {}
+        self._by_signature: Dict[str, List[Dict]] = {}
+        self._cursor: Dict[str, int] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for entry in json.load(f).get("entries", []):
+                    self._index(entry)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        """清空磁带（重新录制前调用），文件在录到第一条时被覆盖"""
+        with self._lock:
+            self._entries, self._by_key, self._by_signature, self._cursor = [], {}, {}, {}
+
+    def _index(self, entry: Dict):
+        self._entries.append(entry)
+        self._by_key[entry["key"]] = entry
+        self._by_signature.setdefault(entry["signature"], []).append(entry)
+
+    def lookup(self, key: str, signature: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._by_key.get(key)
+            if entry is not None:
+                metrics.incr("cassette.exact_hits")
+                return entry
+            metrics.incr("cassette.misses")
+            if self.fallback == "synthetic":
+                metrics.incr("cassette.synthetic")
+                return None
+            if self.fallback != "1":
+                raise CassetteMiss(f"磁带 {self.path} 里没有这次 {signature} 调用的录音（请求指纹 {key[:12]}），"
+                                   f"提示词或消息和录制时不一致；确认改动无误后用 LLM_MODE=record 重新录制")
+            candidates = self._by_signature.get(signature)
+            if not candidates:
+                raise CassetteMiss(f"磁带 {self.path} 里没有 {signature} 这类调用的录音，请先用 LLM_MODE=record 录制")
+            cursor = self._cursor.get(signature, 0)
+            self._cursor[signature] = cursor + 1
+        print(f"警告：磁带里没有请求 {key[:12]} 的录音，改用一条 {signature} 的录音代替")
+        metrics.incr("cassette.fallback_hits")
+        return candidates[cursor % len(candidates)]
+
+    def record(self, key: str, signature: str, message: BaseMessage, latency: float):
+        entry = {"key": key, "signature": signature, "latency": round(latency, 3),
+                 "message": message_to_dict(message)}
+        with self._lock:
+            self._index(entry)
+            self._save()
+
+    def _save(self):
+        """写临时文件再改名，录制途中被打断也不会留下写了一半的磁带"""
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "entries": self._entries}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class CassetteChatModel(BaseChatModel):
+    """
+    get_llm 在 LLM_MODE=record/replay 时返回的模型：record 模式把请求转给真实模型并录音，
+    replay 模式从磁带回放（磁带里没有时按 LLM_REPLAY_FALLBACK 处理），按设定的延迟等待后返回，
+    不需要网络和 API Key。
+    实现了 bind_tools，with_structured_output 走 BaseChatModel 默认的 function calling 方式。
+    """
+
+    model_name: str
+    mode: str = "replay"
+    cassette: Any = None
+    inner: Optional[BaseChatModel] = None
+    latency: Optional[float] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    def bind_tools(self, tools: Sequence, *, tool_choice: Any = None, **kwargs):
+        formatted_tools = [convert_to_openai_tool(tool) for tool in tools]
+        # 和 ChatOpenAI.bind_tools 一样规范 tool_choice，录制时原样交给真实模型
+        if tool_choice == "any":
+            tool_choice = "required"
+        elif isinstance(tool_choice, str) and tool_choice not in ("auto", "none", "required"):
+            tool_choice = {"type": "function", "function": {"name": tool_choice}}
+        if tool_choice:
+            kwargs["tool_choice"] = tool_choice
+        return super().bind(tools=formatted_tools, **kwargs)
+
+    def _prepare(self, messages: List[BaseMessage], kwargs: Dict):
+        tool_choice = kwargs.get("tool_choice")
+        if isinstance(tool_choice, dict):
+            tool_choice = tool_choice["function"]["name"]
+        signature = _call_signature(self.model_name, kwargs.get("tools") or [], tool_choice)
+        return _request_key(signature, messages), signature
+
+    def _replayed(self, entry: Dict) -> ChatResult:
+        message = messages_from_dict([entry["message"]])[0]
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _recorded(self, key: str, signature: str, message: AIMessage, seconds: float) -> ChatResult:
+        self.cassette.record(key, signature, message, seconds)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _replay(self, key: str, signature: str, messages: List[BaseMessage], kwargs: Dict) -> Tuple[ChatResult, float]:
+        """返回 (回放的结果, 需要等待的秒数)；没有设定延迟时按录制时实测的耗时等待，模拟响应不等待"""
+        entry = self.cassette.lookup(key, signature)
+        if entry is None:
+            message = synthetic_message(key, messages, kwargs.get("tools") or [], kwargs.get("tool_choice"))
+            return ChatResult(generations=[ChatGeneration(message=message)]), self.latency or 0.0
+        delay = self.latency if self.latency is not None else entry.get("latency", 0.0)
+        return self._replayed(entry), delay
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key, signature = self._prepare(messages, kwargs)
+        if self.mode == "record":
+            # 走真实模型公开的 invoke，tools / tool_choice 等绑定参数原样透传。
+            # 不把外层的回调传下去：返回的消息带着 usage_metadata，外层回调会统计一次，传下去就重复统计了
+            start = time.perf_counter()
+            message = self.inner.invoke(messages, stop=stop, **kwargs)
+            return self._recorded(key, signature, message, time.perf_counter() - start)
+        result, delay = self._replay(key, signature, messages, kwargs)
+        time.sleep(delay)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key, signature = self._prepare(messages, kwargs)
+        if self.mode == "record":
+            start = time.perf_counter()
+            message = await self.inner.ainvoke(messages, stop=stop, **kwargs)
+            return await asyncio.to_thread(self._recorded, key, signature, message, time.perf_counter() - start)
+        result, delay = self._replay(key, signature, messages, kwargs)
+        await asyncio.sleep(delay)
+        return result
+
+
+_default_cassette: Optional[Cassette] = None
+_default_cassette_lock = threading.Lock()
+
+
+def get_cassette() -> Cassette:
+    global _default_cassette
+    with _default_cassette_lock:
+        if _default_cassette is None:
+            _default_cassette = Cassette()
+        return _default_cassette
+
+
+def wrap_llm(model_name: str, inner: Optional[BaseChatModel]) -> BaseChatModel:
+    """按 LLM_MODE 决定是否在真实模型外面套一层录音/回放"""
+    if LLM_MODE == "live":
+        return inner
+    if LLM_MODE not in ("record", "replay"):
+        raise ValueError(f"无效的 LLM_MODE: {LLM_MODE}，可选 live / record / replay")
+    latency = float(LLM_REPLAY_LATENCY) if LLM_REPLAY_LATENCY else None
+    return CassetteChatModel(model_name=model_name, mode=LLM_MODE, cassette=get_cassette(), inner=inner,
+                             latency=latency)
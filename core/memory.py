@@ -1,66 +1,391 @@
 from dotenv import load_dotenv
+import asyncio
+import atexit
 import json
 import os
+import tempfile
+import threading
+import time
+import weakref
+from typing import Dict, NamedTuple, Optional, Tuple
 from langgraph.store.base import BaseStore
 from langchain_core.messages import SystemMessage
-from core.models import get_llm
+from core.models import get_structured_llm, model_for, usage_config
+from core.rendered_prompts import get_rendered_prompts
 from core.scheme import Userpreference
 from agents.memory_prompt import memory_instructions
-from agents.agent_prompt import default_triage_instructions, default_response_preferences, default_cal_preferences
+from agents.agent_prompt import default_triage_instructions, default_response_preferences, default_cal_preferences, \
+    default_background
+from utils.metrics import metrics
+from utils.sqlite_store import SQLiteStore
+from utils.triage_cache import get_triage_cache, preferences_version
 
 load_dotenv()
-llm = get_llm()
 
 CURRENT_FILE_PATH = os.path.abspath(__file__)
 CURRENT_DIR = os.path.dirname(CURRENT_FILE_PATH)
-MEMORY_FILE = os.path.normpath(os.path.join(CURRENT_DIR, "..", "long_term_memory.json"))
+MEMORY_FILE = os.getenv("MEMORY_PATH") or os.path.normpath(os.path.join(CURRENT_DIR, "..", "long_term_memory.json"))
+# 两次快照之间的每次改动按行追加到这个变更日志里
+MEMORY_LOG_FILE = os.getenv("MEMORY_LOG_PATH") or os.path.splitext(MEMORY_FILE)[0] + ".log"
+# 最后一次改动之后静默这么久才落盘，连续的几条反馈合并成一次写入
+MEMORY_FLUSH_DEBOUNCE_SECONDS = float(os.getenv("MEMORY_FLUSH_DEBOUNCE_SECONDS", "2"))
+# 改动一直不停时最多攒这么久也要落盘一次
+MEMORY_FLUSH_MAX_DELAY_SECONDS = float(os.getenv("MEMORY_FLUSH_MAX_DELAY_SECONDS", "10"))
+# 变更日志攒够这么多条就合并进快照
+MEMORY_COMPACT_EVERY = int(os.getenv("MEMORY_COMPACT_EVERY", "50"))
+# 整理偏好时不加锁，提交时比对版本号；被并发的整理抢先提交就基于新版本重新整理，最多尝试这么多次
+MEMORY_CAS_MAX_ATTEMPTS = max(1, int(os.getenv("MEMORY_CAS_MAX_ATTEMPTS", "5")))
+
+MEMORY_NAMESPACES = [
+    ("email_assistant", "triage_preferences"),
+    ("email_assistant", "response_preferences"),
+    ("email_assistant", "cal_preferences")
+]
+
+
+def _atomic_write_json(path: str, data) -> None:
+    """写到同目录的临时文件并 fsync，再 rename 覆盖，读者要么看到旧文件要么看到完整的新文件"""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".memory-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class MemoryPersistence:
+    """
+    长期记忆的落盘层：更新记忆时只把 namespace 记进脏集合，由后台线程防抖后统一写盘，
+    不再在人工审核的链路上同步重写整个 JSON 文件。
+    落盘分两部分：快照文件（namespace -> {"preferences", "version"}）和追加写的变更日志，
+    每次刷盘只往日志末尾追加改动的那几个 namespace，日志攒多了再原子地合并成新快照。
+    启动时先读快照再按顺序重放日志，日志最后一行写了一半（进程崩溃）时直接跳过。
+    版本号跟着偏好一起落盘，重启后不会退回第 0 版；以前只存了偏好文本的快照按第 0 版读入。
+    """
+
+    def __init__(self, snapshot_path: str = MEMORY_FILE, log_path: str = MEMORY_LOG_FILE,
+                 debounce_seconds: float = MEMORY_FLUSH_DEBOUNCE_SECONDS,
+                 max_delay_seconds: float = MEMORY_FLUSH_MAX_DELAY_SECONDS,
+                 compact_every: int = MEMORY_COMPACT_EVERY):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.compact_every = compact_every
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # 刷盘和合并快照互斥，后台线程和手动 flush() 不会同时写文件
+        self._io_lock = threading.Lock()
+        self._dirty: Dict[str, dict] = {}
+        self._first_dirty_at: Optional[float] = None
+        self._last_dirty_at: Optional[float] = None
+        # 已经落盘的完整状态，合并快照时直接用它，不用再去读 store。
+        # 构造时就从盘上读出来：没调用过 load() 时第一次合并也不会用启动后改过的那几个 namespace 盖掉整个快照
+        self._state, self._log_entries = self._read_disk()
+        self._worker: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def mark_dirty(self, namespace: tuple, preferences: str, version: int = 0):
+        """记录一次改动，立即返回；同一个 namespace 在落盘前被改多次只写最后一次"""
+        with self._wakeup:
+            self._dirty["|".join(namespace)] = {"preferences": preferences, "version": version}
+            now = time.monotonic()
+            if self._first_dirty_at is None:
+                self._first_dirty_at = now
+            self._last_dirty_at = now
+            if self._worker is None or not self._worker.is_alive():
+                self._stopped = False
+                self._worker = threading.Thread(target=self._run, name="memory-flush", daemon=True)
+                self._worker.start()
+            self._wakeup.notify()
+        metrics.incr("memory.dirty_marks")
+
+    def _seconds_until_due(self) -> Optional[float]:
+        if not self._dirty:
+            return None
+        due = min(self._last_dirty_at + self.debounce_seconds, self._first_dirty_at + self.max_delay_seconds)
+        return due - time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not self._stopped:
+                    wait = self._seconds_until_due()
+                    if wait is not None and wait <= 0:
+                        break
+                    self._wakeup.wait(wait)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                # 没写进去的改动已经放回脏集合，下一轮再试
+                print(f"长期记忆落盘失败: {e}")
+                time.sleep(self.debounce_seconds)
+
+    def flush(self) -> int:
+        """把脏集合追加到变更日志（fsync 后才算落盘），返回写入的条数"""
+        with self._io_lock:
+            with self._lock:
+                pending, self._dirty = self._dirty, {}
+                self._first_dirty_at = self._last_dirty_at = None
+            if not pending:
+                return 0
+            try:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    for key, value in pending.items():
+                        f.write(json.dumps({"key": key, **value, "ts": time.time()}, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception:
+                with self._wakeup:
+                    for key, value in pending.items():
+                        # 等待期间又有新改动的 namespace 以新的为准
+                        self._dirty.setdefault(key, value)
+                    now = time.monotonic()
+                    self._first_dirty_at = self._first_dirty_at or now
+                    self._last_dirty_at = self._last_dirty_at or now
+                raise
+            self._state.update(pending)
+            self._log_entries += len(pending)
+            metrics.incr("memory.flushes")
+            metrics.incr("memory.flushed_entries", len(pending))
+            if self._log_entries >= self.compact_every:
+                self._compact()
+            return len(pending)
+
+    def compact(self):
+        with self._io_lock:
+            self._compact()
+
+    def _compact(self):
+        """当前状态原子地写成新快照，再清空日志；两步之间崩溃也没关系，重放日志是幂等的"""
+        _atomic_write_json(self.snapshot_path, self._state)
+        with open(self.log_path, "w", encoding="utf-8"):
+            pass
+        self._log_entries = 0
+        metrics.incr("memory.compactions")
+
+    def _read_disk(self) -> Tuple[Dict[str, dict], int]:
+        """读快照 + 按顺序重放变更日志，返回 (完整状态, 重放的日志条数)"""
+        state: Dict[str, dict] = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                for key, value in json.load(f).items():
+                    state[key] = value if isinstance(value, dict) else {"preferences": value, "version": 0}
+        replayed = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+            for line in data.splitlines():
+                try:
+                    entry = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    # 只可能是崩溃时写了一半的最后一行
+                    continue
+                state[entry["key"]] = {"preferences": entry["preferences"], "version": entry.get("version", 0)}
+                replayed += 1
+            if data and not data.endswith(b"\n"):
+                # 截掉写了一半的尾巴，否则下一次追加会接在它后面，连新写的那条也读不出来
+                os.truncate(self.log_path, data.rfind(b"\n") + 1)
+        return state, replayed
+
+    def load(self, store: BaseStore) -> int:
+        """读快照 + 重放变更日志，把结果放进 store，返回恢复的 namespace 数"""
+        with self._io_lock:
+            state, replayed = self._read_disk()
+            for key, value in state.items():
+                # 把字符串 Key 还原回原来的 namespace 元组
+                store.put(tuple(key.split("|")), "preferences", value)
+            self._state = state
+            self._log_entries = replayed
+            if replayed:
+                self._compact()
+        return len(state)
+
+    def stop(self, timeout: float = 5.0):
+        """停掉后台线程并把剩下的改动写完，进程退出时自动调用"""
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+            worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+        self.flush()
+
+
+_default_persistence: Optional[MemoryPersistence] = None
+_default_persistence_lock = threading.Lock()
+
+
+def get_memory_persistence() -> MemoryPersistence:
+    global _default_persistence
+    with _default_persistence_lock:
+        if _default_persistence is None:
+            _default_persistence = MemoryPersistence()
+            atexit.register(_default_persistence.stop)
+        return _default_persistence
 
 
 def save_to_disk(store: BaseStore):
-    """把内存里的所有抽屉同步到 JSON 文件里"""
-    data = {}
-    namespaces = [
-        ("email_assistant", "triage_preferences"),
-        ("email_assistant", "response_preferences"),
-        ("email_assistant", "cal_preferences")
-    ]
-    for ns in namespaces:
+    """把内存里的所有抽屉立即同步成快照文件（平时由 update_memory 异步落盘，不需要调用）"""
+    persistence = get_memory_persistence()
+    for ns in MEMORY_NAMESPACES:
         item = store.get(ns, "preferences")
         if item:
-            data["|".join(ns)] = item.value["preferences"]
-
-    with open(MEMORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-    print(f"数据已写入硬盘文件: {MEMORY_FILE}")
+            persistence.mark_dirty(ns, item.value["preferences"], item.value.get("version", 0))
+    persistence.flush()
+    persistence.compact()
+    print(f"数据已写入硬盘文件: {persistence.snapshot_path}")
 
 
 def load_from_disk(store: BaseStore):
-    """程序启动时，把 JSON 文件里的内容塞回内存档案柜"""
-    if not os.path.exists(MEMORY_FILE):
-        return
+    """程序启动时，把快照和变更日志里的内容塞回内存档案柜"""
+    restored = get_memory_persistence().load(store)
+    # 直接写了 store，之前记下的快照作废；按版本号缓存的系统提示词也一起清掉，
+    # 万一盘上的内容和 store 里同一版本号的不一样，也不会继续用旧偏好拼出来的提示词
+    with _snapshots_lock:
+        _snapshots.pop(store, None)
+    get_rendered_prompts().clear()
+    if restored:
+        print(f"已从硬盘恢复历史档案。")
+
+
+class PreferenceSnapshot(NamedTuple):
+    """某个 namespace 某一版已提交的偏好；version 每整理一次加一，单调递增"""
+    version: int
+    preferences: str
+
+
+# store -> {namespace: 最近一次读到/写入的快照}。偏好只经由本模块的函数写入，这里总是最新的已提交版本，
+# 热路径上取偏好只是一次字典查找，不再访问 store
+_snapshots: "weakref.WeakKeyDictionary[BaseStore, Dict[tuple, PreferenceSnapshot]]" = weakref.WeakKeyDictionary()
+_snapshots_lock = threading.Lock()
+
+
+def _cached_snapshot(store: BaseStore, namespace: tuple) -> Optional[PreferenceSnapshot]:
+    with _snapshots_lock:
+        snapshot = _snapshots.get(store, {}).get(namespace)
+    metrics.incr("memory.snapshot_hit" if snapshot else "memory.snapshot_miss")
+    return snapshot
+
+
+def _remember(store: BaseStore, namespace: tuple, snapshot: PreferenceSnapshot) -> PreferenceSnapshot:
+    with _snapshots_lock:
+        known = _snapshots.setdefault(store, {})
+        # 并发提交时记录的先后不一定和版本先后一致，只往前走，不让旧版本盖掉新版本
+        if namespace not in known or known[namespace].version <= snapshot.version:
+            known[namespace] = snapshot
+        return known[namespace]
+
+
+def _snapshot_of(memory_item, default_content: str) -> PreferenceSnapshot:
+    # 加版本号之前写入的条目没有 version，按第 0 版处理
+    return PreferenceSnapshot(memory_item.value.get("version", 0),
+                              memory_item.value.get("preferences", default_content))
 
-    with open(MEMORY_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-        for key, value in data.items():
-            # 把字符串 Key 还原回原来的 namespace 元组
-            ns = tuple(key.split("|"))
-            store.put(ns, "preferences", {"preferences": value})
-    print(f"已从硬盘恢复历史档案。")
+
+def _value_of(snapshot: PreferenceSnapshot) -> dict:
+    return {"preferences": snapshot.preferences, "version": snapshot.version}
+
+
+class MemoryConflictError(RuntimeError):
+    """连续多次提交都被并发的整理抢先，这次更新没有写入（记忆队列会稍后重试）"""
+
+
+# 不支持原子比对写入的 store（如 InMemoryStore）按 namespace 分段加锁，只锁读-比对-写这一小段
+_cas_stripes = [threading.Lock() for _ in range(64)]
+
+
+def compare_and_swap(store: BaseStore, namespace: tuple, expected_version: Optional[int],
+                     snapshot: PreferenceSnapshot) -> Tuple[bool, Optional[PreferenceSnapshot]]:
+    """
+    store 里的版本号还是 expected_version 时才写入 snapshot（None 表示抽屉还不存在）。
+    返回 (是否写入, 当前已提交的版本)。模型调用都在这之外，不同 namespace、不同 worker 之间不会互相等待。
+    """
+    # SQLiteStore 之类自带原子比对写入的 store 直接用它，多个进程共用一个库也安全
+    if hasattr(store, "compare_and_put"):
+        swapped, item = store.compare_and_put(namespace, "preferences", _value_of(snapshot), expected_version)
+        current = _snapshot_of(item, snapshot.preferences) if item else None
+    else:
+        with _cas_stripes[hash((id(store), namespace)) % len(_cas_stripes)]:
+            item = store.get(namespace, "preferences")
+            swapped = (item.value.get("version", 0) if item else None) == expected_version
+            if swapped:
+                store.put(namespace, "preferences", _value_of(snapshot))
+        current = snapshot if swapped else (_snapshot_of(item, snapshot.preferences) if item else None)
+    return swapped, current and _remember(store, namespace, current)
+
+
+def get_memory_snapshot(store: BaseStore, namespace: tuple, default_content: str) -> PreferenceSnapshot:
+    """取指定抽屉（namespace）的当前版本，没有就用默认值建一个第 0 版"""
+    snapshot = _cached_snapshot(store, namespace)
+    if snapshot:
+        return snapshot
+    memory_item = store.get(namespace, "preferences")
+    if memory_item:
+        return _remember(store, namespace, _snapshot_of(memory_item, default_content))
+    # 如果是新抽屉，先把默认的规矩塞进去打底，防止下次来还是空的；
+    # 只在抽屉仍不存在时插入，不会盖掉刚被别的 worker 整理好的版本
+    snapshot = PreferenceSnapshot(0, default_content)
+    return compare_and_swap(store, namespace, None, snapshot)[1] or snapshot
 
 
 def get_memory(store: BaseStore, namespace: tuple, default_content: str) -> str:
     """
     辅助函数：去指定的抽屉（namespace）拿档案，没有就用默认值
     """
+    return get_memory_snapshot(store, namespace, default_content).preferences
 
-    memory_item = store.get(namespace, "preferences")
 
-    if memory_item:
-        return memory_item.value.get("preferences", default_content)
-    else:
-        # 如果是新抽屉，先把默认的规矩塞进去打底，防止下次来还是空的
-        store.put(namespace, "preferences", {"preferences": default_content})
-        return default_content
+def user_namespace(user_id: Optional[str], kind: str) -> tuple:
+    """每个飞书用户（EmailDetail 里的 user_id）一套偏好；没有 user_id 时（本地调试）用全局档案"""
+    return ("email_assistant", user_id, kind) if user_id else ("email_assistant", kind)
+
+
+def get_user_snapshot(store: BaseStore, user_id: Optional[str], kind: str,
+                      default_content: str) -> PreferenceSnapshot:
+    """取某个用户的偏好快照；新用户先继承全局档案（分用户之前学到的偏好），全局也没有才用默认值"""
+    namespace = user_namespace(user_id, kind)
+    snapshot = _cached_snapshot(store, namespace)
+    if snapshot:
+        return snapshot
+    if user_id and store.get(namespace, "preferences") is None:
+        inherited = store.get(user_namespace(None, kind), "preferences")
+        if inherited:
+            default_content = inherited.value.get("preferences", default_content)
+    return get_memory_snapshot(store, namespace, default_content)
+
+
+def get_user_memory(store: BaseStore, user_id: Optional[str], kind: str, default_content: str) -> str:
+    return get_user_snapshot(store, user_id, kind, default_content).preferences
+
+
+def _after_update(store: BaseStore, namespace: tuple, old_prefs: str, updated: PreferenceSnapshot):
+    new_prefs = updated.preferences
+    if namespace[-1] == "triage_preferences" and old_prefs != new_prefs:
+        # 分拣偏好变了，这个用户按旧偏好缓存的分拣结果作废（其他用户的不受影响）；全局档案的 namespace 里没有 user_id
+        user_id = namespace[1] if len(namespace) == 3 else None
+        get_triage_cache().drop_version(preferences_version(user_id, old_prefs, default_background))
+    if not isinstance(store, SQLiteStore):
+        # SQLiteStore 本身就是持久化的，内存里的 store 才需要另外落盘
+        get_memory_persistence().mark_dirty(namespace, new_prefs, updated.version)
+
+
+def _on_conflict(namespace: tuple, current: PreferenceSnapshot, committed: Optional[PreferenceSnapshot],
+                 attempt: int) -> PreferenceSnapshot:
+    metrics.incr("memory.cas_conflict")
+    if attempt >= MEMORY_CAS_MAX_ATTEMPTS:
+        raise MemoryConflictError(f"档案 {namespace[-1]} 连续 {attempt} 次被并发更新抢先，本次未写入")
+    print(f"档案 {namespace[-1]} 整理期间已被更新到第 {committed.version if committed else '?'} 版，重新合并 ...")
+    return committed or current
 
 
 def update_memory(store: BaseStore, namespace: tuple, messages: list):
@@ -68,24 +393,62 @@ def update_memory(store: BaseStore, namespace: tuple, messages: list):
     辅助函数：分析指定的对话，即时更新专属抽屉（namespace）的记忆
 
     """
-    print(f"正在更新专属档案库: {namespace[1]} ...")
+    print(f"正在更新专属档案库: {namespace[-1]} ...")
 
     # 1. 拿出旧档案
-    current_prefs = get_memory(store, namespace, "")
+    current = get_memory_snapshot(store, namespace, "")
+    structured_llm = get_structured_llm(Userpreference, model_for("memory"))
+    for attempt in range(1, MEMORY_CAS_MAX_ATTEMPTS + 1):
+        # 2. “三明治强化提示词”
+        memory = memory_instructions.format(current_prefs=current.preferences)
+        # 3. 调用模型做总结
+        result = structured_llm.invoke([SystemMessage(content=memory)] + messages, config=usage_config("memory"))
+
+        # 4. 抽屉还是整理前那一版时才放回去，版本号加一；否则在别人刚提交的版本上重新整理
+        updated = PreferenceSnapshot(current.version + 1, result.preferences)
+        swapped, committed = compare_and_swap(store, namespace, current.version, updated)
+        if swapped:
+            break
+        current = _on_conflict(namespace, current, committed, attempt)
+    _after_update(store, namespace, current.preferences, updated)
+
+    print(f"档案 {namespace[-1]} 已更新到第 {updated.version} 版！\n思考过程：{result.reasoning}")
+
+
+async def aget_memory_snapshot(store: BaseStore, namespace: tuple, default_content: str) -> PreferenceSnapshot:
+    """get_memory_snapshot 的异步版本"""
+    snapshot = _cached_snapshot(store, namespace)
+    if snapshot:
+        return snapshot
+    memory_item = await store.aget(namespace, "preferences")
+    if memory_item:
+        return _remember(store, namespace, _snapshot_of(memory_item, default_content))
+    snapshot = PreferenceSnapshot(0, default_content)
+    return (await asyncio.to_thread(compare_and_swap, store, namespace, None, snapshot))[1] or snapshot
+
+
+async def aget_memory(store: BaseStore, namespace: tuple, default_content: str) -> str:
+    """get_memory 的异步版本"""
+    return (await aget_memory_snapshot(store, namespace, default_content)).preferences
+
 
-    # 2. “三明治强化提示词”
-    memory = memory_instructions.format(current_prefs=current_prefs)
-    # 3. 调用模型做总结
-    llm = get_llm()
-    structured_llm = llm.with_structured_output(Userpreference)
-    result = structured_llm.invoke([SystemMessage(content=memory)] + messages)
+async def aget_user_snapshot(store: BaseStore, user_id: Optional[str], kind: str,
+                             default_content: str) -> PreferenceSnapshot:
+    """get_user_snapshot 的异步版本"""
+    namespace = user_namespace(user_id, kind)
+    snapshot = _cached_snapshot(store, namespace)
+    if snapshot:
+        return snapshot
+    if user_id and await store.aget(namespace, "preferences") is None:
+        inherited = await store.aget(user_namespace(None, kind), "preferences")
+        if inherited:
+            default_content = inherited.value.get("preferences", default_content)
+    return await aget_memory_snapshot(store, namespace, default_content)
 
-    # 4. 把新档案放回抽屉
-    new_prefs = result.preferences
-    store.put(namespace, "preferences", {"preferences": new_prefs})
 
-    print(f"档案 {namespace[1]} 已更新！\n思考过程：{result.reasoning}")
-    save_to_disk(store)
+async def aget_user_memory(store: BaseStore, user_id: Optional[str], kind: str, default_content: str) -> str:
+    """get_user_memory 的异步版本"""
+    return (await aget_user_snapshot(store, user_id, kind, default_content)).preferences
 
 
 if __name__ == '__main__':
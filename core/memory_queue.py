@@ -0,0 +1,159 @@
+import atexit
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from langgraph.store.base import BaseStore
+
+from core.memory import update_memory, get_memory_persistence
+from utils.metrics import metrics
+
+load_dotenv()
+
+# 第一条反馈进队后再等这么久才整理，期间同一个 namespace 的反馈合并成一次 LLM 调用
+MEMORY_QUEUE_COALESCE_SECONDS = float(os.getenv("MEMORY_QUEUE_COALESCE_SECONDS", "1"))
+# 整理失败后最多重试几次，超过就丢弃这批反馈
+MEMORY_QUEUE_MAX_ATTEMPTS = int(os.getenv("MEMORY_QUEUE_MAX_ATTEMPTS", "3"))
+# 同时整理偏好的后台线程数；同一个 namespace 同一时刻只交给一个线程，不同 namespace 互不等待
+MEMORY_QUEUE_WORKERS = int(os.getenv("MEMORY_QUEUE_WORKERS", "4"))
+
+
+class _Pending:
+    def __init__(self, store: BaseStore, namespace: tuple):
+        self.store = store
+        self.namespace = namespace
+        self.feedback: List[list] = []
+        self.first_at = time.monotonic()
+        self.attempts = 0
+
+
+class MemoryUpdateQueue:
+    """
+    把整理偏好的 LLM 调用移出人工审核链路：节点里只把反馈放进队列就继续往下走，
+    后台线程按 namespace 攒一小段时间，把积压的几条反馈合并成一次 update_memory。
+    整理完成前读到的仍是上一版偏好，store 里只会出现完整整理过的版本。
+    几个线程并行整理不同的 namespace；正在整理的 namespace 新来的反馈先攒着，等这一轮提交后再合并，
+    万一和别的进程撞上，由 update_memory 的版本比对重新合并。
+    """
+
+    def __init__(self, coalesce_seconds: float = MEMORY_QUEUE_COALESCE_SECONDS,
+                 max_attempts: int = MEMORY_QUEUE_MAX_ATTEMPTS, workers: int = MEMORY_QUEUE_WORKERS):
+        self.coalesce_seconds = coalesce_seconds
+        self.max_attempts = max_attempts
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending: Dict[Tuple[int, tuple], _Pending] = {}
+        self._active: Set[Tuple[int, tuple]] = set()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, store: BaseStore, namespace: tuple, messages: list):
+        """放入一条反馈（一组消息），立即返回"""
+        with self._wakeup:
+            key = (id(store), namespace)
+            if key not in self._pending:
+                self._pending[key] = _Pending(store, namespace)
+            self._pending[key].feedback.append(messages)
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if len(self._threads) < min(self.workers, len(self._pending) + len(self._active)):
+                worker = threading.Thread(target=self._run, name=f"memory-queue-{len(self._threads)}", daemon=True)
+                worker.start()
+                self._threads.append(worker)
+            self._wakeup.notify_all()
+        metrics.incr("memory_queue.submitted")
+
+    def _take_due(self) -> Optional[_Pending]:
+        now = time.monotonic()
+        for key, pending in self._pending.items():
+            if key not in self._active and now - pending.first_at >= self.coalesce_seconds:
+                del self._pending[key]
+                self._active.add(key)
+                return pending
+        return None
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                batch = self._take_due()
+                while batch is None:
+                    waiting = [p.first_at for key, p in self._pending.items() if key not in self._active]
+                    if waiting:
+                        self._wakeup.wait(max(0.0, min(waiting) + self.coalesce_seconds - time.monotonic()))
+                    else:
+                        self._wakeup.wait()
+                    batch = self._take_due()
+            try:
+                self._consolidate(batch)
+            finally:
+                with self._wakeup:
+                    self._active.discard((id(batch.store), batch.namespace))
+                    self._wakeup.notify_all()
+
+    def _consolidate(self, batch: _Pending):
+        messages = [message for feedback in batch.feedback for message in feedback]
+        if len(batch.feedback) > 1:
+            messages.insert(0, {
+                "role": "user",
+                "content": f"以下是用户先后给出的 {len(batch.feedback)} 条反馈，请按时间顺序一并整理进偏好档案，后面的反馈与前面冲突时以后面的为准。"
+            })
+        try:
+            with metrics.timer("memory_queue.latency"):
+                update_memory(batch.store, batch.namespace, messages)
+        except Exception as e:
+            batch.attempts += 1
+            if batch.attempts >= self.max_attempts:
+                print(f"整理 {batch.namespace[-1]} 偏好失败 {batch.attempts} 次，放弃这 {len(batch.feedback)} 条反馈: {e}")
+                metrics.incr("memory_queue.dropped", len(batch.feedback))
+                return
+            print(f"整理 {batch.namespace[-1]} 偏好失败，稍后重试: {e}")
+            with self._wakeup:
+                # 放回队首，和失败期间新来的反馈合并，保持先后顺序
+                key = (id(batch.store), batch.namespace)
+                newer = self._pending.get(key)
+                if newer is not None:
+                    batch.feedback.extend(newer.feedback)
+                batch.first_at = time.monotonic()
+                self._pending[key] = batch
+            return
+        metrics.incr("memory_queue.calls")
+        metrics.incr("memory_queue.merged", len(batch.feedback))
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """等队列清空（测试和退出前用），超时返回 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._wakeup:
+            while self._pending or self._active:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._wakeup.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            pending = sum(len(p.feedback) for p in self._pending.values())
+        return {
+            "pending": pending,
+            "submitted": metrics.get("memory_queue.submitted"),
+            "llm_calls": metrics.get("memory_queue.calls"),
+            "merged_feedback": metrics.get("memory_queue.merged"),
+            "dropped": metrics.get("memory_queue.dropped"),
+            "cas_conflicts": metrics.get("memory.cas_conflict"),
+        }
+
+
+_default_queue: Optional[MemoryUpdateQueue] = None
+_default_queue_lock = threading.Lock()
+
+
+def get_memory_queue() -> MemoryUpdateQueue:
+    global _default_queue
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = MemoryUpdateQueue()
+            # 退出前先把还没整理的反馈处理完；atexit 后注册先执行，所以先创建落盘层，保证它最后刷盘
+            get_memory_persistence()
+            atexit.register(_default_queue.join, 30)
+        return _default_queue
@@ -1,25 +1,213 @@
 import os
+import threading
+from typing import Dict, Sequence, Tuple
 
+import httpx
 from dotenv import load_dotenv
 
 load_dotenv()
 from langchain.chat_models import init_chat_model
+from langchain_core.callbacks import BaseCallbackHandler
 
+from core.llm_cassette import LLM_MODE, CassetteMiss, wrap_llm
+from utils.metrics import metrics
 
-def get_llm(model_name="gpt-4o"):
+# 进程内所有模型实例共用一个长连接池，避免每次更新记忆都重新建 TLS 连接
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+# 各个节点用哪个模型：分拣和整理记忆用小模型，起草回信和分拣升级用 gpt-4o，都可以用环境变量覆盖
+NODE_MODELS = {
+    "triage": os.getenv("TRIAGE_MODEL", "gpt-4o-mini"),
+    "triage_escalation": os.getenv("TRIAGE_ESCALATION_MODEL", "gpt-4o"),
+    "response": os.getenv("RESPONSE_MODEL", "gpt-4o"),
+    "memory": os.getenv("MEMORY_MODEL", "gpt-4o-mini"),
+}
+# 小模型给出的置信度低于这个值时，改用大模型重新分拣
+TRIAGE_ESCALATION_THRESHOLD = float(os.getenv("TRIAGE_ESCALATION_THRESHOLD", "0.7"))
+
+_http_client = None
+_http_async_client = None
+_registry: Dict[Tuple, object] = {}
+_registry_lock = threading.RLock()
+
+
+def _params_key(params: dict) -> Tuple:
+    return tuple(sorted((k, repr(v)) for k, v in params.items()))
+
+
+def get_http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """同步/异步各一个共享的 httpx 客户端，第一次用到时创建"""
+    global _http_client, _http_async_client
+    with _registry_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+            _http_async_client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        return _http_client, _http_async_client
+
+
+def get_llm(model_name="gpt-4o", **params):
+    """
+    根据传入的模型名称动态初始化 LLM，默认为gpt-4o。
+    同样的 (模型, 参数) 只创建一次，之后直接复用，可以在多个工作线程里同时调用。
+    LLM_MODE=record/replay 时外面套一层录音/回放（见 core/llm_cassette.py），replay 模式不会创建真实模型。
+    """
+    params = {"temperature": 0, **params}
+    key = ("llm", model_name, _params_key(params))
+    with _registry_lock:
+        if key not in _registry:
+            llm = None
+            if LLM_MODE != "replay":
+                http_client, http_async_client = get_http_clients()
+                llm = init_chat_model(
+                    model_name,
+                    model_provider="openai",
+                    base_url=os.getenv("OPENAI_API_BASE"),
+                    http_client=http_client,
+                    http_async_client=http_async_client,
+                    **params
+                )
+            _registry[key] = wrap_llm(model_name, llm)
+        return _registry[key]
+
+
+def get_structured_llm(schema, model_name="gpt-4o", include_raw: bool = False, **params):
+    """
+    缓存 llm.with_structured_output(schema)，按 (模型, 参数, schema) 区分。
+    include_raw=True 时返回 {"raw", "parsed", "parsing_error"}，解析失败也能拿到模型的原始输出。
+    """
+    key = ("structured", model_name, _params_key(params), schema, include_raw)
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = get_llm(model_name, **params).with_structured_output(schema, include_raw=include_raw)
+        return _registry[key]
+
+
+def get_tool_llm(tools: Sequence, model_name="gpt-4o", tool_choice=None, **params):
+    """缓存 llm.bind_tools(tools)，工具按名字区分"""
+    key = ("tools", model_name, _params_key(params), tuple(tool.name for tool in tools), tool_choice)
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = get_llm(model_name, **params).bind_tools(list(tools), tool_choice=tool_choice)
+        return _registry[key]
+
+
+class UsageRecorder(BaseCallbackHandler):
+    """从每次调用返回的 usage_metadata 里累计输入 token 和命中服务端前缀缓存的 token，按节点记到 metrics"""
+
+    def __init__(self, node: str):
+        self.node = node
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if not usage:
+                    continue
+                metrics.incr(f"{self.node}.llm_calls")
+                metrics.incr(f"{self.node}.prompt_tokens", usage.get("input_tokens", 0))
+                metrics.incr(f"{self.node}.cached_tokens", (usage.get("input_token_details") or {}).get("cache_read", 0))
+
+
+_usage_recorders: Dict[str, UsageRecorder] = {}
+
+
+def usage_config(node: str) -> dict:
+    """invoke(..., config=usage_config("triage")) 即可把这次调用的 token 用量记到对应节点下"""
+    with _registry_lock:
+        if node not in _usage_recorders:
+            _usage_recorders[node] = UsageRecorder(node)
+        return {"callbacks": [_usage_recorders[node]]}
+
+
+def prompt_cache_report() -> Dict[str, Dict]:
+    """各节点的输入 token、缓存命中 token 和命中比例"""
+    with _registry_lock:
+        nodes = list(_usage_recorders)
+    report = {}
+    for node in nodes:
+        prompt_tokens = metrics.get(f"{node}.prompt_tokens")
+        cached_tokens = metrics.get(f"{node}.cached_tokens")
+        report[node] = {
+            "llm_calls": metrics.get(f"{node}.llm_calls"),
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "cached_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+        }
+    return report
+
+
+def model_for(node: str) -> str:
+    return NODE_MODELS.get(node, "gpt-4o")
+
+
+def _escalation_models(node: str) -> Tuple[str, str]:
+    """返回 (小模型, 大模型)，两者相同时不做级联，直接调用大模型"""
+    metrics.incr(f"{node}.calls")
+    return model_for(node), model_for(f"{node}_escalation")
+
+
+def _keep_small_result(node: str, outcome, threshold: float) -> bool:
     """
-    根据传入的模型名称动态初始化 LLM，默认为gpt-4o
+    同步/异步两个版本共用的升级判断：outcome 是小模型的结构化输出，调用出错时是异常对象。
+    置信度够就直接用；否则打印原因、记一次升级，交给大模型重做。
     """
-    return init_chat_model(
-        model_name,
-        model_provider="openai",
-        temperature=0,
-        base_url=os.getenv("OPENAI_API_BASE")
-    )
+    small_model, large_model = model_for(node), model_for(f"{node}_escalation")
+    if isinstance(outcome, Exception):
+        print(f"{small_model} 调用失败，升级到 {large_model}: {outcome}")
+    elif outcome.confidence >= threshold:
+        return True
+    else:
+        print(f"{small_model} 置信度 {outcome.confidence:.2f} 低于 {threshold}，升级到 {large_model}")
+    metrics.incr(f"{node}.escalations")
+    return False
+
+
+def invoke_with_escalation(schema, messages: list, node: str = "triage",
+                           threshold: float = TRIAGE_ESCALATION_THRESHOLD):
+    """
+    模型级联：先用 node 对应的小模型做结构化输出，结果的 confidence 低于阈值（或小模型调用出错）时
+    再用 f"{node}_escalation" 对应的大模型重做一次。每一级的耗时和升级次数都记到 metrics 里。
+    """
+    small_model, large_model = _escalation_models(node)
+    if small_model != large_model:
+        try:
+            with metrics.timer(f"{node}.latency.small"):
+                outcome = get_structured_llm(schema, small_model).invoke(messages, config=usage_config(node))
+        except CassetteMiss:
+            # 回放时磁带对不上说明提示词变了，换大模型重试只会再错一次，直接报出来
+            raise
+        except Exception as e:
+            outcome = e
+        if _keep_small_result(node, outcome, threshold):
+            return outcome
+    with metrics.timer(f"{node}.latency.large"):
+        return get_structured_llm(schema, large_model).invoke(messages, config=usage_config(f"{node}_escalation"))
+
+
+async def ainvoke_with_escalation(schema, messages: list, node: str = "triage",
+                                  threshold: float = TRIAGE_ESCALATION_THRESHOLD):
+    """invoke_with_escalation 的异步版本，给 async 图节点用，等待模型时不占线程"""
+    small_model, large_model = _escalation_models(node)
+    if small_model != large_model:
+        try:
+            with metrics.timer(f"{node}.latency.small"):
+                outcome = await get_structured_llm(schema, small_model).ainvoke(messages, config=usage_config(node))
+        except CassetteMiss:
+            # 回放时磁带对不上说明提示词变了，换大模型重试只会再错一次，直接报出来
+            raise
+        except Exception as e:
+            outcome = e
+        if _keep_small_result(node, outcome, threshold):
+            return outcome
+    with metrics.timer(f"{node}.latency.large"):
+        return await get_structured_llm(schema, large_model).ainvoke(messages,
+                                                                      config=usage_config(f"{node}_escalation"))
 
 
 if __name__ == "__main__":
     llm = get_llm("gpt-4o")
+    assert llm is get_llm("gpt-4o"), "同样的参数应该复用同一个实例"
     try:
         message = {"role": "user", "content": "请输出你的模型号"}
         response = llm.invoke([message])
@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from utils.metrics import metrics
+
+load_dotenv()
+
+# 缓存多少份渲染好的系统提示词；每个用户的分拣和起草各一份，偏好一更新旧的就用不到了
+RENDERED_PROMPT_CACHE_SIZE = int(os.getenv("RENDERED_PROMPT_CACHE_SIZE", "4096"))
+
+
+class RenderedPromptCache:
+    """
+    渲染好的系统提示词缓存，键是 (模板名, 用户, 偏好版本号...)。
+    偏好版本号只增不减，偏好一变键就变，旧条目不用主动作废，等 LRU 淘汰即可。
+    同一封邮件反复打回重写时，起草节点直接拿到上次拼好的提示词，不再做字符串格式化。
+    """
+
+    def __init__(self, max_entries: int = RENDERED_PROMPT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, str]" = OrderedDict()
+
+    def render(self, template: str, key: Tuple[Hashable, ...], render: Callable[[], str]) -> str:
+        cache_key = (template,) + tuple(key)
+        with self._lock:
+            prompt = self._entries.get(cache_key)
+            if prompt is not None:
+                self._entries.move_to_end(cache_key)
+        if prompt is not None:
+            metrics.incr(f"rendered_prompt.{template}.hit")
+            return prompt
+        metrics.incr(f"rendered_prompt.{template}.miss")
+        prompt = render()
+        with self._lock:
+            self._entries[cache_key] = prompt
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prompt
+
+    def clear(self):
+        """偏好被整体替换（如从硬盘恢复）时调用，版本号不再能代表内容"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            templates = sorted({cache_key[0] for cache_key in self._entries})
+            entries = len(self._entries)
+        report = {"entries": entries}
+        for template in templates:
+            hits = metrics.get(f"rendered_prompt.{template}.hit")
+            misses = metrics.get(f"rendered_prompt.{template}.miss")
+            report[template] = {"hits": hits, "misses": misses,
+                                "reuse_rate": hits / (hits + misses) if hits + misses else 0.0}
+        return report
+
+
+_default_cache: Optional[RenderedPromptCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_rendered_prompts() -> RenderedPromptCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = RenderedPromptCache()
+        return _default_cache
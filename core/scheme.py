@@ -1,4 +1,4 @@
-from typing import TypedDict, Literal
+from typing import TypedDict, Literal, List
 
 from langgraph.graph import MessagesState
 from pydantic import BaseModel, Field
@@ -16,6 +16,21 @@ class RouterScheme(BaseModel):
                 - notify: 包含重要信息但无需回复，仅需通知用户的邮件。
                 - ignore: 垃圾邮件、广告或无需任何处理的邮件。"""
     )
+    confidence: float = Field(ge=0, le=1, description="对该分类结果的把握程度，0 到 1 之间；拿不准时如实给出较低的值")
+
+
+class BatchRouterItem(RouterScheme):
+    """
+    批量分拣中单封邮件的结果
+    """
+    index: int = Field(description="邮件编号，与输入中 [编号] 一致")
+
+
+class BatchRouterScheme(BaseModel):
+    """
+    一次分拣多封邮件，每封邮件对应 results 中的一项。
+    """
+    results: List[BatchRouterItem] = Field(description="逐封邮件的分拣结果，每个编号恰好出现一次")
 
 
 class Userpreference(BaseModel):
@@ -34,8 +49,15 @@ class EmailDetail(TypedDict):
     to: str
     subject: NotRequired[str]
     email_thread: str
-    thread_id: str  # 邮件的专属 UUID
+    thread_id: str  # 这封来信的 checkpoint thread，由 Message-ID 推导，每封来信各自一个
+    conversation_id: NotRequired[str]  # 所属会话 ID，由 Message-ID / References 推导，同一会话的来信共享
     user_id: str  # 飞书 Open ID (收件人)
+    uid: NotRequired[int]  # 邮件在 163 收件箱中的 IMAP UID（增量同步时才有）
+    skipped_attachments: NotRequired[List[dict]]  # 分拣阶段没有下载的附件：文件名、类型、大小
+    message_id: NotRequired[str]  # 邮件头里的 Message-ID
+    date: NotRequired[str]  # 邮件头里的 Date 原文
+    headers: NotRequired[dict]  # 抓取到的邮件头字段（小写字段名 -> 解码后的值）
+    mirror_id: NotRequired[int]  # 本地邮件镜像库中的行 ID
 
 
 class State(MessagesState):
@@ -4,15 +4,15 @@ import requests
 from dotenv import load_dotenv
 from langgraph.types import Command
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.store.memory import InMemoryStore
 
 from core.gp import workflow
+from utils.sqlite_store import get_memory_store
 
 load_dotenv()
 APP_ID = os.getenv("FEISHU_APP_ID")
 APP_SECRET = os.getenv("FEISHU_APP_SECRET")
 
-mock_store = InMemoryStore()
+mock_store = get_memory_store()
 memory_saver = MemorySaver()
 # from core.memory import load_from_disk
 # load_from_disk(mock_store)
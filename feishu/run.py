@@ -1,25 +1,79 @@
+import asyncio
+import hmac
 import sys
 import os
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
 import uvicorn
 from langgraph.types import Command
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.store.memory import InMemoryStore
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from core.gp import workflow
+from core.gp import async_workflow
+from core.batch_triage import prefetch_triage
+from core.memory import load_from_disk
+from core.memory_queue import get_memory_queue
+from core.models import prompt_cache_report
+from core.rendered_prompts import get_rendered_prompts
 from feishu.feishu_tool import run_agent_process, send_feishu_card, build_interrupt_card, send_feishu_text
-from utils.email_163 import fetch_latest_163_email
+from utils.dedup import get_inbound_deduper, card_event_deduper
+from utils.email_163 import fetch_new_163_emails
+from utils.helpers import email_fingerprint
+from utils.mail_mirror import get_mail_mirror, mark_email_status
+from utils.metrics import metrics
+from utils.smtp_outbox import get_outbox
+from utils.sqlite_store import get_memory_store
+from utils.triage_cache import get_triage_cache
 
 app = FastAPI()
 
-agent_app = workflow.compile(store=InMemoryStore(), checkpointer=MemorySaver())
+# 图节点都是 async 的，所有流程共用 uvicorn 的事件循环，等待 LLM 时不占线程
+# 长期记忆存在 SQLite 里，按飞书用户分 namespace，重启后不丢
+agent_app = async_workflow.compile(store=get_memory_store(), checkpointer=MemorySaver())
+if not agent_app.store.list_namespaces(limit=1):
+    # 第一次启动时把以前的 JSON 档案导入为全局档案，新用户会继承它
+    load_from_disk(agent_app.store)
 
 
-def run_agent_worker(thread_id: str, input_data: dict = None, resume_command: Command = None, user_id: str = None):
+def _notify_send_failed(item: dict):
+    """发件箱里的邮件彻底发不出去时（退信或重试次数用完），通知审核通过这封邮件的用户；在发件箱线程里调用"""
+    if not item.get("thread_id"):
+        return
+    email_input = agent_app.get_state({"configurable": {"thread_id": item["thread_id"]}}).values.get("email_input")
+    user_id = (email_input or {}).get("user_id")
+    if not user_id:
+        print(f"邮件 #{item['id']} 发送失败，但找不到会话 {item['thread_id']} 对应的用户，无法通知")
+        return
+    send_feishu_text(user_id, f"发给 {item['to_addr']} 的邮件「{item['subject']}」发送失败，已不再重试: "
+                              f"{item['last_error']}\n请检查收件地址后重新发送。")
+
+
+get_outbox().on_failed = _notify_send_failed
+
+# 一次拉取到很多封邮件时，同时在跑的流程数上限（主要受 LLM 并发和速率限制约束）
+GRAPH_CONCURRENCY = int(os.getenv("GRAPH_CONCURRENCY", "32"))
+# /admin/* 接口的口令，请求头 X-Admin-Token 必须与之一致；不配置时这些接口一律关闭
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# 同一 thread 的 resume 串行执行，按 thread_id 散列到固定数量的锁上
+_resume_locks = [asyncio.Lock() for _ in range(64)]
+
+
+async def run_agent_worker(thread_id: str, input_data: dict = None, resume_command: Command = None,
+                           user_id: str = None):
     config = {"configurable": {"thread_id": thread_id}}
-    run_args = resume_command if resume_command else input_data
+    if resume_command:
+        async with _resume_locks[hash(thread_id) % len(_resume_locks)]:
+            # 重复的卡片回调排在前一次后面，前一次已经消费掉中断时直接返回，不再走一遍图
+            if not (await agent_app.aget_state(config)).interrupts:
+                print(f"会话 {thread_id} 没有待处理的中断，忽略重复的卡片回调")
+                return
+            await _run_agent(config, resume_command, user_id)
+        return
+    await _run_agent(config, input_data, user_id, input_data=input_data)
+
+
+async def _run_agent(config: dict, run_args, user_id: str = None, input_data: dict = None):
     # {
     #     "__interrupt__": (
     #         Interrupt(
@@ -33,16 +87,103 @@ def run_agent_worker(thread_id: str, input_data: dict = None, resume_command: Co
     #         ),
     #     )
     # }
-    for event_data in agent_app.stream(run_args, config=config):
-        if "__interrupt__" in event_data:
-            interrupt_val = event_data["__interrupt__"][0].value
-            actual_data = interrupt_val[0] if isinstance(interrupt_val, list) else interrupt_val
-            card_json = build_interrupt_card(actual_data)
-            target_user_id = actual_data.get("user_id") or user_id
-            send_feishu_card(receive_id=target_user_id, card_json=card_json)
-            return
+    try:
+        async for event_data in agent_app.astream(run_args, config=config):
+            if "__interrupt__" in event_data:
+                interrupt_val = event_data["__interrupt__"][0].value
+                actual_data = interrupt_val[0] if isinstance(interrupt_val, list) else interrupt_val
+                card_json = build_interrupt_card(actual_data)
+                target_user_id = actual_data.get("user_id") or user_id
+                await asyncio.to_thread(send_feishu_card, receive_id=target_user_id, card_json=card_json)
+                await _mark_thread_status(config, "awaiting_review")
+                return
+    except Exception:
+        # 处理失败时释放去重指纹，用户再次触发时这封邮件还能重新处理
+        if input_data:
+            await asyncio.to_thread(get_inbound_deduper().release, email_fingerprint(input_data["email_input"]))
+        raise
+    await _mark_thread_status(config, "done")
     if user_id:
-        send_feishu_text(user_id, "流程处理完毕。")
+        await asyncio.to_thread(send_feishu_text, user_id, "流程处理完毕。")
+
+
+async def _mark_thread_status(config: dict, status: str):
+    """把图的运行进度同步到本地邮件镜像，resume 时没有 input_data，所以从 checkpoint 里取 email_input"""
+    email_input = (await agent_app.aget_state(config)).values.get("email_input")
+    await asyncio.to_thread(mark_email_status, email_input, status)
+
+
+def _prefetch_triage(emails: list):
+    try:
+        count = prefetch_triage(emails, agent_app.store)
+        if count:
+            print(f"已批量分拣 {count} 封邮件")
+    except Exception as e:
+        # 批量分拣只是优化，失败了各封邮件仍会在 triage_router 里单独分拣
+        print(f"批量分拣失败: {e}")
+
+
+async def run_email_batch(emails: list, user_id: str):
+    """
+    一次拉取/重放的所有邮件放在同一个后台任务里并发处理：先把积压的邮件批量分拣进缓存，
+    再在事件循环上同时跑各自的流程，用信号量限制同时在跑的数量。
+    （BackgroundTasks 按顺序逐个执行，每封邮件单独一个任务就退化成了串行。）
+    """
+    if len(emails) > 1:
+        await asyncio.to_thread(_prefetch_triage, emails)
+    semaphore = asyncio.Semaphore(GRAPH_CONCURRENCY)
+
+    async def run_one(email_data: dict):
+        async with semaphore:
+            try:
+                await run_agent_worker(thread_id=email_data.get("thread_id"),
+                                       input_data={"email_input": email_data}, user_id=user_id)
+            except Exception as e:
+                # 一封邮件出错不影响同批的其他邮件；它在镜像里还停在 fetched / triaged，下次同步会重跑
+                print(f"会话 {email_data.get('thread_id')} 处理失败: {e}")
+                metrics.incr("graph.failed_runs")
+                await asyncio.to_thread(send_feishu_text, user_id,
+                                        f"邮件《{email_data.get('subject', '')}》处理失败，下次同步时会重试：{e}")
+
+    await asyncio.gather(*(run_one(email_data) for email_data in emails))
+
+
+def _with_unfinished(new_emails: list) -> list:
+    """
+    同步游标在邮件落进镜像后就推进了，不等流程跑完。之前拉到、但流程没跑起来或中途失败（进程重启、LLM 报错）
+    的邮件在镜像里还停在 fetched / triaged，把它们和这次的新邮件一起交给流程，同一封邮件只出现一次。
+    正在跑的流程 checkpoint 里已经有 email_input，会被 _already_handled 过滤掉。
+    """
+    mirror = get_mail_mirror()
+    seen = {email_data.get("mirror_id") for email_data in new_emails}
+    unfinished = [email_data
+                  for status in ("fetched", "triaged")
+                  for email_data in mirror.list_emails(status=status)
+                  if email_data["mirror_id"] not in seen]
+    return unfinished + new_emails
+
+
+async def _already_handled(email_data: dict) -> bool:
+    """
+    thread_id 由这封邮件的 Message-ID 推导，每封来信一个 checkpoint：同一封邮件再次抓取会落到原来的
+    checkpoint，里面已经有 email_input 就说明处理过（或正在等待审核），不再重跑整条 LLM 流程。
+    同一会话里的新回复是新的 thread，会话上下文在起草时从本地镜像里取。
+    """
+    config = {"configurable": {"thread_id": email_data.get("thread_id")}}
+    previous = (await agent_app.aget_state(config)).values.get("email_input")
+    return bool(previous) and previous.get("message_id") == email_data.get("message_id")
+
+
+async def _point_to_pending_card(thread_id: str, user_id: str):
+    """重复邮件不再重跑流程：原会话还在等待审核就把那张卡片再发一次，否则只提示已处理"""
+    snapshot = await agent_app.aget_state({"configurable": {"thread_id": thread_id}})
+    if snapshot.interrupts:
+        interrupt_val = snapshot.interrupts[0].value
+        actual_data = interrupt_val[0] if isinstance(interrupt_val, list) else interrupt_val
+        await asyncio.to_thread(send_feishu_text, user_id, "这封邮件与之前的一封内容相同，仍在等待您审核，已为您重新发送审核卡片。")
+        await asyncio.to_thread(send_feishu_card, receive_id=user_id, card_json=build_interrupt_card(actual_data))
+    else:
+        await asyncio.to_thread(send_feishu_text, user_id, "这封邮件与之前处理过的一封内容相同，已跳过。")
 
 
 @app.post("/webhook/event")
@@ -55,20 +196,32 @@ async def event_handler(request: Request, background_tasks: BackgroundTasks):
     open_id = event.get("sender", {}).get("sender_id", {}).get("open_id")
 
     if open_id:
-        send_feishu_text(open_id, "正在为您拉取 163 邮箱的最新邮件，请稍候...")
-        email_data = fetch_latest_163_email()
-        if isinstance(email_data, dict):
-            current_thread_id = email_data.get("thread_id")
-            email_data["user_id"] = open_id
-            real_input = {"email_input": email_data}
-            background_tasks.add_task(
-                run_agent_worker,
-                thread_id=current_thread_id,
-                input_data=real_input,
-                user_id=open_id
-            )
+        # 飞书接口是同步的 requests 调用，和 IMAP 同步一样放到线程里，不阻塞其他请求
+        await asyncio.to_thread(send_feishu_text, open_id, "正在为您拉取 163 邮箱的新邮件，请稍候...")
+        new_emails = await asyncio.to_thread(fetch_new_163_emails)
+        if isinstance(new_emails, str):
+            await asyncio.to_thread(send_feishu_text, open_id, f"拉取邮件失败:\n{new_emails}")
+            return {"msg": "ok"}
+        new_emails = await asyncio.to_thread(_with_unfinished, new_emails)
+        if not new_emails:
+            await asyncio.to_thread(send_feishu_text, open_id, "自上次同步以来没有新邮件。")
         else:
-            send_feishu_text(open_id, f"拉取邮件失败:\n{email_data}")
+            accepted = []
+            for email_data in new_emails:
+                current_thread_id = email_data.get("thread_id")
+                if await _already_handled(email_data):
+                    print(f"邮件 {email_data.get('message_id')} 已在会话 {current_thread_id} 中处理过，跳过")
+                    continue
+                duplicate_thread_id = await asyncio.to_thread(get_inbound_deduper().claim,
+                                                              email_fingerprint(email_data), current_thread_id)
+                # 指纹登记在同一个 thread 上，说明是上次没跑完、这次重跑的同一封邮件
+                if duplicate_thread_id and duplicate_thread_id != current_thread_id:
+                    await _point_to_pending_card(duplicate_thread_id, open_id)
+                    continue
+                email_data["user_id"] = open_id
+                accepted.append(email_data)
+            if accepted:
+                background_tasks.add_task(run_email_batch, accepted, open_id)
     return {"msg": "ok"}
 
 
@@ -110,6 +263,61 @@ async def event_handler(request: Request, background_tasks: BackgroundTasks):
 #
 #     return {"msg": "ok"}
 
+def _require_admin(request: Request):
+    """管理接口会重跑 LLM 流程、往任意 open_id 推卡片，必须带上配置好的口令；没配置 ADMIN_TOKEN 时直接关闭"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="口令错误")
+
+
+@app.post("/admin/replay")
+async def replay_handler(request: Request, background_tasks: BackgroundTasks):
+    """
+    从本地邮件镜像重放某一天的邮件（可按分类过滤），全程不访问 IMAP。
+    请求体: {"open_id": "ou_xxx", "day": "2026-10-18", "classification": "notify", "tag": "v2"}
+    同一个 tag 的重放落在固定的 thread 上，重复提交不会重跑已经跑过的邮件，发信台账也能认出重复发送；
+    需要再跑一遍时换一个 tag。
+    """
+    _require_admin(request)
+    body = await request.json()
+    open_id = body.get("open_id")
+    if not open_id:
+        return {"error": "缺少 open_id"}
+
+    tag = body.get("tag") or "replay"
+    emails = await asyncio.to_thread(get_mail_mirror().list_emails, day=body.get("day"),
+                                     classification=body.get("classification"))
+    accepted = []
+    for email_data in emails:
+        # 重放的 thread 由这封邮件自己的 thread 加上重放标签推导，不和原来那次运行的 checkpoint 混在一起
+        email_data["thread_id"] = f"{email_data['thread_id']}-replay-{tag}"
+        email_data["user_id"] = open_id
+        if await _already_handled(email_data):
+            continue
+        accepted.append(email_data)
+    if accepted:
+        background_tasks.add_task(run_email_batch, accepted, open_id)
+    return {"msg": "ok", "count": len(accepted), "skipped": len(emails) - len(accepted)}
+
+
+@app.get("/admin/metrics")
+async def metrics_handler(request: Request):
+    """运行指标：分拣缓存命中率、发件箱各状态的邮件数（failed 是彻底发不出去的）、模型级联的升级率和各级耗时、各节点命中前缀缓存的 token 数、偏好整理队列、系统提示词复用率等"""
+    _require_admin(request)
+    triage_calls = metrics.get("triage.calls")
+    return {
+        "counters": metrics.snapshot(),
+        "latency": metrics.latency_snapshot(),
+        "triage_escalation_rate": metrics.get("triage.escalations") / triage_calls if triage_calls else 0.0,
+        "triage_cache": get_triage_cache().stats(),
+        "outbox": get_outbox().stats(),
+        "prompt_cache": prompt_cache_report(),
+        "memory_queue": get_memory_queue().stats(),
+        "rendered_prompts": get_rendered_prompts().stats(),
+    }
+
+
 @app.post("/webhook/card")
 async def card_handler(request: Request, background_tasks: BackgroundTasks):
     try:
@@ -123,6 +331,11 @@ async def card_handler(request: Request, background_tasks: BackgroundTasks):
     if body.get("schema") != "2.0":
         return {"toast": {"type": "info", "content": "忽略V1"}}
 
+    event_id = body.get("header", {}).get("event_id")
+    if event_id and card_event_deduper.claim(event_id, event_id):
+        print(f"重复投递的卡片回调 {event_id}，已忽略")
+        return {"toast": {"type": "info", "content": "Agent 已收到反馈，继续执行..."}}
+
     event_data = body.get("event", {})
     open_id = event_data.get("operator", {}).get("open_id")
 
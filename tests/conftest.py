@@ -0,0 +1,24 @@
+"""
+测试进程的公共环境：落盘的数据库都放到临时目录，LLM 以 replay 模式运行，磁带里没有的请求按 schema
+生成模拟响应，不访问网络、不需要 API Key。core / utils 的模块在导入时就读取这些环境变量，所以放在 conftest 里。
+"""
+import os
+import tempfile
+
+_data_dir = tempfile.mkdtemp(prefix="mail-assistant-tests-")
+for _name, _filename in {
+    "OUTBOX_PATH": "outbox.db",
+    "MAIL_MIRROR_PATH": "mirror.db",
+    "DEDUP_PATH": "dedup.db",
+    "MEMORY_PATH": "memory.json",
+    "MEMORY_STORE_PATH": "memory_store.db",
+    "TRIAGE_CACHE_PATH": "triage_cache.db",
+    "TRIAGE_EXAMPLES_PATH": "triage_examples.db",
+    "TRIAGE_RULES_PATH": "triage_rules.json",
+    "LLM_CASSETTE_PATH": "cassette.json",
+}.items():
+    os.environ[_name] = os.path.join(_data_dir, _filename)
+os.environ["LLM_MODE"] = "replay"
+os.environ["LLM_REPLAY_FALLBACK"] = "synthetic"
+os.environ["LLM_REPLAY_LATENCY"] = "0"
+os.environ.setdefault("MAIL_USER", "me@163.com")
@@ -0,0 +1,64 @@
+import threading
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+import core.batch_triage as batch_triage
+from core.scheme import RouterScheme
+from utils.metrics import metrics
+
+
+def item(index: int, classification: str = "notify", **overrides) -> dict:
+    return {"index": index, "reasoning": f"第 {index} 封", "classification": classification, "confidence": 0.95,
+            **overrides}
+
+
+def fake_batch_llm(monkeypatch, results: list):
+    raw = AIMessage(content="", tool_calls=[{"name": "BatchRouterScheme", "args": {"results": results}, "id": "c1"}])
+
+    def get_structured_llm(schema, model_name, include_raw=False, **params):
+        assert include_raw, "批量分拣要拿原始输出逐项校验"
+        return RunnableLambda(lambda messages: {"raw": raw, "parsed": None, "parsing_error": ValueError("bad item")})
+
+    monkeypatch.setattr(batch_triage, "get_structured_llm", get_structured_llm)
+
+
+def fake_single_triage(monkeypatch) -> list:
+    calls = []
+    lock = threading.Lock()
+
+    def triage_one(system_prompt, email_input):
+        with lock:
+            calls.append(email_input["subject"])
+        return RouterScheme(reasoning="单封", classification="respond", confidence=1.0)
+
+    monkeypatch.setattr(batch_triage, "_triage_one", triage_one)
+    return calls
+
+
+def emails(n: int) -> list:
+    return [{"author": f"s{i}@example.com", "to": "me@163.com", "subject": f"邮件 {i + 1}", "email_thread": "正文"}
+            for i in range(n)]
+
+
+def test_one_malformed_item_only_falls_back_for_that_email(monkeypatch):
+    fake_batch_llm(monkeypatch, [item(1), item(2, classification="maybe"), item(3, "ignore")])
+    calls = fake_single_triage(monkeypatch)
+    fallback, invalid = metrics.get("triage_batch.fallback"), metrics.get("triage_batch.invalid_items")
+
+    results = batch_triage.triage_batch(emails(3), "偏好")
+
+    assert [r.classification for r in results] == ["notify", "respond", "ignore"]
+    assert calls == ["邮件 2"]
+    assert metrics.get("triage_batch.fallback") - fallback == 1
+    assert metrics.get("triage_batch.invalid_items") - invalid == 1
+
+
+def test_missing_duplicate_and_low_confidence_items_fall_back(monkeypatch):
+    fake_batch_llm(monkeypatch, [item(1), item(1, "ignore"), item(3, confidence=0.2), item(9), {"index": 4}])
+    calls = fake_single_triage(monkeypatch)
+
+    results = batch_triage.triage_batch(emails(4), "偏好")
+
+    assert results[0].classification == "notify"
+    assert sorted(calls) == ["邮件 2", "邮件 3", "邮件 4"]
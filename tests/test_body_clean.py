@@ -0,0 +1,28 @@
+from utils.body_clean import normalize_body
+
+
+def test_signature_delimiter_near_end_is_cut():
+    text = "周五下午两点可以。\n\n-- \n张煦\n南京航空航天大学\n"
+    assert normalize_body(text) == "周五下午两点可以。"
+
+
+def test_bare_double_dash_line_is_kept():
+    text = "第一部分\n--\n第二部分\n--\n第三部分"
+    assert normalize_body(text) == "第一部分\n--\n第二部分\n--\n第三部分"
+
+
+def test_signature_delimiter_far_from_end_is_kept():
+    body = "\n".join(f"第 {i} 条说明" for i in range(20))
+    text = f"开头\n-- \n{body}"
+    assert normalize_body(text).endswith("第 19 条说明")
+    assert normalize_body(text).startswith("开头\n--")
+
+
+def test_quote_marker_still_cuts_before_signature():
+    text = "收到，谢谢！\n\n-- \n张煦\n\n在 2026年10月17日 18:02，王老师 写道：\n" + "> 请确认。\n" * 50
+    assert normalize_body(text) == "收到，谢谢！"
+
+
+def test_html_signature():
+    html = "<div>好的</div><div>-- </div><div>张煦</div>"
+    assert normalize_body(html, "text/html") == "好的"
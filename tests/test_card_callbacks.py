@@ -0,0 +1,129 @@
+"""
+飞书卡片回调：图停在 write_email 的审核中断上时，并发打 N 个 "accept" 回调
+（一半复用同一个 event_id 模拟飞书重投，一半是不同 event_id 模拟用户连点），这次工具调用只能入队、发出一封；
+审核通过的邮件被退信时，要用飞书通知审核的用户。
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from langchain_core.messages import AIMessage
+
+import feishu.run as run
+import utils.smtp_outbox as smtp_outbox
+from utils.fake_smtp import FakeSMTPServer
+
+TOOL_CALL_ID = "call_card"
+
+
+@pytest.fixture
+def outbox(monkeypatch, tmp_path):
+    server = FakeSMTPServer().start()
+    outbox = smtp_outbox.SMTPOutbox(path=str(tmp_path / "outbox.db"), host="127.0.0.1", port=server.port,
+                                    user="me@163.com", password="", use_ssl=False, rate_per_minute=600)
+    monkeypatch.setattr(smtp_outbox, "_default_outbox", outbox)
+    monkeypatch.setattr(run, "send_feishu_card", lambda receive_id, card_json: None)
+    texts = []
+    monkeypatch.setattr(run, "send_feishu_text", lambda receive_id, text: texts.append((receive_id, text)))
+    outbox.on_failed = run._notify_send_failed
+    yield outbox, server, texts
+    outbox.stop(timeout=2)
+    server.stop()
+
+
+async def prepare_pending_review(thread_id: str, to: str = "hr@example.com"):
+    """跳过分拣和起草，直接写入一条带 write_email 调用的 AI 消息，让图停在 interrupt_handler 的审核中断上"""
+    config = {"configurable": {"thread_id": thread_id}}
+    await run.agent_app.aupdate_state(config, {
+        "email_input": {
+            "author": "HR <hr@example.com>",
+            "to": "me@163.com",
+            "subject": "面试邀约",
+            "email_thread": "请确认周五下午两点是否方便。",
+            "thread_id": thread_id,
+            "user_id": "ou_card",
+        },
+        "classification": "respond",
+        "messages": [AIMessage(content="", tool_calls=[{
+            "name": "write_email",
+            "args": {"to": to, "subject": "Re: 面试邀约", "content": "周五下午两点可以，谢谢。"},
+            "id": TOOL_CALL_ID,
+        }])],
+    }, as_node="response_agent")
+    async for _ in run.agent_app.astream(None, config=config):
+        pass
+    assert (await run.agent_app.aget_state(config)).interrupts
+
+
+def card_callback(thread_id: str, event_id: str) -> dict:
+    return {
+        "schema": "2.0",
+        "header": {"event_id": event_id},
+        "event": {
+            "operator": {"open_id": "ou_card"},
+            "action": {"value": {"type": "accept", "action": "write_email", "thread_id": thread_id}},
+        },
+    }
+
+
+def wait_for_status(outbox, outbox_id: int, status: str, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while outbox.get(outbox_id)["status"] != status and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert outbox.get(outbox_id)["status"] == status
+
+
+def test_concurrent_duplicate_callbacks_send_once(outbox):
+    outbox, server, _ = outbox
+    thread_id, n = "card-thread", 20
+    asyncio.run(prepare_pending_review(thread_id))
+
+    barrier = threading.Barrier(n)
+    statuses = []
+    # 用 with 让所有请求共用同一个事件循环，和 uvicorn 里一样（resume 锁是 asyncio.Lock）
+    with TestClient(run.app) as client:
+        def fire(i: int):
+            event_id = "evt-retry" if i % 2 == 0 else f"evt-click-{i}"
+            barrier.wait()
+            statuses.append(client.post("/webhook/card", json=card_callback(thread_id, event_id)).status_code)
+
+        workers = [threading.Thread(target=fire, args=(i,)) for i in range(n)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    assert set(statuses) == {200}
+    snapshot = asyncio.run(run.agent_app.aget_state({"configurable": {"thread_id": thread_id}}))
+    assert [m.type for m in snapshot.values["messages"]].count("tool") == 1
+    item = outbox.find(thread_id, TOOL_CALL_ID)
+    assert item is not None
+    assert outbox.count() == 1
+
+    wait_for_status(outbox, item["id"], "sent")
+    time.sleep(0.2)
+    assert [m["to"] for m in server.messages] == [["hr@example.com"]]
+
+
+def failures(texts: list) -> list:
+    # 流程跑完时也会发一条普通的飞书消息，这里只看发送失败的通知
+    return [(receive_id, text) for receive_id, text in texts if "发送失败" in text]
+
+
+def test_rejected_mail_is_reported_to_reviewer(outbox):
+    outbox, server, texts = outbox
+    thread_id = "card-bounce"
+    server.reject.add("nobody@example.com")
+    asyncio.run(prepare_pending_review(thread_id, to="nobody@example.com"))
+    with TestClient(run.app) as client:
+        client.post("/webhook/card", json=card_callback(thread_id, "evt-bounce"))
+
+    wait_for_status(outbox, outbox.find(thread_id, TOOL_CALL_ID)["id"], "failed")
+    deadline = time.monotonic() + 5
+    while not failures(texts) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    [(receive_id, text)] = failures(texts)
+    assert receive_id == "ou_card"
+    assert "nobody@example.com" in text and "550" in text
@@ -0,0 +1,28 @@
+from utils.dedup import InboundDeduper
+
+
+def test_duplicate_caught_after_restart(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    assert InboundDeduper(path).claim("fp", "thread-1") is None
+    # 新实例相当于进程重启
+    assert InboundDeduper(path).claim("fp", "thread-2") == "thread-1"
+
+
+def test_release_allows_reprocessing(tmp_path):
+    deduper = InboundDeduper(str(tmp_path / "dedup.db"))
+    deduper.claim("fp", "thread-1")
+    deduper.release("fp")
+    assert deduper.claim("fp", "thread-2") is None
+    assert deduper.claim("fp", "thread-3") == "thread-2"
+
+
+def test_expired_fingerprint_is_claimed_again(tmp_path):
+    deduper = InboundDeduper(str(tmp_path / "dedup.db"), ttl_seconds=-1)
+    assert deduper.claim("fp", "thread-1") is None
+    assert deduper.claim("fp", "thread-2") is None
+
+
+def test_in_memory_deduper():
+    deduper = InboundDeduper(":memory:")
+    assert deduper.claim("evt", "evt") is None
+    assert deduper.claim("evt", "evt") == "evt"
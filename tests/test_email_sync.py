@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+import utils.email_163 as email_163
+import utils.imap_pool as imap_pool
+import utils.mail_index as mail_index
+import utils.mail_mirror as mail_mirror
+from utils.fake_imap import FakeIMAPServer
+from utils.imap_pool import IMAPSessionPool
+
+
+def raw_email(n: int) -> bytes:
+    return (f"From: sender{n} <s{n}@example.com>\r\nTo: me@163.com\r\nSubject: mail {n}\r\n"
+            f"Message-ID: <m{n}@example.com>\r\n\r\nbody {n}\r\n").encode()
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    server = FakeIMAPServer().start()
+    pool = IMAPSessionPool("127.0.0.1", server.port, server.user, server.password, use_ssl=False, timeout=5)
+    monkeypatch.setattr(imap_pool, "_default_pool", pool)
+    monkeypatch.setattr(email_163, "SYNC_CURSOR_FILE", str(tmp_path / "cursor.json"))
+    monkeypatch.setattr(mail_mirror, "_default_mirror", mail_mirror.MailMirror(str(tmp_path / "mirror.db")))
+    monkeypatch.setattr(mail_index, "_default_index", mail_index.MailIndex(str(tmp_path / "mirror.db")))
+    yield server
+    pool.close()
+    server.stop()
+
+
+def sync_uids(**kwargs) -> list:
+    results = email_163.fetch_new_163_emails(**kwargs)
+    assert not isinstance(results, str), results
+    return [email_data["uid"] for email_data in results]
+
+
+def cursor() -> dict:
+    with open(email_163.SYNC_CURSOR_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_first_sync_takes_latest_then_only_new_mail(server):
+    for n in range(3):
+        server.add_message(raw_email(n))
+    assert sync_uids() == [3]
+    assert cursor()["last_uid"] == 3
+    assert sync_uids() == []
+    server.add_message(raw_email(3))
+    server.add_message(raw_email(4))
+    assert sync_uids(limit=1) == [4]
+    assert sync_uids() == [5]
+    assert cursor()["last_uid"] == 5
+
+
+def test_bootstrap_uses_highest_existing_uid(server):
+    for n in range(3):
+        server.add_message(raw_email(n))
+    server.delete_message(3)
+    # UIDNEXT 还是 4，但最新的一封是 UID 2
+    assert server.uidnext == 4
+    assert sync_uids() == [2]
+
+
+def test_empty_mailbox_bootstrap(server):
+    assert sync_uids() == []
+    assert cursor()["last_uid"] == 0
+    server.add_message(raw_email(0))
+    assert sync_uids() == [1]
+
+
+def test_uidvalidity_change_resets_cursor(server):
+    for n in range(3):
+        server.add_message(raw_email(n))
+    sync_uids()
+    server.reset_mailbox(uidvalidity=2)
+    server.add_message(raw_email(10))
+    server.add_message(raw_email(11))
+    assert sync_uids() == [2]
+    assert cursor()["uidvalidity"] == 2 and cursor()["last_uid"] == 2
+
+
+def test_failed_uid_is_retried_without_blocking_the_cursor(server):
+    server.add_message(raw_email(0))
+    sync_uids()
+    server.add_message(raw_email(1))
+    server.add_message(raw_email(2))
+    server.fail_fetch[2] = 1
+    assert sync_uids() == [3]
+    assert cursor()["last_uid"] == 3 and cursor()["retry"] == {"2": 1}
+    assert sync_uids() == [2]
+    assert cursor()["retry"] == {}
+
+
+def test_failed_uid_is_dropped_after_max_retries(server, monkeypatch):
+    monkeypatch.setattr(email_163, "SYNC_MAX_RETRIES", 2)
+    server.add_message(raw_email(0))
+    sync_uids()
+    server.add_message(raw_email(1))
+    server.fail_fetch[2] = 10
+    assert sync_uids() == []
+    assert cursor()["retry"] == {"2": 1}
+    assert sync_uids() == []
+    assert cursor()["retry"] == {}
+    assert sync_uids() == []
+
+
+def test_synced_mail_stays_fetched_in_mirror_until_processed(server):
+    server.add_message(raw_email(0))
+    [email_data] = email_163.fetch_new_163_emails()
+    mirror = mail_mirror.get_mail_mirror()
+    assert [e["mirror_id"] for e in mirror.list_emails(status="fetched")] == [email_data["mirror_id"]]
+    mirror.set_status(email_data["mirror_id"], "done")
+    assert mirror.list_emails(status="fetched") == []
@@ -0,0 +1,116 @@
+import base64
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from utils.bodystructure import decode_partial, parse_fetch_response, walk_bodystructure
+from utils.email_163 import fetch_email_partial
+from utils.fake_imap import FakeIMAPServer
+from utils.imap_pool import IMAPSessionPool
+
+PLAIN = "老师您好，附件是第三组的实验报告，请查收。" * 5
+
+
+def with_headers(message, subject: str) -> bytes:
+    message["From"] = "同学 <student@example.com>"
+    message["To"] = "me@163.com"
+    message["Subject"] = subject
+    message["Message-ID"] = f"<{subject}@example.com>"
+    return message.as_bytes().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+def alternative(plain: str, html: str) -> MIMEMultipart:
+    message = MIMEMultipart("alternative")
+    message.attach(MIMEText(plain, "plain", "utf-8"))
+    message.attach(MIMEText(html, "html", "utf-8"))
+    return message
+
+
+@pytest.fixture
+def server():
+    server = FakeIMAPServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def mail(server):
+    pool = IMAPSessionPool("127.0.0.1", server.port, server.user, server.password, use_ssl=False, timeout=5)
+    with pool.session() as mail:
+        yield mail
+    pool.close()
+
+
+def test_alternative_prefers_plain_text(server, mail):
+    uid = server.add_message(with_headers(alternative(PLAIN, "<p>HTML 版本</p>"), "alt"))
+    email_data = fetch_email_partial(mail, uid)
+    assert email_data["email_thread"].startswith("老师您好")
+    assert email_data["subject"] == "alt" and email_data["uid"] == uid
+    assert email_data["skipped_attachments"] == []
+
+
+def test_html_is_fetched_when_plain_is_a_stub(server, mail):
+    uid = server.add_message(with_headers(alternative("", "<p>只有 HTML 里才有的正文内容，需要转换成纯文本。</p>"), "stub"))
+    assert "只有 HTML 里才有的正文内容" in fetch_email_partial(mail, uid)["email_thread"]
+
+
+def test_attachment_is_skipped_and_its_literal_filename_parsed(server, mail):
+    message = MIMEMultipart("mixed")
+    message.attach(MIMEText(PLAIN, "plain", "utf-8"))
+    attachment = MIMEApplication(b"%PDF-1.4 " + b"x" * 3000, "pdf")
+    # RFC 2231 编码的中文文件名，服务器在 BODYSTRUCTURE 里以字面量 {n} 发送
+    attachment.add_header("Content-Disposition", "attachment", filename=("utf-8", "", "实验报告.pdf"))
+    message.attach(attachment)
+    uid = server.add_message(with_headers(message, "mixed"))
+
+    email_data = fetch_email_partial(mail, uid)
+    assert email_data["email_thread"].startswith("老师您好")
+    [skipped] = email_data["skipped_attachments"]
+    assert skipped["filename"] == "实验报告.pdf"
+    assert skipped["content_type"] == "application/pdf"
+    assert skipped["size"] > 3000
+
+
+def test_literal_inside_bodystructure():
+    data = [
+        (b'1 (UID 7 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 12 1 NIL NIL)'
+         b'("APPLICATION" "PDF" ("NAME" {12}', "实验报告".encode("utf-8")),
+        b') NIL NIL "BASE64" 400 NIL ("ATTACHMENT" NIL)) "MIXED"))',
+    ]
+    fields = parse_fetch_response(data)
+    assert fields["UID"] == "7"
+    text, pdf = walk_bodystructure(fields["BODYSTRUCTURE"])
+    assert text["section"] == "1" and text["encoding"] == "base64"
+    assert pdf["section"] == "2" and pdf["filename"] == "实验报告" and pdf["disposition"] == "attachment"
+
+
+def test_body_download_is_capped(server, mail):
+    uid = server.add_message(with_headers(MIMEText(PLAIN * 20, "plain", "utf-8"), "long"))
+    body = fetch_email_partial(mail, uid, max_bytes=200)["email_thread"]
+    # base64 的 200 字节约 150 字节原文，截断处不完整的汉字被丢掉，不会出现乱码
+    assert 0 < len(body) <= 50 and PLAIN.startswith(body)
+
+
+def test_falls_back_to_rfc822_without_bodystructure(server, mail):
+    server.bodystructure = False
+    uid = server.add_message(with_headers(alternative(PLAIN, "<p>HTML</p>"), "fallback"))
+    email_data = fetch_email_partial(mail, uid)
+    assert email_data["email_thread"].startswith("老师您好")
+    assert "skipped_attachments" not in email_data
+
+
+def test_decode_partial_truncated_base64():
+    encoded = base64.b64encode("实验报告".encode("utf-8"))
+    # 截在 base64 分组中间、也截在第三个汉字的字节中间
+    assert decode_partial(encoded[:10], "base64", "utf-8") == "实验"
+    assert decode_partial(encoded[:5] + b"\r\n", "BASE64", "utf-8") == "实"
+
+
+def test_decode_partial_truncated_quoted_printable():
+    encoded = b"=E5=AE=9E=E9=AA=8C=E6=8A"
+    assert decode_partial(encoded + b"=A5", "quoted-printable", "utf-8") == "实验报"
+    assert decode_partial(encoded + b"=A", "quoted-printable", "utf-8") == "实验"
+    assert decode_partial(encoded + b"=", "quoted-printable", "utf-8") == "实验"
+    assert decode_partial(b"abc=E", "quoted-printable", "utf-8") == "abc"
@@ -0,0 +1,107 @@
+import imaplib
+import threading
+import time
+
+import pytest
+
+from utils.fake_imap import FakeIMAPServer
+from utils.imap_pool import IMAPSessionPool
+
+
+@pytest.fixture
+def server():
+    server = FakeIMAPServer().start()
+    yield server
+    server.stop()
+
+
+def make_pool(server: FakeIMAPServer, **kwargs) -> IMAPSessionPool:
+    return IMAPSessionPool("127.0.0.1", server.port, server.user, server.password,
+                           use_ssl=False, timeout=5, **kwargs)
+
+
+def test_session_reuses_logged_in_connection(server):
+    pool = make_pool(server)
+    server.add_message(b"Subject: one\r\n\r\nbody\r\n")
+    for _ in range(3):
+        with pool.session() as mail:
+            status, data = mail.search(None, 'ALL')
+            assert status == 'OK' and data[0] == b"1"
+    pool.close()
+    assert server.logins == 1
+    # 每次借出前用 NOOP 探活，而不是重新 login/select
+    assert server.commands.count("SELECT") == 1
+    assert server.commands.count("NOOP") == 2
+
+
+def test_reconnects_after_server_drops_idle_connection(server):
+    pool = make_pool(server)
+    with pool.session() as mail:
+        mail.noop()
+    server.drop_connections()
+    with pool.session() as mail:
+        assert mail.noop()[0] == 'OK'
+    pool.close()
+    assert server.logins == 2
+
+
+def test_connection_discarded_after_error_in_session(server):
+    pool = make_pool(server)
+    with pytest.raises(ValueError):
+        with pool.session():
+            raise ValueError("boom")
+    with pool.session() as mail:
+        mail.noop()
+    pool.close()
+    assert server.logins == 2
+
+
+def test_server_without_id_command(server):
+    server.support_id = False
+    pool = make_pool(server)
+    with pool.session() as mail:
+        assert mail.state == 'SELECTED'
+    pool.close()
+
+
+def test_login_failure_is_raised(server):
+    pool = IMAPSessionPool("127.0.0.1", server.port, server.user, "wrong", use_ssl=False, timeout=5)
+    with pytest.raises(imaplib.IMAP4.error):
+        with pool.session():
+            pass
+    assert server.logins == 0
+
+
+def test_pool_bounds_concurrent_connections(server):
+    pool = make_pool(server, max_size=2, acquire_timeout=5)
+    active, peak = 0, 0
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal active, peak
+        with pool.session() as mail:
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            mail.noop()
+            time.sleep(0.05)
+            with lock:
+                active -= 1
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+    assert peak == 2
+    assert server.logins == 2
+
+
+def test_acquire_times_out_when_pool_exhausted(server):
+    pool = make_pool(server, max_size=1, acquire_timeout=0.1)
+    with pool.session():
+        with pytest.raises(TimeoutError):
+            with pool.session():
+                pass
+    pool.close()
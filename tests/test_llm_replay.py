@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.store.memory import InMemoryStore
+from langgraph.types import Command
+
+import utils.smtp_outbox as smtp_outbox
+from agents.tools import write_email
+from core.gp import workflow, async_workflow
+from core.llm_cassette import Cassette, CassetteChatModel, CassetteMiss, get_cassette
+from core.models import invoke_with_escalation
+from core.scheme import RouterScheme
+from utils.fake_smtp import FakeSMTPServer
+from utils.metrics import metrics
+
+TEACHER = "teacher@example.edu.cn"
+
+
+def make_email(thread_id: str) -> dict:
+    return {
+        "author": f"王老师 <{TEACHER}>",
+        "to": "me@163.com",
+        "subject": f"{thread_id} 课程设计答辩时间",
+        "email_thread": "同学你好，课程设计答辩定在下周三下午，请确认能否参加。",
+        "thread_id": thread_id,
+        "user_id": "ou_test",
+    }
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    server = FakeSMTPServer().start()
+    outbox = smtp_outbox.SMTPOutbox(path=str(tmp_path / "outbox.db"), host="127.0.0.1", port=server.port,
+                                    user="me@163.com", password="", use_ssl=False, rate_per_minute=600)
+    monkeypatch.setattr(smtp_outbox, "_default_outbox", outbox)
+    yield server
+    outbox.stop(timeout=2)
+    server.stop()
+
+
+def wait_for_delivery(server: FakeSMTPServer, timeout: float = 10) -> list:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not server.messages:
+        time.sleep(0.02)
+    return server.messages
+
+
+def run_sync(thread_id: str):
+    app = workflow.compile(store=InMemoryStore(), checkpointer=MemorySaver())
+    config = {"configurable": {"thread_id": thread_id}}
+    app.invoke({"email_input": make_email(thread_id)}, config=config)
+    interrupts = app.get_state(config).interrupts
+    app.invoke(Command(resume={"type": "accept"}), config=config)
+    return interrupts, app.get_state(config)
+
+
+async def run_async(thread_id: str):
+    app = async_workflow.compile(store=InMemoryStore(), checkpointer=MemorySaver())
+    config = {"configurable": {"thread_id": thread_id}}
+    await app.ainvoke({"email_input": make_email(thread_id)}, config=config)
+    interrupts = (await app.aget_state(config)).interrupts
+    await app.ainvoke(Command(resume={"type": "accept"}), config=config)
+    return interrupts, await app.aget_state(config)
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_triage_draft_interrupt_resume_under_replay(server, use_async):
+    synthetic_before = metrics.get("cassette.synthetic")
+    thread_id = f"replay-{'async' if use_async else 'sync'}"
+    interrupts, state = asyncio.run(run_async(thread_id)) if use_async else run_sync(thread_id)
+
+    # 分拣走 with_structured_output，起草走 bind_tools，各一次模拟响应
+    assert metrics.get("cassette.synthetic") - synthetic_before == 2
+    assert state.values["classification"] == "respond"
+    [request] = interrupts[0].value
+    assert request["action_request"]["action"] == "write_email"
+    assert request["action_request"]["args"]["to"] == TEACHER
+    assert not state.next
+    assert state.values["messages"][-1].type == "tool"
+    [delivered] = wait_for_delivery(server)
+    assert delivered["to"] == [TEACHER]
+
+
+def test_recorded_calls_replay_exactly(tmp_path):
+    path = str(tmp_path / "cassette.json")
+    synthetic = CassetteChatModel(model_name="gpt-4o-mini", cassette=Cassette(str(tmp_path / "none.json"),
+                                                                              fallback="synthetic"))
+    recorder = CassetteChatModel(model_name="gpt-4o-mini", mode="record", cassette=Cassette(path, fallback="0"),
+                                 inner=synthetic)
+    messages = [{"role": "user", "content": f"请回复 {TEACHER} 的来信"}]
+    recorded = (recorder.with_structured_output(RouterScheme).invoke(messages),
+                recorder.bind_tools([write_email], tool_choice="required").invoke(messages).tool_calls)
+
+    player = CassetteChatModel(model_name="gpt-4o-mini", cassette=Cassette(path, fallback="0"))
+    assert len(player.cassette) == 2
+    assert player.with_structured_output(RouterScheme).invoke(messages) == recorded[0]
+    assert player.bind_tools([write_email], tool_choice="required").invoke(messages).tool_calls == recorded[1]
+    with pytest.raises(CassetteMiss):
+        player.with_structured_output(RouterScheme).invoke([{"role": "user", "content": "改过的提示词"}])
+
+
+def test_escalation_does_not_swallow_cassette_miss(monkeypatch):
+    monkeypatch.setattr(get_cassette(), "fallback", "0")
+    escalations = metrics.get("triage.escalations")
+    with pytest.raises(CassetteMiss):
+        invoke_with_escalation(RouterScheme, [{"role": "user", "content": "磁带里没有的请求"}])
+    assert metrics.get("triage.escalations") == escalations
@@ -0,0 +1,40 @@
+from utils.mail_index import MailIndex
+from utils.mail_mirror import MailMirror
+
+
+def make_index(tmp_path) -> MailIndex:
+    path = str(tmp_path / "mirror.db")
+    mirror = MailMirror(path)
+    for i, (subject, body) in enumerate([("明天开会", "请准时参加"), ("会议纪要", "见附件"), ("github 部署", "已上线")]):
+        mirror.save_email({"author": f"发件人 <u{i}@example.com>", "to": "me@163.com", "subject": subject,
+                           "email_thread": body, "thread_id": f"t{i}", "message_id": f"<{i}@test>"})
+    return MailIndex(path)
+
+
+def subjects(results) -> list:
+    return sorted(result["subject"] for result in results)
+
+
+def test_single_cjk_character_matches_anywhere_in_a_run(tmp_path):
+    index = make_index(tmp_path)
+    # “会”在“开会”里是最后一个字，在“会议”里是第一个字
+    assert subjects(index.search("会")) == ["会议纪要", "明天开会"]
+    assert subjects(index.search("附")) == ["会议纪要"]
+
+
+def test_bigram_and_word_queries(tmp_path):
+    index = make_index(tmp_path)
+    assert subjects(index.search("开会")) == ["明天开会"]
+    assert subjects(index.search("明天 会")) == ["明天开会"]
+    assert subjects(index.search("github")) == ["github 部署"]
+    assert index.search("周五") == []
+
+
+def test_index_from_older_version_is_rebuilt(tmp_path):
+    index = make_index(tmp_path)
+    index.sync()
+    with index._conn:
+        index._conn.execute("DELETE FROM search_terms WHERE length(term) = 1")
+        index._conn.execute("UPDATE search_meta SET value = 1")
+    reopened = MailIndex(str(tmp_path / "mirror.db"))
+    assert subjects(reopened.search("会")) == ["会议纪要", "明天开会"]
@@ -0,0 +1,55 @@
+import sqlite3
+
+from utils.mail_mirror import SCHEMA, MailMirror
+
+OLD_SCHEMA = SCHEMA.replace("conversation_index", "thread_index") \
+    .replace("idx_messages_conversation", "idx_messages_thread") \
+    .replace("conversation_id", "thread_id")
+
+
+def mail(n: int, **headers) -> dict:
+    return {"author": "老师 <teacher@example.edu.cn>", "to": "me@163.com", "subject": f"第 {n} 封",
+            "email_thread": f"正文 {n}", "message_id": f"<m{n}@example.edu.cn>",
+            "date": f"Mon, {n} Jun 2026 10:00:00 +0800", "headers": headers}
+
+
+def save(mirror: MailMirror, email_data: dict) -> dict:
+    email_data["conversation_id"] = mirror.resolve_conversation_id(email_data)
+    email_data["mirror_id"] = mirror.save_email(email_data)
+    return email_data
+
+
+def test_conversation_history_follows_in_reply_to(tmp_path):
+    mirror = MailMirror(str(tmp_path / "mirror.db"))
+    first = save(mirror, mail(1))
+    second = save(mirror, mail(2, **{"in-reply-to": "<m1@example.edu.cn>"}))
+    assert second["conversation_id"] == first["conversation_id"]
+    assert [e["subject"] for e in mirror.conversation_history(second)] == ["第 1 封"]
+
+
+def test_old_thread_id_column_is_renamed(tmp_path):
+    path = str(tmp_path / "mirror.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    conn.execute("INSERT INTO messages (message_id, uid, thread_id, author, sender_email, to_addr, subject, sent_at, "
+                 "fetched_at) VALUES ('<m1@example.edu.cn>', 1, 'mail-old', '老师', 'teacher@example.edu.cn', "
+                 "'me@163.com', '第 1 封', '2026-06-01T02:00:00+00:00', 0)")
+    conn.execute("INSERT INTO bodies (message_pk, body) VALUES (1, '正文 1')")
+    conn.execute("INSERT INTO processing (message_pk, status, updated_at) VALUES (1, 'done', 0)")
+    conn.execute("INSERT INTO thread_index (message_id, thread_id) VALUES ('<m1@example.edu.cn>', 'mail-old')")
+    conn.commit()
+    conn.close()
+
+    mirror = MailMirror(path)
+    reply = save(mirror, mail(2, **{"in-reply-to": "<m1@example.edu.cn>"}))
+    assert reply["conversation_id"] == "mail-old"
+    assert [e["subject"] for e in mirror.conversation_history(reply)] == ["第 1 封"]
+    mirror.close()
+    conn = sqlite3.connect(path)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+    indexes = {row[1] for row in conn.execute("PRAGMA index_list(messages)")}
+    conn.close()
+    assert "conversation_id" in columns and "thread_id" not in columns
+    assert "idx_messages_conversation" in indexes and "idx_messages_thread" not in indexes
+    # 再打开一次不会重复迁移
+    MailMirror(path).close()
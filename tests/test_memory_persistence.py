@@ -0,0 +1,60 @@
+import json
+
+from langgraph.store.memory import InMemoryStore
+
+from core.memory import MemoryPersistence
+
+
+def make_persistence(tmp_path, **kwargs) -> MemoryPersistence:
+    return MemoryPersistence(str(tmp_path / "memory.json"), str(tmp_path / "memory.log"), **kwargs)
+
+
+def write_snapshot(tmp_path, state: dict):
+    (tmp_path / "memory.json").write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+
+
+def test_load_replays_log_over_snapshot(tmp_path):
+    write_snapshot(tmp_path, {"email_assistant|ou_a|triage_preferences": "旧的",
+                              "email_assistant|ou_b|triage_preferences": {"preferences": "b", "version": 2}})
+    first = make_persistence(tmp_path)
+    first.mark_dirty(("email_assistant", "ou_a", "triage_preferences"), "新的", 3)
+    first.flush()
+
+    store = InMemoryStore()
+    assert make_persistence(tmp_path).load(store) == 2
+    assert store.get(("email_assistant", "ou_a", "triage_preferences"), "preferences").value == \
+        {"preferences": "新的", "version": 3}
+    assert store.get(("email_assistant", "ou_b", "triage_preferences"), "preferences").value == \
+        {"preferences": "b", "version": 2}
+
+
+def test_torn_last_line_is_skipped_and_trimmed(tmp_path):
+    persistence = make_persistence(tmp_path)
+    persistence.mark_dirty(("email_assistant", "ou_a", "triage_preferences"), "完整的", 1)
+    persistence.flush()
+    with open(tmp_path / "memory.log", "a", encoding="utf-8") as f:
+        f.write('{"key": "email_assistant|ou_b|triage_preferences", "prefer')
+
+    reopened = make_persistence(tmp_path)
+    # 截掉半行之后再追加，新写的这一条要能读出来
+    reopened.mark_dirty(("email_assistant", "ou_c", "triage_preferences"), "c", 1)
+    reopened.flush()
+
+    store = InMemoryStore()
+    assert make_persistence(tmp_path).load(store) == 2
+    assert store.get(("email_assistant", "ou_a", "triage_preferences"), "preferences").value["preferences"] == "完整的"
+    assert store.get(("email_assistant", "ou_c", "triage_preferences"), "preferences").value["preferences"] == "c"
+    assert store.get(("email_assistant", "ou_b", "triage_preferences"), "preferences") is None
+
+
+def test_compaction_without_load_keeps_existing_snapshot(tmp_path):
+    write_snapshot(tmp_path, {"email_assistant|ou_a|triage_preferences": "a",
+                              "email_assistant|ou_b|triage_preferences": "b"})
+    persistence = make_persistence(tmp_path, compact_every=1)
+    persistence.mark_dirty(("email_assistant", "ou_c", "triage_preferences"), "c", 1)
+    persistence.flush()
+
+    on_disk = json.loads((tmp_path / "memory.json").read_text(encoding="utf-8"))
+    assert sorted(on_disk) == ["email_assistant|ou_a|triage_preferences", "email_assistant|ou_b|triage_preferences",
+                               "email_assistant|ou_c|triage_preferences"]
+    assert (tmp_path / "memory.log").read_text(encoding="utf-8") == ""
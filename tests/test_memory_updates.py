@@ -0,0 +1,112 @@
+"""
+偏好记忆并发更新：用假的整理模型代替 get_structured_llm，把当前档案里已有的反馈标记和新反馈的标记合并后返回，
+中间随机睡几毫秒模拟模型耗时。很多个 worker 同时对少数几个 namespace 调 update_memory，
+最后检查每个 namespace 的档案里一条反馈都没丢、版本号正好等于提交次数。
+"""
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langgraph.store.memory import InMemoryStore
+
+import core.memory as memory
+from core.scheme import Userpreference
+from utils.sqlite_store import SQLiteStore
+
+NAMESPACES = [("email_assistant", f"ou_{i}", "response_preferences") for i in range(3)]
+MARK = re.compile(r"<fb:[\w-]+>")
+
+
+class FakeMerger:
+    """假的整理模型：新档案 = 旧档案里的标记 ∪ 这次反馈里的标记，丢失更新会直接体现为少了标记"""
+
+    def __init__(self, before_return=None):
+        self.before_return = before_return
+
+    def invoke(self, messages, config=None):
+        time.sleep(random.uniform(0.001, 0.005))
+        if self.before_return:
+            self.before_return()
+        marks = set()
+        for message in messages:
+            marks.update(MARK.findall(message.content if hasattr(message, "content") else message["content"]))
+        return Userpreference(reasoning="合并反馈", preferences=" ".join(sorted(marks)))
+
+
+@pytest.fixture
+def merger(monkeypatch):
+    merger = FakeMerger()
+    monkeypatch.setattr(memory, "get_structured_llm", lambda schema, model_name=None, **params: merger)
+    return merger
+
+
+def feedback(worker: int, n: int):
+    return [{"role": "user", "content": f"以后记住这一条 <fb:w{worker}-{n}>"}]
+
+
+@pytest.mark.parametrize("layout", ["memory", "sqlite", "sqlite-shared"])
+def test_concurrent_updates_lose_nothing(tmp_path, monkeypatch, merger, layout):
+    # 几个 worker 抢同一个 namespace 时，个别 worker 会连续被抢先很多次，这里不让它放弃
+    monkeypatch.setattr(memory, "MEMORY_CAS_MAX_ATTEMPTS", 1000)
+    path = str(tmp_path / "store.db")
+    if layout == "memory":
+        stores = [InMemoryStore()]
+    elif layout == "sqlite":
+        stores = [SQLiteStore(path)]
+    else:
+        # 两个实例共用一个库文件，相当于两个进程，各有自己的 LRU 缓存
+        stores = [SQLiteStore(path), SQLiteStore(path)]
+    workers, per_worker = 8, 5
+    submitted = {namespace: set() for namespace in NAMESPACES}
+    submitted_lock = threading.Lock()
+
+    def worker(w: int):
+        store = stores[w % len(stores)]
+        for n in range(per_worker):
+            namespace = NAMESPACES[(w + n) % len(NAMESPACES)]
+            messages = feedback(w, n)
+            memory.update_memory(store, namespace, messages)
+            with submitted_lock:
+                submitted[namespace].update(MARK.findall(messages[0]["content"]))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(worker, range(workers)))
+
+    # 每个实例的 LRU 里可能还是对方提交前的版本，核对时直接查库
+    reader = stores[0] if layout == "memory" else SQLiteStore(path, cache_size=0)
+    for namespace in NAMESPACES:
+        value = reader.get(namespace, "preferences").value
+        assert set(MARK.findall(value["preferences"])) == submitted[namespace]
+        assert value["version"] == len(submitted[namespace])
+
+
+def test_gives_up_after_max_attempts(monkeypatch, merger):
+    monkeypatch.setattr(memory, "MEMORY_CAS_MAX_ATTEMPTS", 2)
+    store = InMemoryStore()
+    namespace = NAMESPACES[0]
+    memory.update_memory(store, namespace, feedback(0, 0))
+
+    def commit_concurrently():
+        # 每次整理期间都有别的 worker 抢先提交一版
+        current = memory.get_memory_snapshot(store, namespace, "")
+        memory.compare_and_swap(store, namespace, current.version,
+                                memory.PreferenceSnapshot(current.version + 1, current.preferences))
+
+    merger.before_return = commit_concurrently
+    with pytest.raises(memory.MemoryConflictError):
+        memory.update_memory(store, namespace, feedback(0, 1))
+    assert "<fb:w0-1>" not in store.get(namespace, "preferences").value["preferences"]
+
+
+def test_max_attempts_is_at_least_one():
+    env = dict(os.environ, MEMORY_CAS_MAX_ATTEMPTS="0")
+    output = subprocess.run([sys.executable, "-c", "import core.memory as m; print(m.MEMORY_CAS_MAX_ATTEMPTS)"],
+                            env=env, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    assert output.strip() == "1"
@@ -0,0 +1,180 @@
+import threading
+import time
+
+import pytest
+
+from utils.fake_smtp import FakeSMTPServer
+from utils.metrics import metrics
+from utils.smtp_outbox import SMTPOutbox, _RateLimiter
+
+
+@pytest.fixture
+def server():
+    server = FakeSMTPServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_outbox(tmp_path, server):
+    outboxes = []
+
+    def make(**kwargs) -> SMTPOutbox:
+        kwargs.setdefault("rate_per_minute", 600)
+        outbox = SMTPOutbox(path=str(tmp_path / "outbox.db"), host="127.0.0.1", port=server.port,
+                            user="me@163.com", password="", use_ssl=False, **kwargs)
+        outboxes.append(outbox)
+        return outbox
+
+    yield make
+    for outbox in outboxes:
+        outbox.stop(timeout=2)
+
+
+def wait_for(outbox: SMTPOutbox, outbox_id: int, statuses=("sent", "failed"), timeout: float = 10) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        item = outbox.get(outbox_id)
+        if item["status"] in statuses:
+            return item
+        time.sleep(0.02)
+    raise AssertionError(f"邮件 #{outbox_id} 在 {timeout}s 内没有变成 {statuses}: {outbox.get(outbox_id)}")
+
+
+def test_sends_over_one_reused_connection(server, make_outbox):
+    outbox = make_outbox()
+    ids = [outbox.enqueue(f"user{i}@example.com", f"第 {i} 封", "正文") for i in range(3)]
+    for outbox_id in ids:
+        assert wait_for(outbox, outbox_id)["status"] == "sent"
+    assert [m["subject"] for m in server.messages] == ["第 0 封", "第 1 封", "第 2 封"]
+    assert server.messages[0]["to"] == ["user0@example.com"]
+    assert len({m["peer"] for m in server.messages}) == 1
+
+
+def test_temporary_failure_retries_with_exponential_backoff(server, make_outbox):
+    server.fail_next = 2
+    outbox = make_outbox(backoff_base=0.2)
+    item = wait_for(outbox, outbox.enqueue("a@example.com", "重试", "正文"))
+    assert item["status"] == "sent"
+    assert item["attempts"] == 3
+    assert "451" in item["last_error"]
+    first, second, third = server.attempt_times
+    assert second - first >= 0.2 * 0.9
+    assert third - second >= 0.4 * 0.9
+
+
+def test_gives_up_after_max_attempts(server, make_outbox):
+    server.fail_next = 10
+    outbox = make_outbox(backoff_base=0.05, max_attempts=2)
+    item = wait_for(outbox, outbox.enqueue("a@example.com", "放弃", "正文"))
+    assert item["status"] == "failed"
+    assert item["attempts"] == 2
+    assert len(server.attempt_times) == 2
+
+
+def test_permanent_rejection_is_not_retried(server, make_outbox):
+    server.reject.add("nobody@example.com")
+    failed = []
+    outbox = make_outbox(backoff_base=0.05, on_failed=failed.append)
+    before = metrics.get("outbox.failed")
+    item = wait_for(outbox, outbox.enqueue("nobody@example.com", "退信", "正文"))
+    assert item["status"] == "failed"
+    assert item["attempts"] == 1
+    assert "550" in item["last_error"]
+    assert server.messages == []
+
+    deadline = time.monotonic() + 5
+    while not failed and time.monotonic() < deadline:
+        time.sleep(0.02)
+    [notified] = failed
+    assert (notified["id"], notified["status"], notified["last_error"]) == (item["id"], "failed", item["last_error"])
+    assert metrics.get("outbox.failed") - before == 1
+    assert outbox.stats() == {"queued": 0, "sending": 0, "sent": 0, "failed": 1}
+
+
+def test_retries_when_server_is_down(tmp_path, server, make_outbox):
+    port = server.port
+    server.stop()
+    outbox = make_outbox(backoff_base=0.2)
+    outbox_id = outbox.enqueue("a@example.com", "服务器恢复", "正文")
+    deadline = time.monotonic() + 5
+    while outbox.get(outbox_id)["attempts"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert outbox.get(outbox_id)["status"] == "queued"
+
+    revived = FakeSMTPServer(port=port).start()
+    try:
+        assert wait_for(outbox, outbox_id)["status"] == "sent"
+        assert len(revived.messages) == 1
+    finally:
+        revived.stop()
+
+
+def test_idle_worker_wakes_up_for_new_mail(server, make_outbox):
+    outbox = make_outbox()
+    assert wait_for(outbox, outbox.enqueue("a@example.com", "第一封", "正文"))["status"] == "sent"
+    # 后台线程此时在等唤醒（最长 30 秒），新入队的邮件要立刻发出
+    time.sleep(0.3)
+    start = time.monotonic()
+    assert wait_for(outbox, outbox.enqueue("b@example.com", "第二封", "正文"), timeout=2)["status"] == "sent"
+    assert time.monotonic() - start < 1
+
+
+def test_restart_resends_in_flight_mail_with_same_message_id(tmp_path, server, make_outbox):
+    outbox = make_outbox()
+    outbox_id = outbox.enqueue("a@example.com", "重启", "正文")
+    wait_for(outbox, outbox_id)
+    outbox.stop(timeout=2)
+    # 模拟服务器已收下、但进程在记成 sent 之前退出
+    with outbox._lock, outbox._conn:
+        outbox._conn.execute("UPDATE outbox SET status = 'sending' WHERE id = ?", (outbox_id,))
+
+    restarted = make_outbox()
+    assert restarted.get(outbox_id)["status"] == "queued"
+    restarted.start()
+    assert wait_for(restarted, outbox_id)["status"] == "sent"
+    first, second = server.messages
+    assert first["message_id"] == second["message_id"]
+    assert first["message_id"].startswith(f"<outbox-{outbox_id}.")
+
+
+def test_enqueue_once_is_idempotent_under_concurrency(server, make_outbox):
+    outbox = make_outbox()
+    n = 20
+    barrier = threading.Barrier(n)
+    results = []
+
+    def enqueue():
+        barrier.wait()
+        results.append(outbox.enqueue_once("thread-1", "call_1", "a@example.com", "台账", "正文"))
+
+    workers = [threading.Thread(target=enqueue) for _ in range(n)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sum(1 for _, created in results if created) == 1
+    [outbox_id] = {outbox_id for outbox_id, _ in results}
+    assert outbox.find("thread-1", "call_1")["id"] == outbox_id
+    assert outbox.find("thread-1", "call_2") is None
+    assert wait_for(outbox, outbox_id)["status"] == "sent"
+    assert outbox.count() == outbox.count("sent") == 1
+    assert len(server.messages) == 1
+
+
+def test_rate_limit_holds_back_mail_over_quota(server, make_outbox):
+    outbox = make_outbox(rate_per_minute=1)
+    first = outbox.enqueue("a@example.com", "第一封", "正文")
+    second = outbox.enqueue("b@example.com", "第二封", "正文")
+    assert wait_for(outbox, first)["status"] == "sent"
+    time.sleep(0.5)
+    assert outbox.get(second)["status"] == "queued"
+    assert len(server.messages) == 1
+
+
+def test_rate_limiter_allows_burst_then_paces():
+    limiter = _RateLimiter(per_minute=120)
+    for _ in range(120):
+        assert limiter.wait_time() == 0
+        limiter.consume()
+    assert limiter.wait_time() == pytest.approx(0.5, abs=0.05)
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+from langgraph.store.memory import InMemoryStore
+
+from utils import sqlite_store
+from utils.metrics import metrics
+from utils.sqlite_store import SQLiteStore
+
+ITEMS = [
+    (("email_assistant", "ou_a", "triage_preferences"), "preferences", {"preferences": "a", "meta": {"lang": "zh"}}),
+    (("email_assistant", "ou_b", "triage_preferences"), "preferences", {"preferences": "b", "meta": {"lang": "en"}}),
+    (("email_assistant", "ou_a", "cal_preferences"), "preferences", {"preferences": "a 的日程"}),
+    # "_" 和 "%" 在 LIKE 里是通配符，按前缀搜 ("ou_a",) 不能把 ("oux",) 带出来
+    (("ou_a",), "k", {"preferences": "下划线"}),
+    (("oux", "a"), "k", {"preferences": "不该被匹配"}),
+    (("100%",), "k", {"preferences": "百分号"}),
+    (("1000",), "k", {"preferences": "不该被匹配"}),
+]
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def store(request, tmp_path):
+    # 同一组断言在 InMemoryStore 上也跑一遍，保证两者对调用方表现一致
+    store = SQLiteStore(str(tmp_path / "store.db")) if request.param == "sqlite" else InMemoryStore()
+    for namespace, key, value in ITEMS:
+        store.put(namespace, key, value)
+    yield store
+    if isinstance(store, SQLiteStore):
+        store.close()
+
+
+def make_store(tmp_path, **kwargs) -> SQLiteStore:
+    return SQLiteStore(str(tmp_path / "store.db"), **kwargs)
+
+
+def values(items) -> list:
+    return sorted(item.value["preferences"] for item in items)
+
+
+def test_search_by_namespace_prefix(store):
+    assert values(store.search(("email_assistant",))) == ["a", "a 的日程", "b"]
+    assert values(store.search(("email_assistant", "ou_a"))) == ["a", "a 的日程"]
+    assert values(store.search(("ou_a",))) == ["下划线"]
+    assert values(store.search(("100%",))) == ["百分号"]
+    assert values(store.search(("email",))) == []
+    assert len(store.search(())) == len(ITEMS)
+
+
+def test_search_filter(store):
+    assert values(store.search(("email_assistant",), filter={"preferences": "b"})) == ["b"]
+    assert values(store.search(("email_assistant",), filter={"meta": {"lang": "zh"}})) == ["a"]
+    assert store.search(("email_assistant",), filter={"meta": {"lang": "fr"}}) == []
+
+
+def test_list_namespaces(store):
+    assert store.list_namespaces(prefix=("email_assistant",)) == [
+        ("email_assistant", "ou_a", "cal_preferences"),
+        ("email_assistant", "ou_a", "triage_preferences"),
+        ("email_assistant", "ou_b", "triage_preferences"),
+    ]
+    assert store.list_namespaces(suffix=("triage_preferences",)) == [
+        ("email_assistant", "ou_a", "triage_preferences"),
+        ("email_assistant", "ou_b", "triage_preferences"),
+    ]
+    assert store.list_namespaces(prefix=("email_assistant", "*"), suffix=("cal_preferences",)) == [
+        ("email_assistant", "ou_a", "cal_preferences"),
+    ]
+    assert store.list_namespaces(prefix=("email_assistant",), max_depth=2) == [
+        ("email_assistant", "ou_a"), ("email_assistant", "ou_b"),
+    ]
+    assert store.list_namespaces(prefix=("email_assistant",), limit=1, offset=1) == [
+        ("email_assistant", "ou_a", "triage_preferences"),
+    ]
+
+
+def test_search_newest_first_with_offset_and_limit(tmp_path):
+    store = make_store(tmp_path)
+    for i in range(5):
+        store.put(("email_assistant", f"ou_{i}"), "preferences", {"preferences": str(i)})
+    store.put(("email_assistant", "ou_1"), "preferences", {"preferences": "1 改过"})
+    page = store.search(("email_assistant",), limit=2, offset=1)
+    assert [item.value["preferences"] for item in page] == ["4", "3"]
+    assert store.search(("email_assistant",), limit=1)[0].value["preferences"] == "1 改过"
+
+
+def test_semantic_query_is_rejected(tmp_path):
+    store = make_store(tmp_path)
+    with pytest.raises(ValueError):
+        store.search(("email_assistant",), query="会议")
+
+
+def test_missing_entries_are_cached(tmp_path):
+    store = make_store(tmp_path)
+    namespace = ("email_assistant", "ou_new", "triage_preferences")
+    misses, hits = metrics.get("memory_store.cache_miss"), metrics.get("memory_store.cache_hit")
+    assert store.get(namespace, "preferences") is None
+    assert store.get(namespace, "preferences") is None
+    assert metrics.get("memory_store.cache_miss") - misses == 1
+    assert metrics.get("memory_store.cache_hit") - hits == 1
+
+    # 写入要覆盖掉缓存里的"不存在"，删除后又要缓存成"不存在"
+    store.put(namespace, "preferences", {"preferences": "新用户"})
+    assert store.get(namespace, "preferences").value == {"preferences": "新用户"}
+    store.delete(namespace, "preferences")
+    assert store.get(namespace, "preferences") is None
+    assert metrics.get("memory_store.cache_miss") - misses == 1
+
+
+def test_lru_evicts_oldest(tmp_path):
+    store = make_store(tmp_path, cache_size=2)
+    for user in ("ou_a", "ou_b", "ou_c"):
+        store.put(("email_assistant", user), "preferences", {"preferences": user})
+    misses = metrics.get("memory_store.cache_miss")
+    assert store.get(("email_assistant", "ou_c"), "preferences").value["preferences"] == "ou_c"
+    assert store.get(("email_assistant", "ou_a"), "preferences").value["preferences"] == "ou_a"
+    assert metrics.get("memory_store.cache_miss") - misses == 1
+
+
+def test_abatch_serves_cached_reads_without_thread(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    namespace = ("email_assistant", "ou_a", "triage_preferences")
+    store.put(namespace, "preferences", {"preferences": "a"})
+    store.get(("email_assistant", "ou_b", "triage_preferences"), "preferences")
+
+    def no_thread(*args, **kwargs):
+        raise AssertionError("缓存全部命中时不应该切到线程")
+
+    monkeypatch.setattr(sqlite_store.asyncio, "to_thread", no_thread)
+    item, missing = asyncio.run(store.aget(namespace, "preferences")), \
+        asyncio.run(store.aget(("email_assistant", "ou_b", "triage_preferences"), "preferences"))
+    assert item.value == {"preferences": "a"}
+    assert missing is None
+
+    # 有没缓存过的条目就要走线程去查库
+    with pytest.raises(AssertionError):
+        asyncio.run(store.aget(("email_assistant", "ou_c", "triage_preferences"), "preferences"))
@@ -0,0 +1,60 @@
+import time
+
+from utils.metrics import metrics
+from utils.triage_cache import TriageCache, preferences_version
+
+RESULT = {"reasoning": "课程通知", "classification": "notify", "confidence": 0.9}
+
+
+def make_cache(tmp_path, **kwargs) -> TriageCache:
+    return TriageCache(str(tmp_path / "triage_cache.db"), **kwargs)
+
+
+def test_hit_and_miss(tmp_path):
+    cache = make_cache(tmp_path)
+    version = preferences_version("ou_a", "偏好", "背景")
+    hits, misses = metrics.get("triage_cache.hit"), metrics.get("triage_cache.miss")
+    assert cache.get("fp", version) is None
+    cache.put("fp", version, RESULT)
+    assert cache.get("fp", version) == RESULT
+    assert cache.get("other", version) is None
+    assert metrics.get("triage_cache.hit") - hits == 1
+    assert metrics.get("triage_cache.miss") - misses == 2
+    assert cache.stats()["lifetime_hits"] == 1
+
+
+def test_contains_does_not_count_as_hit(tmp_path):
+    cache = make_cache(tmp_path)
+    version = preferences_version("ou_a", "偏好", "背景")
+    cache.put("fp", version, RESULT)
+    hits = metrics.get("triage_cache.hit")
+    assert cache.contains("fp", version)
+    assert not cache.contains("fp", preferences_version("ou_a", "改过的偏好", "背景"))
+    assert metrics.get("triage_cache.hit") == hits
+    assert cache.stats()["lifetime_hits"] == 0
+
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    version = preferences_version("ou_a", "偏好", "背景")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache.put("fp", version, RESULT)
+    monkeypatch.setattr(time, "time", lambda: now + 59)
+    assert cache.get("fp", version) == RESULT
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("fp", version) is None
+    assert not cache.contains("fp", version)
+
+
+def test_versions_are_scoped_per_user(tmp_path):
+    cache = make_cache(tmp_path)
+    # 两个用户的偏好文本一样（都还在用全局档案），缓存条目也要分开
+    version_a = preferences_version("ou_a", "偏好", "背景")
+    version_b = preferences_version("ou_b", "偏好", "背景")
+    assert version_a != version_b
+    cache.put("fp", version_a, RESULT)
+    cache.put("fp", version_b, {**RESULT, "classification": "ignore"})
+    assert cache.drop_version(version_a) == 1
+    assert cache.get("fp", version_a) is None
+    assert cache.get("fp", version_b)["classification"] == "ignore"
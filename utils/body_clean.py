@@ -0,0 +1,266 @@
+import os
+import re
+from html.parser import HTMLParser
+from typing import List, Tuple
+
+# 正文最多保留的字符数，分拣和起草回复都用不到更长的内容
+BODY_MAX_CHARS = int(os.getenv("BODY_MAX_CHARS", "4000"))
+# 纯文本版本短于这个长度时（常见于 "请使用支持 HTML 的客户端查看" 之类的占位），改用 HTML 版本
+PLAIN_STUB_CHARS = 40
+FEED_CHUNK = 16 * 1024
+
+_SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template", "svg"}
+_BLOCK_TAGS = {
+    "p", "div", "br", "tr", "li", "ul", "ol", "table", "section", "article", "header", "footer",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr", "pre", "center", "dd", "dt", "address",
+}
+_CELL_TAGS = {"td", "th"}
+# 各家客户端放引用原文的容器：163 的 isReplyContent、Gmail 的 gmail_quote、Outlook 的 divRplyFwdMsg 等
+_QUOTE_MARKERS = ("isreplycontent", "gmail_quote", "divrplyfwdmsg", "yahoo_quoted", "moz-cite-prefix")
+
+# 出现这些行时，后面都是引用的历史邮件或手机客户端的签名
+_CUT_LINE_RE = re.compile(
+    r"^\s*(?:"
+    r"-{2,}\s*(?:原始邮件|Original Message|Forwarded message|转发的邮件)\s*-{2,}\s*$"
+    r"|在\s?.{1,80}(?:写道|wrote)\s*[:：]\s*$"
+    r"|On\s.{1,200}wrote\s*:\s*$"
+    r"|(?:发件人|From)\s*[:：][^\n]*\n\s*(?:发送时间|发送日期|日期|Sent|Date)\s*[:：]"
+    r"|发自我的\s*(?:iPhone|iPad|手机|华为手机|小米手机)\s*$"
+    r"|发自网易邮箱(?:大师|手机版)?\s*$"
+    r"|Sent from my\s[^\n]+$"
+    r")",
+    re.IGNORECASE | re.MULTILINE,
+)
+# RFC 3676 的签名分隔线是 "-- "（两个减号加一个空格）单独一行；只有 "--" 的行常见于正文里的分隔，不能当签名
+_SIGNATURE_RE = re.compile(r"^--[ \u00a0]\r?$", re.MULTILINE)
+# 分隔线后面的非空行不超过这么多才当作签名截掉，离结尾太远的说明后面还是正文
+SIGNATURE_MAX_LINES = 10
+
+
+class _TextExtractor(HTMLParser):
+    """单遍扫描的 HTML 转文本，跳过脚本/样式以及引用的历史邮件，输出到达上限后即停止"""
+
+    def __init__(self, max_chars: int, strip_quotes: bool):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.strip_quotes = strip_quotes
+        self.chunks: List[str] = []
+        self.length = 0
+        self._skip_tag = None
+        self._skip_depth = 0
+
+    @property
+    def full(self) -> bool:
+        return self.length >= self.max_chars
+
+    def _start_skip(self, tag: str, attrs) -> bool:
+        if tag in _SKIP_TAGS:
+            return True
+        if not self.strip_quotes:
+            return False
+        if tag == "blockquote":
+            return True
+        for name, value in attrs:
+            if name in ("id", "class") and value and any(marker in value.lower() for marker in _QUOTE_MARKERS):
+                return True
+        return False
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+        if self._start_skip(tag, attrs):
+            self._skip_tag, self._skip_depth = tag, 1
+            return
+        if tag in _BLOCK_TAGS:
+            self.chunks.append("\n")
+        elif tag in _CELL_TAGS:
+            self.chunks.append(" ")
+
+    def handle_startendtag(self, tag, attrs):
+        if self._skip_tag is None and tag in ("br", "hr"):
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    self._skip_tag = None
+            return
+        if tag in _BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if self._skip_tag is not None or self.full:
+            return
+        self.chunks.append(data)
+        self.length += len(data)
+
+
+def _strip_signature(text: str) -> str:
+    """只认最后一条 "-- " 分隔线，且它后面只剩几行（签名的长度）时才截断"""
+    match = None
+    for match in _SIGNATURE_RE.finditer(text):
+        pass
+    if match is None or match.start() == 0:
+        return text
+    if sum(1 for line in text[match.end():].splitlines() if line.strip()) > SIGNATURE_MAX_LINES:
+        return text
+    return text[:match.start()]
+
+
+def _tidy_lines(text: str, strip_quotes: bool) -> str:
+    """
+    去掉每行首尾空白和空行；需要时在第一条引用分隔线处截断、去掉结尾的签名，并丢掉 '>' 开头的引用行。
+    """
+    if strip_quotes:
+        match = _CUT_LINE_RE.search(text)
+        if match and match.start() > 0:
+            text = text[:match.start()]
+        text = _strip_signature(text)
+    lines = []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if not line or (strip_quotes and line.startswith(">")):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def html_to_text(html: str, max_chars: int = BODY_MAX_CHARS, strip_quotes: bool = True) -> str:
+    parser = _TextExtractor(max_chars, strip_quotes)
+    for start in range(0, len(html), FEED_CHUNK):
+        parser.feed(html[start:start + FEED_CHUNK])
+        if parser.full:
+            break
+    parser.close()
+    return _tidy_lines("".join(parser.chunks), strip_quotes)[:max_chars]
+
+
+def plain_to_text(text: str, max_chars: int = BODY_MAX_CHARS, strip_quotes: bool = True) -> str:
+    # 引用截断要在完整文本上做，这里先放宽一些再截断，避免把分隔线截没了
+    return _tidy_lines(text[:max_chars * 4], strip_quotes)[:max_chars]
+
+
+def _looks_like_html(text: str) -> bool:
+    head = text[:2048].lower()
+    return "<html" in head or "<body" in head or "<div" in head or "<p>" in head or "<br" in head or "<table" in head
+
+
+def normalize_body(text: str, content_type: str = "text/plain", max_chars: int = BODY_MAX_CHARS,
+                   strip_quotes: bool = True) -> str:
+    """把单个正文分段清洗为纯文本；有些发件方把 HTML 标成 text/plain，这里也按 HTML 处理"""
+    if not text:
+        return ""
+    if content_type == "text/html" or _looks_like_html(text):
+        return html_to_text(text, max_chars, strip_quotes)
+    return plain_to_text(text, max_chars, strip_quotes)
+
+
+def select_best_body(parts: List[Tuple[str, str]], max_chars: int = BODY_MAX_CHARS) -> str:
+    """
+    parts 是 [(content_type, 原始文本)]，来自同一封邮件的 text/plain 与 text/html。
+    multipart/alternative 的两个版本内容相同，只清洗一份：优先纯文本，纯文本是占位符时才用 HTML。
+    """
+    plain = [text for content_type, text in parts if content_type == "text/plain" and text]
+    html = [text for content_type, text in parts if content_type == "text/html" and text]
+    if plain:
+        cleaned = normalize_body("\n".join(plain), "text/plain", max_chars)
+        if len(cleaned) >= PLAIN_STUB_CHARS or not html:
+            return cleaned
+    if html:
+        return normalize_body("\n".join(html), "text/html", max_chars)
+    return ""
+
+
+def _load_eml_corpus(directory: str) -> List[Tuple[str, str]]:
+    """读取目录下的 .eml 文件（163 网页版可以把邮件导出为 .eml），取出每封邮件的 text/plain 和 text/html 分段"""
+    import email
+
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(".eml"):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            message = email.message_from_binary_file(f)
+        for part in message.walk():
+            if part.get_content_type() not in ("text/plain", "text/html") or part.get_filename():
+                continue
+            payload = part.get_payload(decode=True) or b""
+            try:
+                text = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+            except LookupError:
+                text = payload.decode("utf-8", errors="replace")
+            corpus.append((part.get_content_type(), text))
+    return corpus
+
+
+if __name__ == '__main__':
+    # 用法: python -m utils.body_clean [.eml 目录]，不给目录时用下面几封合成的邮件
+    import sys
+    import timeit
+
+    marketing_html = """<html><head><title>双11狂欢</title><style>.a{color:red}td{padding:0}</style>
+<script>window.dataLayer=[];function track(){}</script></head><body>
+<table width="600"><tr><td><img src="logo.png"/></td><td>尊敬的会员，您好！</td></tr>
+""" + "".join(
+        f'<tr><td class="item"><a href="https://shop.example.com/p/{i}">爆款商品 {i}</a></td>'
+        f'<td><span style="color:#f00">&yen;{i * 10}.00</span>&nbsp;限时直降</td></tr>\n'
+        for i in range(300)
+    ) + """</table><p>如不想再收到此类邮件，请<a href="#">退订</a>。</p></body></html>"""
+
+    notice_163_html = """<div style="font-family:微软雅黑">您好：<br/>您的网易邮箱于 2026-10-18 10:21 在新设备登录。<br/>
+如非本人操作，请立即修改密码。<br/><br/>网易邮件中心</div>""" * 5
+
+    reply_chain_html = """<div>好的，周五下午两点没问题，我会提前准备好材料。</div><div><br></div>
+<div id="isReplyContent"><div>------------------&nbsp;原始邮件&nbsp;------------------</div>
+<blockquote>""" + "<div>上一封邮件的内容，包含大量引用历史。</div>" * 400 + "</blockquote></div>"
+
+    reply_chain_plain = "收到，谢谢！\n\n-- \n张煦\n南京航空航天大学\n\n在 2026年10月17日 18:02，王老师 写道：\n" + \
+                        "> 请确认一下周五的安排。\n" * 400
+
+    corpus = [
+        ("text/html", marketing_html),
+        ("text/html", notice_163_html),
+        ("text/html", reply_chain_html),
+        ("text/plain", reply_chain_plain),
+    ]
+    if len(sys.argv) > 1:
+        corpus = _load_eml_corpus(sys.argv[1])
+        if not corpus:
+            sys.exit(f"{sys.argv[1]} 下没有可用的 .eml 邮件")
+        print(f"使用真实邮件语料: {sys.argv[1]}")
+    else:
+        print("未指定 .eml 目录，使用合成语料（真实的 163/营销邮件更有代表性）")
+    total_bytes = sum(len(text.encode("utf-8")) for _, text in corpus)
+
+    def run_new():
+        for content_type, text in corpus:
+            normalize_body(text, content_type)
+
+    print(f"语料: {len(corpus)} 个正文分段, 共 {total_bytes / 1024:.1f} KB")
+    for content_type, text in corpus[:20]:
+        print(f"  [{content_type}] {len(text)} 字符 -> {len(normalize_body(text, content_type))} 字符")
+
+    rounds = 50
+    new_seconds = timeit.timeit(run_new, number=rounds)
+    print(f"单遍流式清洗: {rounds * total_bytes / new_seconds / 1024 / 1024:.2f} MB/s")
+
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        print("未安装 beautifulsoup4，跳过旧实现的对比")
+    else:
+        def run_old():
+            for _, text in corpus:
+                soup = BeautifulSoup(text, "html.parser")
+                for script_or_style in soup(["script", "style"]):
+                    script_or_style.decompose()
+                clean_text = soup.get_text(separator="\n")
+                "\n".join([line.strip() for line in clean_text.splitlines() if line.strip()])
+
+        old_seconds = timeit.timeit(run_old, number=rounds)
+        print(f"BeautifulSoup(html.parser): {rounds * total_bytes / old_seconds / 1024 / 1024:.2f} MB/s")
+        print(f"加速比: {old_seconds / new_seconds:.1f}x")
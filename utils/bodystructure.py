@@ -0,0 +1,174 @@
+import base64
+import binascii
+import quopri
+import re
+from typing import Dict, List, Optional
+
+
+def _tokenize(segment: bytes, tokens: list):
+    """把 IMAP 响应切成 '(' ')' / 原子 / 字符串，BODY[...] 这种带方括号的键整体作为一个原子"""
+    i, n = 0, len(segment)
+    while i < n:
+        c = segment[i:i + 1]
+        if c in (b" ", b"\r", b"\n"):
+            i += 1
+        elif c in (b"(", b")"):
+            tokens.append(c.decode())
+            i += 1
+        elif c == b'"':
+            i += 1
+            buf = bytearray()
+            while i < n and segment[i:i + 1] != b'"':
+                if segment[i:i + 1] == b"\\":
+                    i += 1
+                buf += segment[i:i + 1]
+                i += 1
+            tokens.append(bytes(buf))
+            i += 1
+        elif c == b"{" and segment.rstrip().endswith(b"}"):
+            # 字面量的长度标记，真正的内容由调用方紧接着追加
+            break
+        else:
+            start, depth = i, 0
+            while i < n:
+                ch = segment[i:i + 1]
+                if ch == b"[":
+                    depth += 1
+                elif ch == b"]":
+                    depth -= 1
+                elif depth == 0 and ch in (b" ", b"(", b")"):
+                    break
+                i += 1
+            atom = segment[start:i].decode(errors="ignore")
+            tokens.append(None if atom.upper() == "NIL" else atom)
+
+
+def _build(tokens: list, pos: int = 0):
+    items = []
+    while pos < len(tokens):
+        tok = tokens[pos]
+        if tok == "(":
+            sub, pos = _build(tokens, pos + 1)
+            items.append(sub)
+        elif tok == ")":
+            return items, pos + 1
+        else:
+            items.append(tok)
+            pos += 1
+    return items, pos
+
+
+def parse_fetch_response(data: list) -> Dict[str, object]:
+    """
+    解析 imaplib 返回的 FETCH 结果，得到 {"UID": "7", "BODYSTRUCTURE": [...], "BODY[1]<0>": b"..."} 这样的字典。
+    imaplib 会把字面量拆成 (前缀, 内容) 元组，这里按顺序拼回一条 token 流。
+    """
+    tokens: list = []
+    for item in data:
+        if isinstance(item, tuple):
+            _tokenize(item[0], tokens)
+            tokens.append(item[1])
+        elif isinstance(item, bytes):
+            _tokenize(item, tokens)
+
+    tree, _ = _build(tokens)
+    # tree 形如 ["1", [键, 值, 键, 值...]]
+    fields = next((node for node in tree if isinstance(node, list)), [])
+    result = {}
+    for key, value in zip(fields[0::2], fields[1::2]):
+        if isinstance(key, str):
+            result[key.upper()] = value
+    return result
+
+
+def _text(value) -> str:
+    if value is None:
+        return ""
+    return value.decode(errors="ignore") if isinstance(value, bytes) else str(value)
+
+
+def _params(value) -> Dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    return {_text(k).lower(): _text(v) for k, v in zip(value[0::2], value[1::2])}
+
+
+def walk_bodystructure(structure: list, prefix: str = "", parent_subtype: str = "") -> List[Dict]:
+    """
+    展开 BODYSTRUCTURE，返回所有叶子节点：
+    section(可直接用于 BODY[section])、content_type、charset、encoding、size、filename、disposition、alternative。
+    message/rfc822 附带的邮件当作附件整体处理，不再往里递归。
+    """
+    if structure and isinstance(structure[0], list):
+        # multipart：前面若干个子结构，紧跟着子类型，再往后是扩展字段
+        children = []
+        for node in structure:
+            if not isinstance(node, list):
+                break
+            children.append(node)
+        subtype = _text(structure[len(children)]).lower() if len(structure) > len(children) else ""
+        leaves = []
+        for index, node in enumerate(children, start=1):
+            section = f"{prefix}.{index}" if prefix else str(index)
+            leaves.extend(walk_bodystructure(node, section, subtype))
+        return leaves
+
+    main_type = _text(structure[0]).lower()
+    sub_type = _text(structure[1]).lower() if len(structure) > 1 else ""
+    params = _params(structure[2] if len(structure) > 2 else None)
+    encoding = _text(structure[5]).lower() if len(structure) > 5 else "7bit"
+    try:
+        size = int(_text(structure[6])) if len(structure) > 6 else 0
+    except ValueError:
+        size = 0
+
+    # text/* 在 size 之后多一个行数字段，message/rfc822 多 envelope/body/行数 三个字段
+    ext_start = 7
+    if main_type == "text":
+        ext_start = 8
+    elif main_type == "message" and sub_type == "rfc822":
+        ext_start = 10
+    disposition, disposition_params = "", {}
+    if len(structure) > ext_start + 1 and isinstance(structure[ext_start + 1], list):
+        disp = structure[ext_start + 1]
+        disposition = _text(disp[0]).lower() if disp else ""
+        disposition_params = _params(disp[1] if len(disp) > 1 else None)
+
+    filename = disposition_params.get("filename") or params.get("name") or ""
+    return [{
+        "section": prefix or "1",
+        "content_type": f"{main_type}/{sub_type}",
+        "charset": params.get("charset", "utf-8"),
+        "encoding": encoding,
+        "size": size,
+        "filename": filename,
+        "disposition": disposition,
+        "alternative": parent_subtype == "alternative",
+    }]
+
+
+def is_body_text(part: Dict) -> bool:
+    """正文候选：text/plain 或 text/html，且不是以附件形式挂载的文件"""
+    return part["content_type"] in ("text/plain", "text/html") and part["disposition"] != "attachment" \
+        and not part["filename"]
+
+
+def decode_partial(payload: bytes, encoding: str, charset: Optional[str]) -> str:
+    """解码被 <0.N> 截断过的正文片段，截断点可能落在 base64 分组或多字节字符中间"""
+    if not payload:
+        return ""
+    encoding = (encoding or "").lower()
+    if encoding == "base64":
+        compact = b"".join(payload.split())
+        compact = compact[:len(compact) - len(compact) % 4]
+        try:
+            payload = base64.b64decode(compact)
+        except (binascii.Error, ValueError):
+            payload = b""
+    elif encoding == "quoted-printable":
+        # 截断点落在 =XX 转义中间时，去掉残缺的转义，否则 "=E" 会原样留在正文里
+        payload = quopri.decodestring(re.sub(rb"=[0-9A-Fa-f]?$", b"", payload))
+    try:
+        return payload.decode(charset or "utf-8", errors="ignore")
+    except LookupError:
+        return payload.decode("utf-8", errors="ignore")
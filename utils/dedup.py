@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 指纹存在 SQLite 里，进程重启后 TTL 内再抓到同样内容的邮件也能认出来
+DEDUP_PATH = os.getenv("DEDUP_PATH") or os.path.normpath(os.path.join(CURRENT_DIR, "..", "inbound_dedup.db"))
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "3600"))
+# 每登记这么多次顺手清一遍过期的指纹
+DEDUP_EVICT_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    fingerprint TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_seen_expires ON seen(expires_at);
+"""
+
+
+class InboundDeduper:
+    """
+    入站邮件去重：按内容指纹记录最近一次接手它的 thread_id，TTL 内再来同样内容的邮件直接短路，
+    不再进入 triage_router 调用 LLM。path=":memory:" 时只在本进程内有效。
+    """
+
+    def __init__(self, path: str = DEDUP_PATH, ttl_seconds: int = DEDUP_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._claims = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def claim(self, fingerprint: str, thread_id: str) -> Optional[str]:
+        """
+        第一次见到该指纹时登记并返回 None，调用方继续处理；
+        TTL 内重复出现时返回最初处理它的 thread_id，调用方应跳过。
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT thread_id FROM seen WHERE fingerprint = ? AND expires_at > ?", (fingerprint, now)
+            ).fetchone()
+            if row:
+                return row[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO seen (fingerprint, thread_id, expires_at) VALUES (?, ?, ?)",
+                (fingerprint, thread_id, now + self.ttl_seconds),
+            )
+            self._claims += 1
+            if self._claims % DEDUP_EVICT_EVERY == 0:
+                self._conn.execute("DELETE FROM seen WHERE expires_at <= ?", (now,))
+            return None
+
+    def release(self, fingerprint: str):
+        """处理失败时释放指纹，允许下一次重新处理"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM seen WHERE fingerprint = ?", (fingerprint,))
+
+
+_default_deduper: Optional[InboundDeduper] = None
+_default_deduper_lock = threading.Lock()
+
+
+def get_inbound_deduper() -> InboundDeduper:
+    global _default_deduper
+    with _default_deduper_lock:
+        if _default_deduper is None:
+            _default_deduper = InboundDeduper()
+        return _default_deduper
+
+
+# 飞书卡片回调超时会重投，重投的 event_id 不变，按 event_id 去重；重投只发生在几秒内，不需要落盘
+card_event_deduper = InboundDeduper(path=":memory:")
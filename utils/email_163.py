@@ -1,15 +1,37 @@
 import email
 import imaplib
+import json
 import os
+import re
+import threading
 from email.header import decode_header
-from typing import Dict, Union
+from email.parser import BytesHeaderParser
+from typing import Dict, List, Optional, Union
 
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-import uuid
+
+from utils.body_clean import select_best_body, PLAIN_STUB_CHARS
+from utils.bodystructure import parse_fetch_response, walk_bodystructure, is_body_text, decode_partial
+from utils.imap_pool import get_imap_pool
+from utils.mail_index import get_mail_index
+from utils.mail_mirror import get_mail_mirror, derive_conversation_id, message_thread_id
 
 load_dotenv()
 
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SYNC_CURSOR_FILE = os.path.normpath(os.path.join(CURRENT_DIR, "..", "imap_sync_cursor.json"))
+SYNC_BATCH_LIMIT = int(os.getenv("IMAP_SYNC_BATCH_LIMIT", "20"))
+# 单封抓取/解析失败的 UID 记在游标的重试列表里，之后每次同步重试，超过这个次数才放弃
+SYNC_MAX_RETRIES = int(os.getenv("IMAP_SYNC_MAX_RETRIES", "5"))
+# 分拣只需要正文开头几 KB，每个正文分段最多下载这么多字节
+BODY_PEEK_BYTES = int(os.getenv("IMAP_BODY_PEEK_BYTES", "8192"))
+# 后三个是群发/自动邮件的标记，规则分拣和本地分拣模型都要用到
+HEADER_FIELDS = ("FROM TO SUBJECT DATE MESSAGE-ID IN-REPLY-TO REFERENCES "
+                 "LIST-UNSUBSCRIBE PRECEDENCE AUTO-SUBMITTED")
+
+# 同一进程内多个 webhook 同时触发同步时，保证游标的读-改-写不会交错
+_sync_lock = threading.Lock()
+
 
 def smart_decode(header_text):
     """安全地解码邮件头信息（处理 =?utf-8?B?...= 乱码）"""
@@ -28,79 +50,244 @@ def smart_decode(header_text):
         return str(header_text)
 
 
+def parse_raw_email(raw_email_bytes: bytes) -> Dict:
+    """把 RFC822 原始字节解析成 EmailDetail 需要的字典"""
+    msg = email.message_from_bytes(raw_email_bytes)
+
+    parts = []
+    for part in msg.walk():
+        content_type = part.get_content_type()
+        if content_type in ["text/plain", "text/html"] and not part.get_filename():
+            payload = part.get_payload(decode=True) or b""
+            parts.append((content_type, decode_partial(payload, "8bit", part.get_content_charset())))
+
+    return _build_email_dict(msg, select_best_body(parts))
+
+
+def _build_email_dict(msg, body_text: str) -> Dict:
+    subject = smart_decode(msg.get("Subject", ""))
+    author = smart_decode(msg.get("From", ""))
+
+    raw_to = msg.get("To", "")
+    to_address = smart_decode(raw_to) if raw_to else "Me"
+
+    email_data = {
+        "author": author,  # 发件人
+        "to": to_address,  # 收件人
+        "subject": subject,  # 主题
+        "email_thread": body_text,  # 清洗后的正文
+        "message_id": (msg.get("Message-ID") or "").strip(),
+        "date": (msg.get("Date") or "").strip(),
+        # HEADER_FIELDS 里抓到的所有头（含 list-unsubscribe / precedence / auto-submitted），字段名统一小写
+        "headers": {name.lower(): smart_decode(value) for name, value in msg.items()},
+    }
+    # 每封来信一个 checkpoint thread，重复抓取同一封邮件会得到同一个 thread_id；会话 ID 由 References 推导
+    email_data["thread_id"] = message_thread_id(email_data)
+    email_data["conversation_id"] = derive_conversation_id(email_data)
+    return email_data
+
+
+def _imap_fetch(mail, msg_id, query: str, use_uid: bool):
+    if use_uid:
+        return mail.uid('FETCH', str(msg_id), query)
+    return mail.fetch(msg_id, query)
+
+
+def _fetch_text_parts(mail, msg_id, parts: List[Dict], use_uid: bool, max_bytes: int) -> List[tuple]:
+    """一条 FETCH 命令按字节上限取回多个正文分段，返回 [(content_type, 解码后的文本)]"""
+    query = "(" + " ".join(f"BODY.PEEK[{part['section']}]<0.{max_bytes}>" for part in parts) + ")"
+    res, data = _imap_fetch(mail, msg_id, query, use_uid)
+    if res != 'OK':
+        raise RuntimeError(f"邮件 {msg_id} 的正文抓取失败")
+    body_fields = parse_fetch_response(data)
+    return [
+        (part["content_type"],
+         decode_partial(body_fields.get(f"BODY[{part['section']}]<0>"), part["encoding"], part["charset"]))
+        for part in parts
+    ]
+
+
+def fetch_email_partial(mail, msg_id, use_uid: bool = True, max_bytes: int = BODY_PEEK_BYTES) -> Dict:
+    """
+    先只取 BODYSTRUCTURE 和关键邮件头，再用 BODY.PEEK[section]<0.N> 按字节上限下载正文分段，
+    附件一律不下载，只在 skipped_attachments 里记录下来。PEEK 不会把邮件标记为已读。
+    服务器不返回 BODYSTRUCTURE 时退回到整封 RFC822 下载。
+    """
+    res, data = _imap_fetch(mail, msg_id, f"(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])", use_uid)
+    if res != 'OK' or not data or data[0] is None:
+        raise RuntimeError(f"邮件 {msg_id} 的结构信息抓取失败")
+
+    fields = parse_fetch_response(data)
+    structure = fields.get("BODYSTRUCTURE")
+    if not isinstance(structure, list):
+        res, data = _imap_fetch(mail, msg_id, "(RFC822)", use_uid)
+        if res != 'OK' or not data or not isinstance(data[0], tuple):
+            raise RuntimeError(f"邮件 {msg_id} 抓取失败")
+        return parse_raw_email(data[0][1])
+
+    header_bytes = next((v for k, v in fields.items() if k.startswith("BODY[HEADER")), None)
+    msg = BytesHeaderParser().parsebytes(header_bytes if isinstance(header_bytes, bytes) else b"")
+
+    parts = walk_bodystructure(structure)
+    text_parts = [part for part in parts if is_body_text(part)]
+    plain_parts = [part for part in text_parts if part["content_type"] == "text/plain"]
+    html_parts = [part for part in text_parts if part["content_type"] == "text/html"]
+
+    # 优先只下载纯文本；纯文本不存在或只是 "请用 HTML 客户端查看" 之类的占位时才补拉 HTML
+    body_text = ""
+    if plain_parts:
+        body_text = select_best_body(_fetch_text_parts(mail, msg_id, plain_parts, use_uid, max_bytes))
+    if len(body_text) < PLAIN_STUB_CHARS and html_parts:
+        body_text = select_best_body(_fetch_text_parts(mail, msg_id, html_parts, use_uid, max_bytes)) or body_text
+
+    email_data = _build_email_dict(msg, body_text)
+    if str(fields.get("UID", "")).isdigit():
+        email_data["uid"] = int(fields["UID"])
+    email_data["skipped_attachments"] = [
+        {
+            "filename": smart_decode(part["filename"]) if part["filename"] else "",
+            "content_type": part["content_type"],
+            "size": part["size"],
+        }
+        for part in parts if not is_body_text(part)
+    ]
+    return email_data
+
+
 def fetch_latest_163_email() -> Union[Dict, str]:
     """
     连接到 163 邮箱，抓取并清洗最新的一封邮件。
     返回包含解码后的主题、发件人和纯文本正文的字典。
     """
-    imap_server = "imap.163.com"
-    email_user = os.getenv("MAIL_USER")
-    password = os.getenv("MAIL_PASS")
-
     try:
+        with get_imap_pool().session() as mail:
+            latest_uid = _latest_uid(mail)
+            if not latest_uid:
+                return "收件箱中没有找到任何邮件。"
 
-        mail = imaplib.IMAP4_SSL(imap_server, 993)
-        if 'ID' not in imaplib.Commands:
-            imaplib.Commands['ID'] = ('AUTH')
-        mail.login(email_user, password)
+            email_data = fetch_email_partial(mail, latest_uid)
+            email_data["uid"] = latest_uid
 
-        id_info = '("name" "python-imap" "version" "1.0.0" "vendor" "myclient")'
-        mail._simple_command('ID', id_info)
-        mail.select("INBOX")
+        mirror = get_mail_mirror()
+        email_data["conversation_id"] = mirror.resolve_conversation_id(email_data)
+        email_data["mirror_id"] = mirror.save_email(email_data)
+        get_mail_index().sync()
+        return email_data
 
-        mail.check()
+    except Exception as e:
+        return f"读取邮件时发生错误: {str(e)}"
 
-        status, messages = mail.search(None, 'ALL')
-        if status != 'OK' or not messages[0]:
-            return "收件箱中没有找到任何邮件。"
 
-        latest_email_id = messages[0].split()[-1]
-        res, msg_data = mail.fetch(latest_email_id, "(RFC822)")
+def load_sync_cursor() -> Optional[Dict]:
+    """读取上次同步到的位置：{"uidvalidity": int, "last_uid": int, "retry": {"uid": 已失败次数}}"""
+    if not os.path.exists(SYNC_CURSOR_FILE):
+        return None
+    try:
+        with open(SYNC_CURSOR_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        if res != 'OK':
-            return "邮件抓取失败。"
 
-        raw_email_bytes = msg_data[0][1]
-        msg = email.message_from_bytes(raw_email_bytes)
+def save_sync_cursor(cursor: Dict):
+    """先写临时文件再 rename，进程中途崩溃也不会留下半截的游标文件"""
+    tmp_path = SYNC_CURSOR_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cursor, f)
+    os.replace(tmp_path, SYNC_CURSOR_FILE)
 
-        subject = smart_decode(msg.get("Subject", ""))
-        author = smart_decode(msg.get("From", ""))
 
-        raw_body = ""
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                # 优先寻找纯文本，如果没有则取 HTML
-                if content_type in ["text/plain", "text/html"]:
-                    payload = part.get_payload(decode=True)
-                    charset = part.get_content_charset() or "utf-8"
-                    raw_body += payload.decode(charset, errors="ignore")
-        else:
-            raw_body = msg.get_payload(decode=True).decode(msg.get_content_charset() or "utf-8", errors="ignore")
+def _get_uid_state(mail) -> tuple:
+    """用 STATUS 读取收件箱当前的 UIDVALIDITY 和 UIDNEXT"""
+    status, data = mail.status("INBOX", "(UIDVALIDITY UIDNEXT)")
+    if status != 'OK' or not data or not data[0]:
+        raise RuntimeError("无法获取收件箱的 UID 状态")
+    raw = data[0].decode() if isinstance(data[0], bytes) else str(data[0])
+    uidvalidity = int(re.search(r"UIDVALIDITY (\d+)", raw).group(1))
+    uidnext = int(re.search(r"UIDNEXT (\d+)", raw).group(1))
+    return uidvalidity, uidnext
 
-        soup = BeautifulSoup(raw_body, "html.parser")
-        for script_or_style in soup(["script", "style"]):
-            script_or_style.decompose()
 
-        clean_text = soup.get_text(separator="\n")
-        final_body = "\n".join([line.strip() for line in clean_text.splitlines() if line.strip()])
+def _latest_uid(mail) -> int:
+    """
+    收件箱里当前最大的 UID，空收件箱返回 0。"UID *" 只返回这一个 UID，不用把整个收件箱的序号都列出来。
+    UID 不保证连续（最新的几封被删掉后 UIDNEXT 不会回退），不能用 UIDNEXT - 1 代替。
+    """
+    status, data = mail.uid('SEARCH', None, 'UID *')
+    if status != 'OK':
+        raise RuntimeError("无法获取收件箱最新邮件的 UID")
+    uids = data[0].split() if data and data[0] else []
+    return int(uids[-1]) if uids else 0
 
-        raw_to = msg.get("To", "")
-        to_address = smart_decode(raw_to) if raw_to else "Me"
 
-        mail.logout()
+def _fetch_uids(mail, uids: List[int], retry: Dict[str, int]) -> List[Dict]:
+    """
+    逐封抓取。单封失败不能卡住游标（否则后面的新邮件永远同步不下来），也不能就此丢掉：
+    记进 retry，下次同步再试，连续失败 SYNC_MAX_RETRIES 次才放弃。成功的从 retry 里移除。
+    """
+    results = []
+    for uid in uids:
+        try:
+            email_data = fetch_email_partial(mail, uid)
+        except (imaplib.IMAP4.abort, OSError):
+            # 连接已断，交给外层处理，本批次已抓到的邮件不推进游标
+            raise
+        except Exception as e:
+            attempts = retry.get(str(uid), 0) + 1
+            if attempts >= SYNC_MAX_RETRIES:
+                retry.pop(str(uid), None)
+                print(f"UID {uid} 已连续 {attempts} 次抓取失败，放弃: {e}")
+            else:
+                retry[str(uid)] = attempts
+                print(f"UID {uid} 抓取失败（第 {attempts} 次），下次同步重试: {e}")
+            continue
+        retry.pop(str(uid), None)
+        email_data["uid"] = uid
+        results.append(email_data)
+    return results
 
-        new_thread_id = str(uuid.uuid4())
-        return {
-            "author": author,  # 发件人
-            "to": to_address,  # 收件人
-            "subject": subject,  # 主题
-            "email_thread": final_body.strip(),  # 清洗后的正文
-            "thread_id": new_thread_id
-        }
 
-    except Exception as e:
-        return f"读取邮件时发生错误: {str(e)}"
+def fetch_new_163_emails(limit: int = SYNC_BATCH_LIMIT) -> Union[List[Dict], str]:
+    """
+    增量同步：只抓取游标之后新到达的邮件，每封邮件只会被返回一次。
+    首次运行（或 UIDVALIDITY 变化导致旧游标失效）时只处理最新的一封，避免把整个收件箱重跑一遍。
+    单次最多返回 limit 封，剩下的留给下一次同步；之前抓取失败的 UID 先重试，不占 limit。
+    游标在邮件落进本地镜像后就推进，不等流程跑完；流程没跑完的邮件由调用方从镜像里按处理状态找回来重跑。
+    """
+    with _sync_lock:
+        try:
+            cursor = load_sync_cursor()
+            with get_imap_pool().session() as mail:
+                uidvalidity, uidnext = _get_uid_state(mail)
+                if not cursor or cursor.get("uidvalidity") != uidvalidity:
+                    cursor = {"uidvalidity": uidvalidity, "last_uid": max(_latest_uid(mail) - 1, 0)}
+                retry = cursor.setdefault("retry", {})
+                results = _fetch_uids(mail, sorted(int(uid) for uid in retry), retry)
+
+                last_uid = cursor["last_uid"]
+                new_uids = []
+                if uidnext - 1 > last_uid:
+                    status, data = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+                    if status != 'OK':
+                        return "增量搜索新邮件失败。"
+                    # "n:*" 在没有新邮件时仍会返回当前最大的 UID，需要再过滤一次
+                    new_uids = sorted(int(uid) for uid in data[0].split() if int(uid) > last_uid)[:limit]
+                    results += _fetch_uids(mail, new_uids, retry)
+
+            # 先落本地镜像再推进游标，之后的重放、重新分拣都不需要再访问 IMAP
+            mirror = get_mail_mirror()
+            for email_data in results:
+                email_data["conversation_id"] = mirror.resolve_conversation_id(email_data)
+                email_data["mirror_id"] = mirror.save_email(email_data)
+            get_mail_index().sync()
+
+            if new_uids:
+                cursor["last_uid"] = new_uids[-1]
+            save_sync_cursor(cursor)
+            return results
+
+        except Exception as e:
+            return f"增量同步邮件时发生错误: {str(e)}"
 
 
 if __name__ == "__main__":
@@ -117,6 +304,8 @@ if __name__ == "__main__":
         print(f"发件人: {result.get('author')}")
         print(f"收件人: {result.get('to')}")
         print(f"主 题: {result.get('subject')}")
+        for attachment in result.get("skipped_attachments", []):
+            print(f"未下载附件: {attachment['filename'] or '(无文件名)'} [{attachment['content_type']}, {attachment['size']} 字节]")
         print("-" * 20)
         print("正文预览 (前 200 字):")
 
@@ -0,0 +1,327 @@
+"""
+本地假 IMAP 服务器，只实现本项目用到的命令：CAPABILITY / LOGIN / ID / SELECT / NOOP / STATUS /
+SEARCH / UID SEARCH / UID FETCH / LOGOUT。UID FETCH 支持 UID、RFC822、BODYSTRUCTURE 和
+BODY.PEEK[HEADER.FIELDS (...)] / BODY.PEEK[section]<0.N>；BODYSTRUCTURE 按邮件内容现场生成，
+含非 ASCII 字符的字符串（比如中文附件名）和真实服务器一样以字面量 {n} 发送。
+
+用于测试连接池和增量同步，不需要真实的 163 账号：
+    server = FakeIMAPServer().start()
+    IMAP_SERVER=127.0.0.1 IMAP_PORT=<server.port> IMAP_USE_SSL=0
+
+用法: python -m utils.fake_imap [端口]
+"""
+import email
+import re
+import socket
+import socketserver
+import sys
+import threading
+from email.message import Message
+from typing import Dict, List, Optional
+
+
+def _string(value) -> bytes:
+    """IMAP 字符串：NIL、带引号的字符串，或者含非 ASCII / 引号时用字面量"""
+    if value is None:
+        return b"NIL"
+    raw = str(value).encode("utf-8")
+    if not raw.isascii() or b'"' in raw or b"\\" in raw:
+        return b"{%d}\r\n" % len(raw) + raw
+    return b'"' + raw + b'"'
+
+
+def _string_list(pairs) -> bytes:
+    if not pairs:
+        return b"NIL"
+    return b"(" + b" ".join(_string(k) + b" " + _string(v) for k, v in pairs) + b")"
+
+
+def _raw_payload(part: Message) -> bytes:
+    """分段在邮件里的原始（仍是传输编码后的）内容，BODY[section] 返回的就是它"""
+    payload = part.get_payload()
+    return payload.encode("utf-8", errors="surrogateescape") if isinstance(payload, str) else b""
+
+
+def _bodystructure(part: Message) -> bytes:
+    if part.is_multipart():
+        children = b"".join(_bodystructure(child) for child in part.get_payload())
+        return b"(" + children + b" " + _string(part.get_content_subtype().upper()) + b")"
+    params = [(k.upper(), v) for k, v in part.get_params()[1:]] if part.get_params() else []
+    if part.get_filename() and not any(k == "NAME" for k, _ in params):
+        params.append(("NAME", part.get_filename()))
+    payload = _raw_payload(part)
+    fields = [
+        _string(part.get_content_maintype().upper()), _string(part.get_content_subtype().upper()),
+        _string_list(params), b"NIL", b"NIL",
+        _string(part.get("Content-Transfer-Encoding", "7BIT").upper()), str(len(payload)).encode(),
+    ]
+    if part.get_content_maintype() == "text":
+        fields.append(str(payload.count(b"\n")).encode())
+    disposition = part.get_content_disposition()
+    filename = part.get_filename()
+    fields.append(b"NIL")  # body MD5
+    fields.append(b"(" + _string(disposition.upper()) + b" " + _string_list([("FILENAME", filename)] if filename else [])
+                  + b")" if disposition else b"NIL")
+    return b"(" + b" ".join(fields) + b")"
+
+
+def _section(message: Message, section: str) -> Optional[Message]:
+    """按 "1" / "2.1" 这样的编号找到分段；单段邮件的 "1" 就是邮件本身"""
+    part = message
+    for index in section.split("."):
+        if not part.is_multipart():
+            return part if index == "1" else None
+        children = part.get_payload()
+        if not index.isdigit() or not 1 <= int(index) <= len(children):
+            return None
+        part = children[int(index) - 1]
+    return part
+
+
+def _header_fields(raw: bytes, names: List[str]) -> bytes:
+    headers = raw.split(b"\r\n\r\n", 1)[0].split(b"\r\n")
+    wanted = {name.upper() for name in names}
+    lines, keep = [], False
+    for line in headers:
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                lines.append(line)
+            continue
+        keep = line.split(b":", 1)[0].decode(errors="ignore").upper() in wanted
+        if keep:
+            lines.append(line)
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.selected = False
+        with self.server.fake.lock:
+            self.server.fake.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.fake.lock:
+            self.server.fake.connections.discard(self.connection)
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+    def send(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def fetch_items(self, uid: int, raw: bytes, query: str) -> bytes:
+        """按 FETCH 的数据项拼出括号里的内容，字面量直接嵌在里面"""
+        fake = self.server.fake
+        message = email.message_from_bytes(raw)
+        items = [b"UID %d" % uid]
+        if re.search(r"\bRFC822\b(?!\.)", query):
+            items.append(b"RFC822 {%d}\r\n" % len(raw) + raw)
+        if "BODYSTRUCTURE" in query.upper() and fake.bodystructure:
+            items.append(b"BODYSTRUCTURE " + _bodystructure(message))
+        for section, origin, length in re.findall(r"BODY\.PEEK\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", query):
+            if section.upper().startswith("HEADER.FIELDS"):
+                content = _header_fields(raw, re.findall(r"[\w-]+", section[len("HEADER.FIELDS"):]))
+            else:
+                part = _section(message, section)
+                content = _raw_payload(part) if part is not None else b""
+            key = f"BODY[{section}]"
+            if origin:
+                content = content[int(origin):int(origin) + int(length)]
+                key += f"<{origin}>"
+            items.append(key.encode() + b" {%d}\r\n" % len(content) + content)
+        return b" ".join(items)
+
+    def handle(self):
+        fake = self.server.fake
+        self.send("* OK fake IMAP4rev1 ready")
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+            if not line:
+                return
+            parts = line.decode(errors="ignore").rstrip("\r\n").split(" ", 2)
+            if len(parts) < 2:
+                continue
+            tag, command, args = parts[0], parts[1].upper(), parts[2] if len(parts) > 2 else ""
+            with fake.lock:
+                fake.commands.append(command)
+            if command == "LOGOUT":
+                self.send("* BYE logging out")
+                self.send(f"{tag} OK LOGOUT completed")
+                return
+            handler = getattr(self, f"cmd_{command.lower()}", None)
+            if handler is None:
+                self.send(f"{tag} BAD unknown command {command}")
+                continue
+            handler(tag, args)
+
+    def cmd_capability(self, tag: str, args: str):
+        self.send("* CAPABILITY IMAP4rev1" + (" ID" if self.server.fake.support_id else ""))
+        self.send(f"{tag} OK CAPABILITY completed")
+
+    def cmd_login(self, tag: str, args: str):
+        fake = self.server.fake
+        user, _, password = args.partition(" ")
+        if user.strip('"') != fake.user or password.strip('"') != fake.password:
+            self.send(f"{tag} NO LOGIN failed")
+            return
+        with fake.lock:
+            fake.logins += 1
+        self.send(f"{tag} OK LOGIN completed")
+
+    def cmd_id(self, tag: str, args: str):
+        if not self.server.fake.support_id:
+            self.send(f"{tag} BAD unknown command ID")
+            return
+        self.send('* ID ("name" "fake-imap")')
+        self.send(f"{tag} OK ID completed")
+
+    def cmd_select(self, tag: str, args: str):
+        fake = self.server.fake
+        self.selected = True
+        self.send(f"* {len(fake.messages)} EXISTS")
+        self.send(f"* OK [UIDVALIDITY {fake.uidvalidity}] UIDs valid")
+        self.send(f"* OK [UIDNEXT {fake.uidnext}] next UID")
+        self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+
+    def cmd_noop(self, tag: str, args: str):
+        self.send(f"{tag} OK NOOP completed")
+
+    def cmd_status(self, tag: str, args: str):
+        fake = self.server.fake
+        self.send(f"* STATUS INBOX (UIDVALIDITY {fake.uidvalidity} UIDNEXT {fake.uidnext})")
+        self.send(f"{tag} OK STATUS completed")
+
+    def cmd_search(self, tag: str, args: str):
+        seqs = range(1, len(self.server.fake.messages) + 1)
+        self.send("* SEARCH " + " ".join(str(seq) for seq in seqs))
+        self.send(f"{tag} OK SEARCH completed")
+
+    def cmd_uid(self, tag: str, args: str):
+        fake = self.server.fake
+        sub, _, rest = args.partition(" ")
+        uids = fake.uids()
+        if sub.upper() == "SEARCH":
+            # 只支持 "ALL"、"UID *" 和 "UID n:*"，和 RFC 一样 "n:*" 至少返回最大的 UID
+            match = re.search(r"UID (\d+|\*)(?::\*)?", rest)
+            if match and match.group(1) == "*":
+                found = uids[-1:]
+            elif match:
+                found = [uid for uid in uids if uid >= int(match.group(1))] or uids[-1:]
+            else:
+                found = uids
+            self.send("* SEARCH " + " ".join(str(uid) for uid in found))
+            self.send(f"{tag} OK SEARCH completed")
+        elif sub.upper() == "FETCH":
+            uid = int(rest.split(" ", 1)[0])
+            with fake.lock:
+                failing = fake.fail_fetch.get(uid, 0)
+                if failing:
+                    fake.fail_fetch[uid] = failing - 1
+            if failing or uid not in fake.messages:
+                self.send(f"{tag} NO FETCH failed")
+                return
+            query = rest.split(" ", 1)[1] if " " in rest else ""
+            self.wfile.write(b"* %d FETCH (" % (uids.index(uid) + 1) + self.fetch_items(uid, fake.messages[uid], query)
+                             + b")\r\n")
+            self.send(f"{tag} OK FETCH completed")
+        else:
+            self.send(f"{tag} BAD unsupported UID command")
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeIMAPServer:
+    """
+    在后台线程里监听 127.0.0.1 的明文 IMAP 服务器。
+    logins 统计登录次数（连接池复用时不会增加），drop_connections() 模拟服务器踢掉空闲连接，
+    fail_fetch[uid] = n 让该 UID 接下来 n 次 FETCH 返回 NO。
+    UID 和真实服务器一样只增不减，delete_message() 删掉最新的邮件后 UIDNEXT 不会回退。
+    bodystructure=False 时 FETCH 不返回 BODYSTRUCTURE，用来测客户端退回整封 RFC822 下载的路径。
+    """
+
+    def __init__(self, user: str = "me@163.com", password: str = "secret", port: int = 0,
+                 support_id: bool = True, bodystructure: bool = True):
+        self.user = user
+        self.password = password
+        self.support_id = support_id
+        self.bodystructure = bodystructure
+        self.uidvalidity = 1
+        self.next_uid = 1
+        self.messages: Dict[int, bytes] = {}
+        self.fail_fetch: Dict[int, int] = {}
+        self.logins = 0
+        self.commands: List[str] = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        self._server = _ThreadingServer(("127.0.0.1", port), _IMAPHandler)
+        self._server.fake = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    @property
+    def uidnext(self) -> int:
+        return self.next_uid
+
+    def uids(self) -> List[int]:
+        with self.lock:
+            return sorted(self.messages)
+
+    def add_message(self, raw: bytes) -> int:
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages[uid] = raw
+        return uid
+
+    def delete_message(self, uid: int):
+        with self.lock:
+            self.messages.pop(uid, None)
+
+    def reset_mailbox(self, uidvalidity: int):
+        """模拟服务器重建邮箱：UIDVALIDITY 变化，已有邮件清空，UID 从 1 重新分配"""
+        with self.lock:
+            self.uidvalidity = uidvalidity
+            self.messages.clear()
+            self.next_uid = 1
+
+    def drop_connections(self):
+        """直接关掉所有客户端连接，客户端下一条命令会读到 EOF"""
+        with self.lock:
+            connections = list(self.connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start(self) -> "FakeIMAPServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeIMAPServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 1143)
+    server.add_message(b"From: a@example.com\r\nTo: me@163.com\r\nSubject: hello\r\n\r\nfake imap\r\n")
+    print(f"假 IMAP 服务器已启动: 127.0.0.1:{server.port}，账号 {server.user} / {server.password}，Ctrl+C 退出")
+    server.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,97 @@
+"""
+基于 aiosmtpd 的本地假 SMTP 服务器：收到的邮件只记在内存里，不会真的发出。
+可以让接下来几次 DATA 返回 451 临时错误、对指定收件人返回 550，用来测发件箱的重试、退避和限流。
+
+    server = FakeSMTPServer().start()
+    SMTP_SERVER=127.0.0.1 SMTP_PORT=<server.port> SMTP_USE_SSL=0
+
+用法: python -m utils.fake_smtp [端口]
+"""
+import socket
+import sys
+import threading
+import time
+from email import message_from_bytes
+from email.header import decode_header, make_header
+from typing import Dict, List, Set
+
+from aiosmtpd.controller import Controller
+
+
+def _free_port() -> int:
+    # aiosmtpd 的 Controller 启动时要按端口号回连自检，不能直接传 0
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _RecordingHandler:
+    def __init__(self, fake: "FakeSMTPServer"):
+        self.fake = fake
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.fake.reject:
+            return "550 5.1.1 mailbox unavailable"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        fake = self.fake
+        with fake.lock:
+            fake.attempt_times.append(time.monotonic())
+            if fake.fail_next > 0:
+                fake.fail_next -= 1
+                return "451 4.3.0 try again later"
+            message = message_from_bytes(envelope.content)
+            fake.messages.append({
+                "peer": session.peer,
+                "from": envelope.mail_from,
+                "to": list(envelope.rcpt_tos),
+                "subject": str(make_header(decode_header(message.get("Subject", "")))),
+                "message_id": message.get("Message-ID"),
+                "received_at": time.monotonic(),
+            })
+        return "250 OK"
+
+
+class FakeSMTPServer:
+    """
+    在 127.0.0.1 上监听的明文 SMTP 服务器。
+    messages 按收到的顺序记录 peer / from / to / subject / message_id，同一个 peer 说明复用了同一条连接；
+    attempt_times 记录每次 DATA 的时间，包括被 fail_next 拒掉的那几次。
+    """
+
+    def __init__(self, port: int = 0):
+        self.fail_next = 0
+        self.reject: Set[str] = set()
+        self.messages: List[Dict] = []
+        self.attempt_times: List[float] = []
+        self.lock = threading.Lock()
+        self._running = False
+        self._controller = Controller(_RecordingHandler(self), hostname="127.0.0.1", port=port or _free_port())
+
+    @property
+    def port(self) -> int:
+        return self._controller.port
+
+    def start(self) -> "FakeSMTPServer":
+        self._controller.start()
+        self._running = True
+        return self
+
+    def stop(self):
+        if self._running:
+            self._controller.stop()
+            self._running = False
+
+
+if __name__ == '__main__':
+    server = FakeSMTPServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 1025).start()
+    print(f"假 SMTP 服务器已启动: 127.0.0.1:{server.port}，Ctrl+C 退出")
+    try:
+        while True:
+            time.sleep(5)
+            with server.lock:
+                print(f"已收到 {len(server.messages)} 封")
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,4 +1,23 @@
+import hashlib
 import json
+import os
+import threading
+from email.utils import parseaddr
+
+from utils.body_clean import normalize_body
+
+# 各节点里邮件正文最多占用的 token 数：分拣只需要看个大概，起草回信需要更多上下文
+TRIAGE_TOKEN_BUDGET = int(os.getenv("TRIAGE_TOKEN_BUDGET", "1500"))
+DRAFT_TOKEN_BUDGET = int(os.getenv("DRAFT_TOKEN_BUDGET", "3000"))
+# 起草回信时附上同一会话里之前的几封来信，每封最多占用的 token 数
+CONVERSATION_HISTORY_LIMIT = int(os.getenv("CONVERSATION_HISTORY_LIMIT", "3"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "400"))
+# 超出预算时保留开头的比例，其余留给结尾（落款、截止日期常常在最后）
+HEAD_RATIO = 0.7
+ELISION_MARKER = "\n……（中间省略约 {count} 个 token）……\n"
+
+_encoding = None
+_encoding_lock = threading.Lock()
 
 
 def parse_email(email_input: dict) -> tuple:
@@ -14,6 +33,95 @@ def parse_email(email_input: dict) -> tuple:
     )
 
 
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算 token 数：汉字大约 1 字 1 个 token，其余字符大约 4 个 1 个 token。
+    tiktoken 词表不可用时 count_tokens 退回到这里。
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def _get_encoding():
+    """tiktoken 第一次使用时需要下载词表，离线环境拿不到时退回 estimate_tokens"""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print(f"tiktoken 不可用，改用估算的 token 数: {e}")
+                _encoding = False
+        return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """本地计算 token 数（gpt-4o 系列的 o200k_base 词表）"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    return len(encoding.encode(text, disallowed_special=())) if encoding else estimate_tokens(text)
+
+
+def _take_tokens(text: str, count: int, from_end: bool = False) -> str:
+    """取开头或结尾的 count 个 token 对应的文本"""
+    if count <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        piece = tokens[-count:] if from_end else tokens[:count]
+        return encoding.decode(piece).strip("\ufffd")
+    # 没有词表时按整段文本的 token 密度换算成字符数
+    chars = max(1, int(len(text) * count / max(estimate_tokens(text), 1)))
+    return text[-chars:] if from_end else text[:chars]
+
+
+def truncate_middle(text: str, budget: int) -> str:
+    """超出预算时保留头尾、中间换成省略标记，保证结果不超过 budget 个 token"""
+    total = count_tokens(text)
+    if total <= budget:
+        return text
+    keep = max(budget - count_tokens(ELISION_MARKER.format(count=total)), 0)
+    result = ""
+    # 估算模式下按字符换算会有少量误差，超了就按超出的量收缩后重来
+    for _ in range(3):
+        head_count = int(keep * HEAD_RATIO)
+        tail_count = keep - head_count
+        head = _take_tokens(text, head_count)
+        tail = _take_tokens(text, tail_count, from_end=True)
+        result = head + ELISION_MARKER.format(count=total - head_count - tail_count) + tail
+        overflow = count_tokens(result) - budget
+        if overflow <= 0:
+            break
+        keep = max(keep - overflow, 0)
+    return result
+
+
+def compact_email_thread(email_thread: str, budget: int) -> str:
+    """
+    拼进提示词之前压缩邮件正文：先去掉引用的历史邮件和签名，仍然超出预算再截掉中间部分。
+    """
+    if not email_thread:
+        return ""
+    stripped = normalize_body(email_thread, "text/plain", max_chars=len(email_thread)) or email_thread
+    return truncate_middle(stripped, budget)
+
+
+def email_fingerprint(email_input: dict) -> str:
+    """
+    邮件内容指纹：发件人地址 + 主题 + 清洗后的正文，统一大小写并压缩空白后取 SHA-256。
+    内容相同但 Message-ID 不同的邮件（重复群发、多个别名各收一份）也会得到同一个指纹。
+    """
+    sender = parseaddr(email_input.get("author", ""))[1].lower() or email_input.get("author", "").lower()
+    subject = " ".join(email_input.get("subject", "").split()).lower()
+    body = " ".join(email_input.get("email_thread", "").split()).lower()
+    return hashlib.sha256(f"{sender}\n{subject}\n{body}".encode("utf-8")).hexdigest()
+
+
 def format_email_markdown(subject, author, to, email_thread, email_id=None):
     """将邮件详情格式化为漂亮的 Markdown 字符串以便显示。
 
@@ -76,3 +184,33 @@ def format_for_display(tool_call):
         else:
             display += f"\n{tool_call['args']}\n"
     return display
+
+
+if __name__ == '__main__':
+    import time
+
+    reply_chain = "好的，周五下午两点没问题，我会提前准备好材料。\n\n在 2026年10月17日 18:02，王老师 写道：\n" + \
+                  "> 请确认一下周五的安排，另外把上周的实验数据也整理一下发给我。\n" * 300
+    forwarded = "转给你看看，重点是最后的报名截止日期。\n" + \
+                "\n".join(f"第 {i} 条：本次大赛面向全校本科生开放，参赛队伍需提交项目计划书和演示视频。" for i in range(400)) + \
+                "\n报名截止日期：2026年11月1日，逾期不予受理。"
+    newsletter = "\n".join(f"[{i}] Weekly digest item {i}: new articles about LLM agents, RAG and tooling. "
+                           f"Read more at https://example.com/posts/{i}" for i in range(800))
+    short = "张同学你好，想邀请你参加下午 14:00 的技术初面，请确认时间是否方便。"
+    corpus = {"回复链": reply_chain, "长转发": forwarded, "英文群发": newsletter, "短邮件": short}
+
+    counter = "tiktoken(o200k_base)" if _get_encoding() else "估算"
+    print(f"token 计数方式: {counter}")
+    for node, budget in (("分拣", TRIAGE_TOKEN_BUDGET), ("起草", DRAFT_TOKEN_BUDGET)):
+        before_total = after_total = 0
+        start = time.perf_counter()
+        for name, text in corpus.items():
+            compacted = compact_email_thread(text, budget)
+            before, after = count_tokens(text), count_tokens(compacted)
+            before_total += before
+            after_total += after
+            print(f"  [{node} 预算 {budget}] {name}: {before} -> {after} token")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"{node}: 共 {before_total} -> {after_total} token，节省 {1 - after_total / before_total:.0%}，"
+              f"压缩耗时 {elapsed_ms:.1f} ms")
+
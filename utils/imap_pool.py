@@ -0,0 +1,172 @@
+import atexit
+import imaplib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+IMAP_SERVER = os.getenv("IMAP_SERVER", "imap.163.com")
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+# 本地假 IMAP 服务器调试时可设置 IMAP_USE_SSL=0 走明文连接
+IMAP_USE_SSL = os.getenv("IMAP_USE_SSL", "1") != "0"
+IMAP_POOL_SIZE = int(os.getenv("IMAP_POOL_SIZE", "2"))
+
+# 163 要求登录后发送 ID 命令，否则 select 会报 "Unsafe Login"
+ID_INFO = '("name" "python-imap" "version" "1.0.0" "vendor" "myclient")'
+
+
+def _safe_logout(conn):
+    """尽力关闭连接，任何异常都吞掉（连接可能已经断了）"""
+    if conn is None:
+        return
+    try:
+        conn.logout()
+    except Exception:
+        try:
+            conn.shutdown()
+        except Exception:
+            pass
+
+
+class IMAPSessionPool:
+    """
+    长连接 IMAP 会话池。
+    借出的连接已经完成 login / ID / select，可以直接 search / fetch；
+    借出前用 NOOP 做健康检查，失效的连接会被丢弃并自动重连。
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str, mailbox: str = "INBOX",
+                 max_size: int = 2, use_ssl: bool = True, timeout: float = 30, acquire_timeout: float = 60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.max_size = max_size
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+
+        self._idle: List[imaplib.IMAP4] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+
+    def _connect(self) -> imaplib.IMAP4:
+        imap_cls = imaplib.IMAP4_SSL if self.use_ssl else imaplib.IMAP4
+        conn = imap_cls(self.host, self.port, timeout=self.timeout)
+        try:
+            if 'ID' not in imaplib.Commands:
+                imaplib.Commands['ID'] = ('AUTH', 'SELECTED')
+            conn.login(self.user, self.password)
+            try:
+                conn._simple_command('ID', ID_INFO)
+            except imaplib.IMAP4.error:
+                # 非 163 的服务器（如本地假服务器）可能不支持 ID，忽略即可
+                pass
+            status, _ = conn.select(self.mailbox)
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"无法选中邮箱目录: {self.mailbox}")
+        except Exception:
+            _safe_logout(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn: imaplib.IMAP4) -> bool:
+        """NOOP 既能探活，也会让服务器推送新邮件的 EXISTS，取代原来的 check()"""
+        try:
+            status, _ = conn.noop()
+            return status == 'OK' and conn.state == 'SELECTED'
+        except Exception:
+            return False
+
+    def _checkout(self) -> imaplib.IMAP4:
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if self._is_healthy(conn):
+                return conn
+            print("IMAP 连接已失效，丢弃并重连...")
+            _safe_logout(conn)
+
+        try:
+            return self._connect()
+        except (imaplib.IMAP4.abort, OSError):
+            # 网络抖动只重试一次，认证失败等错误直接抛出
+            return self._connect()
+
+    def _checkin(self, conn: imaplib.IMAP4):
+        with self._lock:
+            if not self._closed:
+                self._idle.append(conn)
+                return
+        _safe_logout(conn)
+
+    @contextmanager
+    def session(self):
+        """
+        借出一个已选中收件箱的连接，用完自动归还；
+        with 块内抛出异常时连接状态不可信，直接关闭而不是放回池子。
+        """
+        if self._closed:
+            raise RuntimeError("IMAP 连接池已关闭")
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError("等待 IMAP 连接超时")
+        conn: Optional[imaplib.IMAP4] = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except BaseException:
+            _safe_logout(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn)
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            _safe_logout(conn)
+
+
+_default_pool: Optional[IMAPSessionPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def get_imap_pool() -> IMAPSessionPool:
+    """进程级共享的 163 连接池，首次使用时按环境变量创建"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = IMAPSessionPool(
+                host=IMAP_SERVER,
+                port=IMAP_PORT,
+                user=os.getenv("MAIL_USER"),
+                password=os.getenv("MAIL_PASS"),
+                max_size=IMAP_POOL_SIZE,
+                use_ssl=IMAP_USE_SSL,
+            )
+            atexit.register(_default_pool.close)
+        return _default_pool
+
+
+if __name__ == '__main__':
+    pool = get_imap_pool()
+    for i in range(3):
+        start = time.perf_counter()
+        with pool.session() as mail:
+            status, data = mail.search(None, 'ALL')
+        print(f"第 {i + 1} 次借用连接耗时: {(time.perf_counter() - start) * 1000:.1f} ms, 邮件数: {len(data[0].split())}")
+    pool.close()
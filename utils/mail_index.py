@@ -0,0 +1,180 @@
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+from utils.mail_mirror import get_mail_mirror, MAIL_MIRROR_PATH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_terms (
+    term TEXT NOT NULL,
+    message_pk INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, message_pk)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS search_indexed (
+    message_pk INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS search_meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+# 切词方式变了就加一，打开旧版本的索引时整个重建
+INDEX_VERSION = 2
+
+# 连续的汉字切成二元组（建索引时另外记单字，单字查询才能命中）；英文、数字、邮箱地址按整词索引
+_TOKEN_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]+|[a-z0-9][a-z0-9._@+-]*[a-z0-9]|[a-z0-9]")
+
+
+def tokenize(text: str, unigrams: bool = False) -> List[str]:
+    """unigrams=True 时汉字串除了二元组再加上每个单字，建索引用；查询只有单个汉字时本来就切成单字"""
+    tokens = []
+    for run in _TOKEN_RE.findall((text or "").lower()):
+        if run[0].isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            if unigrams:
+                tokens.extend(run)
+    return tokens
+
+
+class MailIndex:
+    """
+    建在本地邮件镜像上的倒排索引（同一个 SQLite 文件）。
+    sync() 只给还没建索引的新邮件补索引，查询按全部词项取交集，再按词频排序。
+    """
+
+    def __init__(self, path: str = MAIL_MIRROR_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        row = self._conn.execute("SELECT value FROM search_meta WHERE name = 'index_version'").fetchone()
+        if row is None or row["value"] != INDEX_VERSION:
+            # 旧索引里没有单字词项，清空后由下一次 sync() 全部重建
+            self._conn.execute("DELETE FROM search_terms")
+            self._conn.execute("DELETE FROM search_indexed")
+            self._conn.execute("INSERT OR REPLACE INTO search_meta (name, value) VALUES ('index_version', ?)",
+                               (INDEX_VERSION,))
+        self._conn.commit()
+
+    def sync(self) -> int:
+        """增量建索引，返回本次新索引的邮件数"""
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT m.id, m.author, m.subject, b.body FROM messages m JOIN bodies b ON b.message_pk = m.id "
+                "WHERE m.id > (SELECT COALESCE(MAX(message_pk), 0) FROM search_indexed) ORDER BY m.id"
+            ).fetchall()
+            for row in rows:
+                counts = Counter(tokenize(f"{row['author']}\n{row['subject']}\n{row['body']}", unigrams=True))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO search_terms (term, message_pk, tf) VALUES (?, ?, ?)",
+                    [(term, row["id"], tf) for term, tf in counts.items()],
+                )
+                self._conn.execute("INSERT INTO search_indexed (message_pk) VALUES (?)", (row["id"],))
+            return len(rows)
+
+    def search(self, query: str, sender: Optional[str] = None, limit: int = 5) -> List[Dict]:
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        self.sync()
+
+        placeholders = ",".join("?" * len(terms))
+        sql = (
+            "SELECT t.message_pk, SUM(t.tf) AS score FROM search_terms t "
+            + ("JOIN messages m ON m.id = t.message_pk " if sender else "")
+            + f"WHERE t.term IN ({placeholders}) "
+            + ("AND m.sender_email = ? " if sender else "")
+            + "GROUP BY t.message_pk HAVING COUNT(*) = ? ORDER BY score DESC LIMIT ?"
+        )
+        params = terms + ([sender.lower()] if sender else []) + [len(terms), limit]
+        with self._lock:
+            hits = self._conn.execute(sql, params).fetchall()
+            results = []
+            for hit in hits:
+                row = self._conn.execute(
+                    "SELECT m.id, m.author, m.subject, m.sent_at, b.body FROM messages m "
+                    "JOIN bodies b ON b.message_pk = m.id WHERE m.id = ?", (hit["message_pk"],)
+                ).fetchone()
+                results.append({
+                    "mirror_id": row["id"],
+                    "author": row["author"],
+                    "subject": row["subject"],
+                    "date": row["sent_at"] or "",
+                    "snippet": row["body"][:200],
+                    "score": hit["score"],
+                })
+            return results
+
+
+_default_index: Optional[MailIndex] = None
+_default_index_lock = threading.Lock()
+
+
+def get_mail_index() -> MailIndex:
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            # 先确保镜像库的表已经建好
+            get_mail_mirror()
+            _default_index = MailIndex()
+        return _default_index
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import tempfile
+    import time
+
+    from utils.mail_mirror import MailMirror
+
+    random.seed(0)
+    vocabulary = ["面试", "邀请", "项目", "进度", "会议", "周五", "下午", "报名", "截止", "日期", "论文", "答辩",
+                  "实习", "offer", "deadline", "github", "部署", "通知", "发票", "报销", "课程", "作业", "导师"]
+    senders = [f"user{i}@example.com" for i in range(200)]
+
+    def random_text(words: int) -> str:
+        return "，".join(random.choice(vocabulary) for _ in range(words))
+
+    for size in (1000, 10000, 50000):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "bench.db")
+            mirror = MailMirror(db_path)
+            for i in range(size):
+                mirror.save_email({
+                    "author": f"发件人 <{random.choice(senders)}>",
+                    "to": "me@163.com",
+                    "subject": random_text(4),
+                    "email_thread": random_text(60),
+                    "thread_id": f"t{i}",
+                    "message_id": f"<{i}@bench>",
+                })
+            index = MailIndex(db_path)
+            start = time.perf_counter()
+            index.sync()
+            build_seconds = time.perf_counter() - start
+
+            queries = ["面试邀请", "项目进度 周五", "github 部署", "报名截止日期", "导师 论文答辩", "会"]
+            rounds = 20
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for q in queries:
+                    index.search(q)
+            per_query_ms = (time.perf_counter() - start) / (rounds * len(queries)) * 1000
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for q in queries:
+                    index.search(q, sender=senders[0])
+            per_sender_query_ms = (time.perf_counter() - start) / (rounds * len(queries)) * 1000
+            print(f"邮件数 {size:>6}: 建索引 {build_seconds:.2f} s, 查询 {per_query_ms:.2f} ms/次, "
+                  f"限定发件人查询 {per_sender_query_ms:.2f} ms/次")
+            mirror.close()
@@ -0,0 +1,340 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parseaddr, parsedate_to_datetime
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIL_MIRROR_PATH = os.getenv("MAIL_MIRROR_PATH") or os.path.normpath(
+    os.path.join(CURRENT_DIR, "..", "mail_mirror.db"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT NOT NULL UNIQUE,
+    uid INTEGER,
+    conversation_id TEXT NOT NULL,  -- 所属会话（conversation_index 里的会话 ID），不是 LangGraph 的 checkpoint thread
+    author TEXT NOT NULL,
+    sender_email TEXT NOT NULL,
+    to_addr TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    sent_at TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages(sent_at);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_email);
+
+CREATE TABLE IF NOT EXISTS headers (
+    message_pk INTEGER NOT NULL REFERENCES messages(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_headers_message ON headers(message_pk);
+CREATE INDEX IF NOT EXISTS idx_headers_name_value ON headers(name, value);
+
+CREATE TABLE IF NOT EXISTS bodies (
+    message_pk INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+    body TEXT NOT NULL,
+    skipped_attachments TEXT NOT NULL DEFAULT '[]'
+);
+
+CREATE TABLE IF NOT EXISTS processing (
+    message_pk INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+    status TEXT NOT NULL,
+    classification TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_processing_classification ON processing(classification);
+CREATE INDEX IF NOT EXISTS idx_processing_status ON processing(status);
+
+CREATE TABLE IF NOT EXISTS conversation_index (
+    message_id TEXT PRIMARY KEY,
+    conversation_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id);
+"""
+
+# 旧版本的镜像库把会话 ID 存在 thread_id 列里，和 LangGraph 的 checkpoint thread_id 同名，打开时改名
+MIGRATIONS = [
+    ("messages", "thread_id", [
+        "DROP INDEX IF EXISTS idx_messages_thread",
+        "ALTER TABLE messages RENAME COLUMN thread_id TO conversation_id",
+    ]),
+    ("thread_index", "thread_id", [
+        "ALTER TABLE thread_index RENAME COLUMN thread_id TO conversation_id",
+        "ALTER TABLE thread_index RENAME TO conversation_index",
+    ]),
+]
+
+_MSG_ID_RE = re.compile(r"<[^<>\s]+>")
+
+
+def _normalize_date(raw_date: str) -> Optional[str]:
+    """把邮件头的 Date 统一成 UTC 的 ISO 字符串，方便按天建索引查询"""
+    if not raw_date:
+        return None
+    try:
+        parsed = parsedate_to_datetime(raw_date)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat()
+
+
+def _message_key(email_data: Dict) -> str:
+    """优先用 Message-ID；个别系统通知没有 Message-ID，就用关键头字段算一个稳定的替代值"""
+    message_id = (email_data.get("message_id") or "").strip()
+    if message_id:
+        return message_id
+    raw = "\n".join([email_data.get("author", ""), email_data.get("subject", ""), email_data.get("date", ""),
+                     str(email_data.get("uid", ""))])
+    return f"<{hashlib.sha1(raw.encode('utf-8')).hexdigest()}@local.mirror>"
+
+
+def parse_message_ids(value: str) -> List[str]:
+    """从 References / In-Reply-To 头里取出所有 <...> 形式的 Message-ID"""
+    return _MSG_ID_RE.findall(value or "")
+
+
+def thread_references(email_data: Dict) -> List[str]:
+    """同一会话里可能指向的 Message-ID，按从会话起点到当前邮件的顺序排列"""
+    headers = email_data.get("headers") or {}
+    ids = parse_message_ids(headers.get("references", "")) + parse_message_ids(headers.get("in-reply-to", ""))
+    own_id = (email_data.get("message_id") or "").strip()
+    if own_id:
+        ids.append(own_id)
+    return list(dict.fromkeys(ids))
+
+
+def derive_conversation_id(email_data: Dict) -> str:
+    """
+    用会话起点的 Message-ID 算出确定性的会话 ID：同一会话里的来信都落到同一个 ID。
+    连 Message-ID 都没有的邮件退回到镜像的替代键。
+    """
+    ids = thread_references(email_data)
+    root = ids[0] if ids else _message_key(email_data)
+    return "mail-" + hashlib.sha1(root.encode("utf-8")).hexdigest()[:16]
+
+
+def message_thread_id(email_data: Dict) -> str:
+    """
+    每封来信自己的 LangGraph checkpoint thread，由这封邮件的 Message-ID 推导：重复抓取同一封邮件落到同一个
+    checkpoint，同一会话的后续来信各走各的 thread。会话里的上下文通过 conversation_history 从镜像里取，
+    不共用 checkpoint，旧卡片的回调也就不可能批准到新邮件的草稿上。
+    """
+    return "msg-" + hashlib.sha1(_message_key(email_data).encode("utf-8")).hexdigest()[:16]
+
+
+class MailMirror:
+    """
+    本地邮件镜像：抓取到的邮件先落库，之后的分拣、重放、审计都从这里读，不再访问 IMAP。
+    单连接 + 锁，开启 WAL 让读写互不阻塞。
+    """
+
+    def __init__(self, path: str = MAIL_MIRROR_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._migrate()
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def _migrate(self):
+        with self._conn:
+            for table, old_column, statements in MIGRATIONS:
+                columns = {row["name"] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+                if old_column in columns:
+                    for statement in statements:
+                        self._conn.execute(statement)
+
+    def resolve_conversation_id(self, email_data: Dict) -> str:
+        """
+        在会话索引里查找这封邮件引用过的任意一封邮件，找到就沿用那个会话的 ID；
+        References 头被客户端截断时，仅凭 In-Reply-To 也能接上原来的会话。
+        查不到时用 derive_conversation_id 新建，并把本邮件涉及的所有 Message-ID 都登记到该会话。
+        """
+        ids = thread_references(email_data)
+        with self._lock, self._conn:
+            conversation_id = None
+            if ids:
+                placeholders = ",".join("?" * len(ids))
+                row = self._conn.execute(
+                    f"SELECT conversation_id FROM conversation_index WHERE message_id IN ({placeholders}) LIMIT 1", ids
+                ).fetchone()
+                conversation_id = row["conversation_id"] if row else None
+            conversation_id = conversation_id or derive_conversation_id(email_data)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO conversation_index (message_id, conversation_id) VALUES (?, ?)",
+                [(message_id, conversation_id) for message_id in ids],
+            )
+            return conversation_id
+
+    def conversation_history(self, email_data: Dict, limit: int = 3) -> List[Dict]:
+        """同一会话里比这封更早的来信（最多 limit 封，按时间先后），起草回信时作为上下文"""
+        conversation_id = email_data.get("conversation_id")
+        if not conversation_id or limit <= 0:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                self._SELECT + "WHERE m.conversation_id = ? AND m.message_id != ? "
+                "AND (? IS NULL OR m.sent_at IS NULL OR m.sent_at <= ?) ORDER BY m.sent_at DESC, m.id DESC LIMIT ?",
+                (conversation_id, _message_key(email_data), _normalize_date(email_data.get("date", "")),
+                 _normalize_date(email_data.get("date", "")), limit),
+            ).fetchall()
+            return [self._to_email_detail(row) for row in reversed(rows)]
+
+    def save_email(self, email_data: Dict) -> int:
+        """写入一封邮件（按 Message-ID 去重），返回镜像行 ID；重复写入不会覆盖已有的处理状态"""
+        message_key = _message_key(email_data)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id FROM messages WHERE message_id = ?", (message_key,)).fetchone()
+            if row:
+                return row["id"]
+            cur = self._conn.execute(
+                "INSERT INTO messages (message_id, uid, conversation_id, author, sender_email, to_addr, subject, sent_at, "
+                "fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    message_key,
+                    email_data.get("uid"),
+                    email_data.get("conversation_id") or email_data.get("thread_id", ""),
+                    email_data.get("author", ""),
+                    parseaddr(email_data.get("author", ""))[1].lower(),
+                    email_data.get("to", ""),
+                    email_data.get("subject", ""),
+                    _normalize_date(email_data.get("date", "")),
+                    now,
+                ),
+            )
+            message_pk = cur.lastrowid
+            self._conn.executemany(
+                "INSERT INTO headers (message_pk, name, value) VALUES (?, ?, ?)",
+                [(message_pk, name, value) for name, value in (email_data.get("headers") or {}).items()],
+            )
+            self._conn.execute(
+                "INSERT INTO bodies (message_pk, body, skipped_attachments) VALUES (?, ?, ?)",
+                (message_pk, email_data.get("email_thread", ""),
+                 json.dumps(email_data.get("skipped_attachments", []), ensure_ascii=False)),
+            )
+            self._conn.execute(
+                "INSERT INTO processing (message_pk, status, classification, updated_at) VALUES (?, 'fetched', NULL, ?)",
+                (message_pk, now),
+            )
+            return message_pk
+
+    def set_status(self, message_pk: int, status: str, classification: Optional[str] = None):
+        """更新处理状态：fetched -> triaged -> awaiting_review -> done；classification 为空时保留原值"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE processing SET status = ?, classification = COALESCE(?, classification), updated_at = ? "
+                "WHERE message_pk = ?",
+                (status, classification, time.time(), message_pk),
+            )
+
+    def _to_email_detail(self, row: sqlite3.Row) -> Dict:
+        headers = {
+            h["name"]: h["value"]
+            for h in self._conn.execute("SELECT name, value FROM headers WHERE message_pk = ?", (row["id"],))
+        }
+        return {
+            "author": row["author"],
+            "to": row["to_addr"],
+            "subject": row["subject"],
+            "email_thread": row["body"],
+            "thread_id": message_thread_id({"message_id": row["message_id"]}),
+            "conversation_id": row["conversation_id"],
+            "uid": row["uid"],
+            "message_id": row["message_id"],
+            "date": headers.get("date", ""),
+            "headers": headers,
+            "skipped_attachments": json.loads(row["skipped_attachments"]),
+            "mirror_id": row["id"],
+        }
+
+    _SELECT = (
+        "SELECT m.*, b.body, b.skipped_attachments, p.status, p.classification FROM messages m "
+        "JOIN bodies b ON b.message_pk = m.id JOIN processing p ON p.message_pk = m.id "
+    )
+
+    def get_email(self, message_pk: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(self._SELECT + "WHERE m.id = ?", (message_pk,)).fetchone()
+            return self._to_email_detail(row) if row else None
+
+    def list_emails(self, day: Optional[str] = None, sender: Optional[str] = None,
+                    classification: Optional[str] = None, status: Optional[str] = None,
+                    limit: int = 200) -> List[Dict]:
+        """
+        按条件从本地镜像取邮件，全部走索引：
+        day 形如 "2026-10-18"（UTC），sender 是发件人邮箱地址。
+        """
+        clauses, params = [], []
+        if day:
+            start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+            clauses.append("m.sent_at >= ? AND m.sent_at < ?")
+            params += [start.isoformat(), (start + timedelta(days=1)).isoformat()]
+        if sender:
+            clauses.append("m.sender_email = ?")
+            params.append(sender.lower())
+        if classification:
+            clauses.append("p.classification = ?")
+            params.append(classification)
+        if status:
+            clauses.append("p.status = ?")
+            params.append(status)
+        where = ("WHERE " + " AND ".join(clauses) + " ") if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(self._SELECT + where + "ORDER BY m.sent_at LIMIT ?", params + [limit]).fetchall()
+            return [self._to_email_detail(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_mirror: Optional[MailMirror] = None
+_default_mirror_lock = threading.Lock()
+
+
+def get_mail_mirror() -> MailMirror:
+    global _default_mirror
+    with _default_mirror_lock:
+        if _default_mirror is None:
+            _default_mirror = MailMirror()
+        return _default_mirror
+
+
+def mark_email_status(email_input: Dict, status: str, classification: Optional[str] = None):
+    """图节点里调用的便捷函数：没有 mirror_id（例如手工构造的测试邮件）时什么也不做"""
+    message_pk = email_input.get("mirror_id") if email_input else None
+    if message_pk:
+        get_mail_mirror().set_status(message_pk, status, classification)
+
+
+if __name__ == '__main__':
+    mirror = MailMirror(":memory:")
+    pk = mirror.save_email({
+        "author": "招聘集团 <hr@example.com>",
+        "to": "maj04@163.com",
+        "subject": "面试邀约",
+        "email_thread": "张同学你好，想邀请你参加技术初面。",
+        "thread_id": "demo-thread",
+        "message_id": "<demo@example.com>",
+        "date": "Sat, 18 Oct 2026 10:00:00 +0800",
+        "headers": {"from": "招聘集团 <hr@example.com>", "subject": "面试邀约"},
+    })
+    mirror.set_status(pk, "triaged", "respond")
+    print(mirror.list_emails(day="2026-10-18", classification="respond"))
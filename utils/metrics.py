@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict
+
+# 每个耗时指标只保留最近这么多个样本，用来算 p50/p95
+LATENCY_WINDOW = 1000
+
+
+def _percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Metrics:
+    """进程内的简单计数器和耗时统计，线程安全；/admin/metrics 接口直接返回 snapshot()"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self._latencies[name].append(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def latency(self, name: str) -> Dict[str, float]:
+        with self._lock:
+            values = sorted(self._latencies.get(name, ()))
+        return {
+            "count": len(values),
+            "avg_ms": sum(values) / len(values) * 1000 if values else 0.0,
+            "p50_ms": _percentile(values, 0.5) * 1000,
+            "p95_ms": _percentile(values, 0.95) * 1000,
+        }
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def latency_snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            names = list(self._latencies)
+        return {name: self.latency(name) for name in names}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._latencies.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,361 @@
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+from email.header import Header
+from email.mime.text import MIMEText
+from typing import Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from utils.metrics import metrics
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTBOX_PATH = os.getenv("OUTBOX_PATH") or os.path.normpath(os.path.join(CURRENT_DIR, "..", "mail_outbox.db"))
+
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.163.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+# 本地用 aiosmtpd 之类的假服务器调试时设置 SMTP_USE_SSL=0
+SMTP_USE_SSL = os.getenv("SMTP_USE_SSL", "1") != "0"
+# 163 对单账号发信频率有限制，超过会临时封禁，这里默认每分钟最多 10 封
+SMTP_RATE_PER_MINUTE = float(os.getenv("SMTP_RATE_PER_MINUTE", "10"))
+SMTP_MAX_ATTEMPTS = int(os.getenv("SMTP_MAX_ATTEMPTS", "5"))
+SMTP_IDLE_SECONDS = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    to_addr TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    content TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL,
+    thread_id TEXT,
+    tool_call_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at);
+"""
+
+# 发信台账：同一会话里同一次工具调用只能入队一次，NULL 互不相等，普通 enqueue 不受影响
+LEDGER_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_ledger ON outbox(thread_id, tool_call_id)"
+
+
+class _RateLimiter:
+    """令牌桶：按每分钟配额匀速放行，允许最多一分钟额度的突发"""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(per_minute, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class _SMTPConnection:
+    """复用同一个已登录的 SMTP 连接，发信前用 NOOP 探活，空闲太久主动断开"""
+
+    def __init__(self, host: str, port: int, user: str, password: str, use_ssl: bool):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self._conn: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp_cls = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        conn = smtp_cls(self.host, self.port, timeout=30)
+        try:
+            conn.ehlo()
+            if conn.has_extn("auth") and self.user:
+                conn.login(self.user, self.password)
+        except Exception:
+            self._safe_quit(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _safe_quit(conn: Optional[smtplib.SMTP]):
+        if conn is None:
+            return
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def get(self) -> smtplib.SMTP:
+        if self._conn is not None:
+            try:
+                if self._conn.noop()[0] == 250:
+                    return self._conn
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._safe_quit(self._conn)
+            self._conn = None
+        self._conn = self._connect()
+        return self._conn
+
+    def send(self, message: MIMEText, to_addr: str):
+        conn = self.get()
+        try:
+            conn.sendmail(self.user, [to_addr], message.as_string())
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # 连接在 NOOP 之后才断开，丢掉后交给重试逻辑
+            self.close()
+            raise
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self._conn is not None and time.monotonic() - self._last_used > SMTP_IDLE_SECONDS:
+            self.close()
+
+    def close(self):
+        self._safe_quit(self._conn)
+        self._conn = None
+
+
+def _is_permanent(error: Exception) -> bool:
+    """5xx 的收件人/内容错误重试也没用；网络、4xx 临时错误和认证失败都按可重试处理"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPDataError, smtplib.SMTPSenderRefused)):
+        return error.smtp_code >= 500
+    return False
+
+
+class SMTPOutbox:
+    """
+    持久化的发件箱：write_email 只负责入队，后台线程复用 SMTP 连接按频率限制发送，
+    失败按指数退避重试，进程重启后未发完的邮件会继续发送。
+    投递语义是至少一次：服务器收下邮件到记成 sent 之间进程退出的话，重启后会再发一遍，
+    同一封邮件每次都带相同的 Message-ID。
+    彻底发送失败（5xx 退信或重试次数用完）的邮件记成 failed，计入 outbox.failed 指标，
+    并调用 on_failed(这一行邮件)，由上层通知对应的用户。
+    """
+
+    def __init__(self, path: str = OUTBOX_PATH, host: str = SMTP_SERVER, port: int = SMTP_PORT,
+                 user: Optional[str] = None, password: Optional[str] = None, use_ssl: bool = SMTP_USE_SSL,
+                 rate_per_minute: float = SMTP_RATE_PER_MINUTE, max_attempts: int = SMTP_MAX_ATTEMPTS,
+                 backoff_base: float = 5.0, on_failed: Optional[Callable[[Dict], None]] = None):
+        self.on_failed = on_failed
+        self.user = user if user is not None else os.getenv("MAIL_USER")
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+        for column in ("thread_id", "tool_call_id"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} TEXT")
+        self._conn.execute(LEDGER_INDEX)
+        # 上次进程退出时正在发送的邮件：SMTP 服务器可能已经收下、只是没来得及记成 sent，
+        # 这里无从确认，按至少一次重新排队。重发用的是同一个 Message-ID，收件端能认出是同一封
+        requeued = self._conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'").rowcount
+        self._conn.commit()
+        if requeued:
+            print(f"发件箱有 {requeued} 封邮件在上次退出时正在发送，无法确认是否已发出，重新排队（可能重复投递）")
+
+        self._smtp = _SMTPConnection(host, port, self.user,
+                                     password if password is not None else os.getenv("MAIL_PASS"), use_ssl)
+        self._limiter = _RateLimiter(rate_per_minute)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    def enqueue(self, to: str, subject: str, content: str) -> int:
+        now = time.time()
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO outbox (to_addr, subject, content, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (to, subject, content, now, now),
+            )
+            outbox_id = cur.lastrowid
+        self.start()
+        self._wakeup.set()
+        return outbox_id
+
+    def enqueue_once(self, thread_id: str, tool_call_id: str, to: str, subject: str,
+                     content: str) -> Tuple[int, bool]:
+        """
+        按 (thread_id, tool_call_id) 幂等入队，返回 (发件箱编号, 是否本次新建)。
+        飞书卡片回调可能重复投递，同一次 write_email 调用被 resume 多少次都只会发出一封。
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (to_addr, subject, content, next_attempt_at, created_at, thread_id, "
+                "tool_call_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (to, subject, content, now, now, thread_id, tool_call_id),
+            )
+            created = cur.rowcount == 1
+            if created:
+                outbox_id = cur.lastrowid
+            else:
+                outbox_id = self._conn.execute(
+                    "SELECT id FROM outbox WHERE thread_id = ? AND tool_call_id = ?", (thread_id, tool_call_id)
+                ).fetchone()["id"]
+        if created:
+            self.start()
+            self._wakeup.set()
+        return outbox_id, created
+
+    def get(self, outbox_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+            return dict(row) if row else None
+
+    def find(self, thread_id: str, tool_call_id: str) -> Optional[Dict]:
+        """按发信台账的 (thread_id, tool_call_id) 查这次工具调用入队的那封邮件，没有入队过返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM outbox WHERE thread_id = ? AND tool_call_id = ?",
+                                     (thread_id, tool_call_id)).fetchone()
+            return dict(row) if row else None
+
+    def count(self, status: Optional[str] = None) -> int:
+        """发件箱里的邮件数，给定 status（queued / sending / sent / failed）时只数这一种"""
+        with self._lock:
+            if status is None:
+                return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (status,)).fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        """各状态的邮件数，给 /admin/metrics 用"""
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ("queued", "sending", "sent", "failed")}
+
+    def start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._stopped.clear()
+                self._worker = threading.Thread(target=self._run, name="smtp-outbox", daemon=True)
+                self._worker.start()
+
+    def stop(self, timeout: float = 5):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+        self._smtp.close()
+
+    def _next_due(self) -> tuple:
+        """返回 (到期的一封邮件, 下一封邮件还要等多久)"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM outbox WHERE status = 'queued' ORDER BY next_attempt_at, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None, None
+            if row["next_attempt_at"] > now:
+                return None, row["next_attempt_at"] - now
+            self._conn.execute("UPDATE outbox SET status = 'sending' WHERE id = ?", (row["id"],))
+            return dict(row), 0.0
+
+    def _run(self):
+        while not self._stopped.is_set():
+            delay = self._limiter.wait_time()
+            if delay > 0:
+                self._stopped.wait(delay)
+                continue
+            # 先清掉唤醒标记再查队列：查完之后才入队的邮件会重新置位，wait 立即返回，不会被吞掉
+            self._wakeup.clear()
+            item, wait = self._next_due()
+            if item is None:
+                self._smtp.close_if_idle()
+                self._wakeup.wait(min(wait, 30) if wait is not None else 30)
+                continue
+            self._limiter.consume()
+            self._deliver(item)
+
+    def _message_id(self, item: Dict) -> str:
+        """由发件箱编号和入队时间生成，重试和重启后重发都不变"""
+        domain = (self.user or "").rpartition("@")[2] or "localhost"
+        return f"<outbox-{item['id']}.{int(item['created_at'] * 1000)}@{domain}>"
+
+    def _notify_failed(self, item: Dict):
+        if self.on_failed is None:
+            return
+        try:
+            self.on_failed(item)
+        except Exception as e:
+            # 通知失败不能拖垮发送线程，队列里的其他邮件还要继续发
+            print(f"邮件 #{item['id']} 的发送失败通知出错: {e}")
+
+    def _deliver(self, item: Dict):
+        message = MIMEText(item["content"], 'plain', 'utf-8')
+        message['From'] = self.user
+        message['To'] = item["to_addr"]
+        message['Subject'] = Header(item["subject"], 'utf-8')
+        message['Message-ID'] = self._message_id(item)
+        try:
+            self._smtp.send(message, item["to_addr"])
+        except Exception as e:
+            attempts = item["attempts"] + 1
+            permanent = _is_permanent(e) or attempts >= self.max_attempts
+            next_attempt_at = time.time() + min(self.backoff_base * (2 ** (attempts - 1)), 600)
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    ("failed" if permanent else "queued", attempts, next_attempt_at, str(e), item["id"]),
+                )
+            print(f"邮件 #{item['id']} 发送失败（第 {attempts} 次）: {e}" + ("，不再重试" if permanent else ""))
+            if permanent:
+                metrics.incr("outbox.failed")
+                self._notify_failed({**item, "status": "failed", "attempts": attempts, "last_error": str(e)})
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = ? WHERE id = ?",
+                (time.time(), item["id"]),
+            )
+        print(f"邮件 #{item['id']} 已发送至 {item['to_addr']}")
+
+
+_default_outbox: Optional[SMTPOutbox] = None
+_default_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> SMTPOutbox:
+    global _default_outbox
+    with _default_outbox_lock:
+        if _default_outbox is None:
+            _default_outbox = SMTPOutbox()
+        return _default_outbox
+
+
+if __name__ == '__main__':
+    outbox = get_outbox()
+    outbox_id = outbox.enqueue(os.getenv("MAIL_USER"), "发件队列测试", "这是一封来自发件队列的测试邮件。")
+    for _ in range(30):
+        status = outbox.get(outbox_id)["status"]
+        if status in ("sent", "failed"):
+            break
+        time.sleep(1)
+    print(outbox.get(outbox_id))
+    outbox.stop()
@@ -0,0 +1,274 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from langgraph.store.base import (
+    BaseStore,
+    GetOp,
+    Item,
+    ListNamespacesOp,
+    MatchCondition,
+    Op,
+    PutOp,
+    Result,
+    SearchItem,
+    SearchOp,
+)
+
+from utils.metrics import metrics
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+MEMORY_STORE_PATH = os.getenv("MEMORY_STORE_PATH") or os.path.normpath(
+    os.path.join(CURRENT_DIR, "..", "memory_store.db"))
+# LRU 里最多缓存多少个 (namespace, key)，每个用户三份偏好，默认够几千个用户
+MEMORY_STORE_CACHE_SIZE = int(os.getenv("MEMORY_STORE_CACHE_SIZE", "10000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS store (
+    prefix TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (prefix, key)
+) WITHOUT ROWID;
+"""
+
+# langgraph 规定 namespace 的每一段都不能含 "."，所以用它拼接前缀，按前缀搜索时可以直接用 LIKE
+_SEP = "."
+_MISSING = object()
+
+
+def _prefix(namespace: Tuple[str, ...]) -> str:
+    return _SEP.join(namespace)
+
+
+def _matches(condition: MatchCondition, namespace: Tuple[str, ...]) -> bool:
+    path = condition.path
+    if len(namespace) < len(path):
+        return False
+    pairs = zip(namespace, path) if condition.match_type == "prefix" else zip(reversed(namespace), reversed(path))
+    return all(p == "*" or n == p for n, p in pairs)
+
+
+def _filter_matches(value: Dict, filter_: Optional[Dict]) -> bool:
+    """只支持按字段精确匹配（可以嵌套），项目里的用法足够了"""
+    return not filter_ or all(
+        _filter_matches(value.get(k) or {}, v) if isinstance(v, dict) else value.get(k) == v
+        for k, v in filter_.items()
+    )
+
+
+class SQLiteStore(BaseStore):
+    """
+    持久化到 SQLite 的 LangGraph BaseStore：(前缀, key) 是主键，单条读写走索引。
+    读先查进程内的 LRU 缓存（不存在的条目也会缓存，新用户第一次取偏好不会每次都查库），
+    写先落库再更新缓存（write-through），缓存里的永远是已提交的版本。
+    """
+
+    def __init__(self, path: str = MEMORY_STORE_PATH, cache_size: int = MEMORY_STORE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[Tuple[str, ...], str], Any]" = OrderedDict()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def _cache_get(self, cache_key):
+        item = self._cache.get(cache_key, _MISSING)
+        if item is not _MISSING:
+            self._cache.move_to_end(cache_key)
+        return item
+
+    def _cache_set(self, cache_key, item: Optional[Item]):
+        self._cache[cache_key] = item
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _row_to_item(namespace: Tuple[str, ...], row: sqlite3.Row) -> Item:
+        return Item(value=json.loads(row["value"]), key=row["key"], namespace=namespace,
+                    created_at=datetime.fromisoformat(row["created_at"]),
+                    updated_at=datetime.fromisoformat(row["updated_at"]))
+
+    def _get(self, op: GetOp) -> Optional[Item]:
+        cache_key = (tuple(op.namespace), op.key)
+        item = self._cache_get(cache_key)
+        if item is not _MISSING:
+            metrics.incr("memory_store.cache_hit")
+            return item
+        metrics.incr("memory_store.cache_miss")
+        row = self._conn.execute("SELECT * FROM store WHERE prefix = ? AND key = ?",
+                                 (_prefix(op.namespace), op.key)).fetchone()
+        item = self._row_to_item(tuple(op.namespace), row) if row else None
+        self._cache_set(cache_key, item)
+        return item
+
+    def _put(self, op: PutOp):
+        namespace = tuple(op.namespace)
+        prefix = _prefix(namespace)
+        if op.value is None:
+            self._conn.execute("DELETE FROM store WHERE prefix = ? AND key = ?", (prefix, op.key))
+            self._cache_set((namespace, op.key), None)
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        self._conn.execute(
+            "INSERT INTO store (prefix, key, value, created_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(prefix, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (prefix, op.key, json.dumps(op.value, ensure_ascii=False), now, now),
+        )
+        # created_at 以库里为准，重新读一次，缓存里的 Item 和直接查库得到的完全一致
+        row = self._conn.execute("SELECT * FROM store WHERE prefix = ? AND key = ?", (prefix, op.key)).fetchone()
+        self._cache_set((namespace, op.key), self._row_to_item(namespace, row))
+
+    def _search(self, op: SearchOp) -> List[SearchItem]:
+        # 没有配置 embedding，不做语义检索；带 query 直接报错，免得调用方以为结果按相关度排过序
+        if op.query:
+            raise ValueError("SQLiteStore 不支持语义检索（query），只能按 namespace 前缀和 filter 查")
+        if op.namespace_prefix:
+            prefix = _prefix(op.namespace_prefix)
+            rows = self._conn.execute(
+                "SELECT * FROM store WHERE prefix = ? OR prefix LIKE ? ESCAPE '\\' ORDER BY updated_at DESC",
+                (prefix, prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + _SEP + "%"),
+            ).fetchall()
+        else:
+            rows = self._conn.execute("SELECT * FROM store ORDER BY updated_at DESC").fetchall()
+        items = []
+        for row in rows:
+            value = json.loads(row["value"])
+            if _filter_matches(value, op.filter):
+                item = self._row_to_item(tuple(row["prefix"].split(_SEP)), row)
+                items.append(SearchItem(namespace=item.namespace, key=item.key, value=item.value,
+                                        created_at=item.created_at, updated_at=item.updated_at))
+        return items[op.offset:op.offset + op.limit]
+
+    def _list_namespaces(self, op: ListNamespacesOp) -> List[Tuple[str, ...]]:
+        namespaces = [tuple(row["prefix"].split(_SEP))
+                      for row in self._conn.execute("SELECT DISTINCT prefix FROM store ORDER BY prefix")]
+        if op.match_conditions:
+            namespaces = [ns for ns in namespaces if all(_matches(c, ns) for c in op.match_conditions)]
+        if op.max_depth is not None:
+            namespaces = sorted({ns[:op.max_depth] for ns in namespaces})
+        return namespaces[op.offset:op.offset + op.limit]
+
+    def batch(self, ops: Iterable[Op]) -> List[Result]:
+        results: List[Result] = []
+        with self._lock, self._conn:
+            for op in ops:
+                if isinstance(op, GetOp):
+                    results.append(self._get(op))
+                elif isinstance(op, PutOp):
+                    self._put(op)
+                    results.append(None)
+                elif isinstance(op, SearchOp):
+                    results.append(self._search(op))
+                elif isinstance(op, ListNamespacesOp):
+                    results.append(self._list_namespaces(op))
+                else:
+                    raise ValueError(f"不支持的操作: {type(op)}")
+        return results
+
+    def compare_and_put(self, namespace: Tuple[str, ...], key: str, value: Dict,
+                        expected_version: Optional[int]) -> Tuple[bool, Optional[Item]]:
+        """
+        乐观并发写入：库里这条记录 value["version"] 还等于 expected_version 时才写入
+        （expected_version 为 None 表示只在记录不存在时插入；没有 version 字段的旧记录按 0 算）。
+        比对和写入是同一条 SQL，多个进程共用一个库文件也不会互相覆盖。
+        返回 (是否写入, 库里当前的条目)，没写入时调用方拿返回的条目重新合并。
+        """
+        namespace = tuple(namespace)
+        prefix = _prefix(namespace)
+        now = datetime.now(timezone.utc).isoformat()
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock, self._conn:
+            if expected_version is None:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO store (prefix, key, value, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (prefix, key, data, now, now),
+                )
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE store SET value = ?, updated_at = ? "
+                    "WHERE prefix = ? AND key = ? AND COALESCE(json_extract(value, '$.version'), 0) = ?",
+                    (data, now, prefix, key, expected_version),
+                )
+            swapped = cursor.rowcount == 1
+            # 没写入说明缓存里的版本可能已经过期（别的进程改过），以库里为准刷新
+            row = self._conn.execute("SELECT * FROM store WHERE prefix = ? AND key = ?", (prefix, key)).fetchone()
+            item = self._row_to_item(namespace, row) if row else None
+            self._cache_set((namespace, key), item)
+        metrics.incr("memory_store.cas_swapped" if swapped else "memory_store.cas_conflict")
+        return swapped, item
+
+    async def abatch(self, ops: Iterable[Op]) -> List[Result]:
+        ops = list(ops)
+        # 全是缓存命中的读就直接在事件循环里返回，不必切到线程
+        if all(isinstance(op, GetOp) for op in ops):
+            with self._lock:
+                cached = [self._cache_get((tuple(op.namespace), op.key)) for op in ops]
+            if all(item is not _MISSING for item in cached):
+                metrics.incr("memory_store.cache_hit", len(cached))
+                return cached
+        return await asyncio.to_thread(self.batch, ops)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_store: Optional[SQLiteStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_memory_store() -> SQLiteStore:
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = SQLiteStore()
+        return _default_store
+
+
+if __name__ == '__main__':
+    import random
+    import tempfile
+    import time
+
+    random.seed(0)
+    kinds = ("triage_preferences", "response_preferences", "cal_preferences")
+    users = [f"ou_{i:05d}" for i in range(2000)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = SQLiteStore(os.path.join(tmp_dir, "store.db"), cache_size=len(users) * len(kinds))
+        start = time.perf_counter()
+        for user in users:
+            for kind in kinds:
+                store.put(("email_assistant", user, kind), "preferences", {"preferences": f"{user} 的{kind}" * 20})
+        put_us = (time.perf_counter() - start) / (len(users) * len(kinds)) * 1e6
+
+        lookups = [(("email_assistant", random.choice(users), random.choice(kinds)), "preferences")
+                   for _ in range(50000)]
+        start = time.perf_counter()
+        for namespace, key in lookups:
+            store.get(namespace, key)
+        cached_us = (time.perf_counter() - start) / len(lookups) * 1e6
+
+        cold = SQLiteStore(os.path.join(tmp_dir, "store.db"), cache_size=0)
+        start = time.perf_counter()
+        for namespace, key in lookups[:5000]:
+            cold.get(namespace, key)
+        uncached_us = (time.perf_counter() - start) / 5000 * 1e6
+        print(f"{len(users)} 个用户 x {len(kinds)} 份偏好: 写入 {put_us:.0f} µs/条")
+        print(f"读取: LRU 命中 {cached_us:.1f} µs/次, 直接查库 {uncached_us:.1f} µs/次")
+        store.close()
+        cold.close()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from utils.metrics import metrics
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+TRIAGE_CACHE_PATH = os.getenv("TRIAGE_CACHE_PATH") or os.path.normpath(
+    os.path.join(CURRENT_DIR, "..", "triage_cache.db"))
+# 分拣结果最多复用一周，过期后重新问一次 LLM
+TRIAGE_CACHE_TTL_SECONDS = int(os.getenv("TRIAGE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS triage_cache (
+    fingerprint TEXT NOT NULL,
+    prefs_version TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (fingerprint, prefs_version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_triage_cache_version ON triage_cache(prefs_version);
+"""
+
+
+def preferences_version(user_id: Optional[str], *parts: str) -> str:
+    """
+    某个用户的分拣偏好（以及拼进同一个系统提示词的背景信息）的版本戳，内容一变版本就变。
+    user_id 也算进去：偏好文本相同的两个用户（比如都还在用全局档案）各用各的缓存条目，
+    一个用户改了偏好、删掉旧版本的条目时不会连带清掉别人的。
+    """
+    return hashlib.sha1("\x00".join((user_id or "",) + parts).encode("utf-8")).hexdigest()[:16]
+
+
+class TriageCache:
+    """
+    分拣结果缓存：键是 (邮件内容指纹, 分拣偏好版本)，偏好版本按用户区分（见 preferences_version）。
+    同样的邮件在偏好没变的情况下直接复用上次的 RouterScheme，不再调用 LLM。
+    """
+
+    def __init__(self, path: str = TRIAGE_CACHE_PATH, ttl_seconds: int = TRIAGE_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def get(self, fingerprint: str, prefs_version: str) -> Optional[Dict]:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT result FROM triage_cache WHERE fingerprint = ? AND prefs_version = ? AND created_at > ?",
+                (fingerprint, prefs_version, time.time() - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                metrics.incr("triage_cache.miss")
+                return None
+            self._conn.execute(
+                "UPDATE triage_cache SET hits = hits + 1 WHERE fingerprint = ? AND prefs_version = ?",
+                (fingerprint, prefs_version),
+            )
+        metrics.incr("triage_cache.hit")
+        return json.loads(row["result"])
+
+    def contains(self, fingerprint: str, prefs_version: str) -> bool:
+        """只检查有没有未过期的条目，不计入命中/未命中，也不增加 hits（批量预分拣挑邮件时用）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM triage_cache WHERE fingerprint = ? AND prefs_version = ? AND created_at > ?",
+                (fingerprint, prefs_version, time.time() - self.ttl_seconds),
+            ).fetchone()
+        return row is not None
+
+    def put(self, fingerprint: str, prefs_version: str, result: Dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO triage_cache (fingerprint, prefs_version, result, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (fingerprint, prefs_version, json.dumps(result, ensure_ascii=False), time.time()),
+            )
+
+    def drop_version(self, prefs_version: str) -> int:
+        """分拣偏好更新后删掉旧版本的条目；版本按用户区分，一个用户改了偏好不影响其他用户"""
+        with self._lock, self._conn:
+            cur = self._conn.execute("DELETE FROM triage_cache WHERE prefs_version = ?", (prefs_version,))
+        metrics.incr("triage_cache.invalidated", cur.rowcount)
+        return cur.rowcount
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits FROM triage_cache") \
+                .fetchone()
+        return {
+            "entries": row["entries"],
+            "lifetime_hits": row["hits"],
+            "hits": metrics.get("triage_cache.hit"),
+            "misses": metrics.get("triage_cache.miss"),
+        }
+
+
+_default_cache: Optional[TriageCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_triage_cache() -> TriageCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = TriageCache()
+        return _default_cache
@@ -0,0 +1,305 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from email.utils import parseaddr
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from utils.mail_index import tokenize
+from utils.metrics import metrics
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+TRIAGE_EXAMPLES_PATH = os.getenv("TRIAGE_EXAMPLES_PATH") or os.path.normpath(
+    os.path.join(CURRENT_DIR, "..", "triage_examples.db"))
+# 置信度达到这个值才直接采用本地模型的结果，否则仍交给 LLM
+TRIAGE_MODEL_CONFIDENCE = float(os.getenv("TRIAGE_MODEL_CONFIDENCE", "0.9"))
+# 样本太少时模型不可信，攒够这么多条人工决策之前一律不参与分拣
+TRIAGE_MODEL_MIN_EXAMPLES = int(os.getenv("TRIAGE_MODEL_MIN_EXAMPLES", "30"))
+# 每个用户一个模型（权重约 3 MB），内存里最多保留这么多个，淘汰的下次用到时从样本表重新训练
+TRIAGE_MODEL_CACHE_SIZE = int(os.getenv("TRIAGE_MODEL_CACHE_SIZE", "32"))
+
+LABELS = ("respond", "notify", "ignore")
+HASH_BITS = 18
+BODY_FEATURE_CHARS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS triage_examples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    label TEXT NOT NULL,
+    source TEXT,
+    created_at REAL NOT NULL
+);
+"""
+# 按用户训练之前建的表没有 user_id 列，打开时补上；旧样本的 user_id 为 NULL，归到不区分用户的模型
+MIGRATIONS = (
+    "ALTER TABLE triage_examples ADD COLUMN user_id TEXT",
+    "CREATE INDEX IF NOT EXISTS idx_triage_examples_user ON triage_examples(user_id)",
+)
+
+
+def extract_features(email_input: Dict) -> List[str]:
+    """发件人地址/域名、主题和正文开头的词、几个群发相关的邮件头，全部变成字符串特征"""
+    sender = parseaddr(email_input.get("author", ""))[1].lower()
+    domain = sender.partition("@")[2]
+    features = [f"from:{sender}", f"domain:{domain}", f"local:{sender.partition('@')[0]}"]
+    features += [f"subj:{t}" for t in tokenize(email_input.get("subject", ""))]
+    features += [f"body:{t}" for t in tokenize(email_input.get("email_thread", "")[:BODY_FEATURE_CHARS])]
+    headers = email_input.get("headers") or {}
+    for name in ("list-unsubscribe", "precedence", "auto-submitted", "in-reply-to"):
+        if headers.get(name):
+            features.append(f"hdr:{name}")
+    return features
+
+
+def _hash_features(features: List[str]) -> Tuple[np.ndarray, float]:
+    """特征哈希到固定维度，返回去重后的下标和按特征数归一化的取值"""
+    dim_mask = (1 << HASH_BITS) - 1
+    indices = np.unique(np.fromiter((zlib.crc32(f.encode("utf-8")) & dim_mask for f in features),
+                                    dtype=np.int64, count=len(features)))
+    return indices, 1.0 / np.sqrt(max(len(indices), 1))
+
+
+class TriageModel:
+    """
+    用户人工决策训练出来的本地分拣模型：哈希特征上的多分类逻辑回归，每来一条决策做一次 SGD 更新。
+    预测只需要对几十个特征的权重求和，耗时是微秒级；置信度不够时返回 None，交给 LLM。
+    分拣偏好是按用户的，模型也按用户分开：一个模型只用 user_id 相同的样本训练，只给这个用户的邮件做预测。
+    """
+
+    def __init__(self, path: str = TRIAGE_EXAMPLES_PATH, user_id: Optional[str] = None, learning_rate: float = 0.5,
+                 confidence: float = TRIAGE_MODEL_CONFIDENCE, min_examples: int = TRIAGE_MODEL_MIN_EXAMPLES):
+        self.user_id = user_id
+        self.learning_rate = learning_rate
+        self.confidence = confidence
+        self.min_examples = min_examples
+        self.weights = np.zeros((1 << HASH_BITS, len(LABELS)), dtype=np.float32)
+        self.bias = np.zeros(len(LABELS), dtype=np.float32)
+        self.trained = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(triage_examples)")}
+        for statement in MIGRATIONS[0 if "user_id" not in columns else 1:]:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._replay()
+
+    def _replay(self, epochs: int = 3):
+        """启动时用这个用户已有的样本重新训练，权重不落盘，样本表就是唯一的真实来源"""
+        rows = self._conn.execute("SELECT * FROM triage_examples WHERE user_id IS ? ORDER BY id",
+                                  (self.user_id,)).fetchall()
+        examples = [({"author": r["sender"], "subject": r["subject"], "email_thread": r["body"],
+                      "headers": json.loads(r["headers"])}, r["label"]) for r in rows]
+        for _ in range(epochs):
+            for email_input, label in examples:
+                self._update(email_input, label)
+        self.trained = len(examples)
+
+    def _probabilities(self, indices: np.ndarray, scale: float) -> np.ndarray:
+        logits = self.weights[indices].sum(axis=0) * scale + self.bias
+        logits -= logits.max()
+        exp = np.exp(logits)
+        return exp / exp.sum()
+
+    def _update(self, email_input: Dict, label: str):
+        indices, scale = _hash_features(extract_features(email_input))
+        target = np.zeros(len(LABELS), dtype=np.float32)
+        target[LABELS.index(label)] = 1.0
+        grad = self._probabilities(indices, scale) - target
+        self.weights[indices] -= self.learning_rate * scale * grad
+        self.bias -= self.learning_rate * grad
+
+    def learn(self, email_input: Dict, label: str, source: str = ""):
+        """记录一条人工决策并立即更新模型"""
+        if label not in LABELS:
+            raise ValueError(f"无效的分类标签: {label}")
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO triage_examples (sender, subject, body, headers, label, source, created_at, user_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (email_input.get("author", ""), email_input.get("subject", ""),
+                     email_input.get("email_thread", "")[:BODY_FEATURE_CHARS],
+                     json.dumps(email_input.get("headers") or {}, ensure_ascii=False), label, source, time.time(),
+                     self.user_id),
+                )
+            self._update(email_input, label)
+            self.trained += 1
+        metrics.incr("triage_model.learned")
+
+    def predict_proba(self, email_input: Dict) -> Dict[str, float]:
+        indices, scale = _hash_features(extract_features(email_input))
+        with self._lock:
+            probabilities = self._probabilities(indices, scale)
+        return dict(zip(LABELS, probabilities.tolist()))
+
+    def predict(self, email_input: Dict) -> Optional[Dict]:
+        """置信度足够时返回 RouterScheme 兼容的结果，否则返回 None"""
+        if self.trained < self.min_examples:
+            return None
+        probabilities = self.predict_proba(email_input)
+        label = max(probabilities, key=probabilities.get)
+        if probabilities[label] < self.confidence:
+            metrics.incr("triage_model.abstain")
+            return None
+        metrics.incr("triage_model.hit")
+        return {
+            "reasoning": f"[本地模型] 根据 {self.trained} 条历史决策判断为 {label}，置信度 {probabilities[label]:.2f}",
+            "classification": label,
+            "confidence": probabilities[label],
+        }
+
+
+_default_models: "OrderedDict[Optional[str], TriageModel]" = OrderedDict()
+_default_models_lock = threading.Lock()
+# 正在训练的用户各一把锁：同一个用户只训练一次，不同用户的冷启动互不等待
+_building_locks: Dict[Optional[str], threading.Lock] = {}
+
+
+def get_triage_model(user_id: Optional[str] = None) -> TriageModel:
+    """
+    取某个飞书用户的分拣模型；user_id 为空时是不区分用户的模型（手工构造的邮件、旧样本）。
+    冷启动的用户要把全部样本训练几轮，这一步放在全局锁外面做，训练好再放进缓存，不挡其他用户的分拣。
+    """
+    with _default_models_lock:
+        model = _default_models.get(user_id)
+        if model is not None:
+            _default_models.move_to_end(user_id)
+            return model
+        building_lock = _building_locks.setdefault(user_id, threading.Lock())
+
+    with building_lock:
+        with _default_models_lock:
+            model = _default_models.get(user_id)
+        if model is None:
+            model = TriageModel(user_id=user_id)
+        with _default_models_lock:
+            model = _default_models.setdefault(user_id, model)
+            _default_models.move_to_end(user_id)
+            while len(_default_models) > TRIAGE_MODEL_CACHE_SIZE:
+                # 不主动关连接，别的线程可能还拿着被淘汰的模型，等它不再被引用时自然释放
+                _default_models.popitem(last=False)
+            _building_locks.pop(user_id, None)
+        return model
+
+
+def record_decision(email_input: Dict, label: str, source: str = ""):
+    """图节点里调用的便捷函数，样本记到邮件所属用户的模型上；写入失败不影响主流程"""
+    if not email_input:
+        return
+    try:
+        get_triage_model(email_input.get("user_id")).learn(email_input, label, source)
+    except Exception as e:
+        print(f"记录分拣样本失败: {e}")
+
+
+def load_examples(path: str = TRIAGE_EXAMPLES_PATH) -> Dict[Optional[str], List[Tuple[Dict, str]]]:
+    """按用户读出样本库里的人工决策（按记录先后排列），离线评估用"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(triage_examples)")}
+        user_column = "user_id" if "user_id" in columns else "NULL AS user_id"
+        rows = conn.execute(f"SELECT *, {user_column} FROM triage_examples ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    by_user: Dict[Optional[str], List[Tuple[Dict, str]]] = {}
+    for r in rows:
+        by_user.setdefault(r["user_id"], []).append(
+            ({"author": r["sender"], "subject": r["subject"], "email_thread": r["body"],
+              "headers": json.loads(r["headers"])}, r["label"]))
+    return by_user
+
+
+if __name__ == '__main__':
+    # 离线评估准确率和延迟: python -m utils.triage_model [样本库路径]
+    # 用样本库里真实的人工决策，每个用户按时间先后前 80% 训练、后 20% 测试；
+    # 不给路径时默认读 TRIAGE_EXAMPLES_PATH，样本库不存在时改用下面合成的邮件
+    import random
+    import sys
+    import tempfile
+
+    random.seed(0)
+    templates = [
+        ("respond", ["hr@antgroup.com", "hr@bytedance.com", "recruit@meituan.com"],
+         ["【面试邀约】{role}", "{role} 笔试安排确认", "关于 {role} 岗位的面试时间"],
+         "你好，想邀请你参加 {role} 的面试，请确认时间是否方便。"),
+        ("respond", ["wang@nuaa.edu.cn", "li@nuaa.edu.cn"],
+         ["关于{topic}的问题", "{topic} 需要你确认", "请回复：{topic}"],
+         "同学你好，{topic} 这件事请尽快回复我。"),
+        ("notify", ["notifications@github.com"],
+         ["[{repo}] Run failed: CI", "[{repo}] PR merged", "[{repo}] New release"],
+         "The workflow run for {repo} has completed."),
+        ("notify", ["mail@service.netease.com", "security@service.netease.com"],
+         ["网易邮箱账号安全提醒", "您的邮箱在新设备登录", "邮箱容量提醒"],
+         "您的网易邮箱于今天在新设备登录，如非本人操作请修改密码。"),
+        ("ignore", ["promo@mail.taobao.com", "news@edm.jd.com", "deals@vip.com"],
+         ["{topic} 限时优惠", "你关注的 {topic} 降价了", "{topic} 清仓特卖"],
+         "爆款直降，点击领取优惠券。"),
+        ("ignore", ["digest@medium.com", "newsletter@zhihu.com"],
+         ["{topic} 本周精选", "Daily Digest: {topic}", "{topic} 热门回答"],
+         "为你精选的 {topic} 内容，点击阅读全文。"),
+    ]
+    roles = ["Python 开发工程师", "算法实习生", "后端开发", "测试开发"]
+    topics = ["课程设计", "毕业论文", "组会安排", "实验报告", "数码产品", "家居用品", "机器学习"]
+    repos = ["163mail-agent", "langgraph", "notes"]
+
+    def sample() -> Tuple[Dict, str]:
+        label, senders, subjects, body = random.choice(templates)
+        fill = {"role": random.choice(roles), "topic": random.choice(topics), "repo": random.choice(repos)}
+        email_input = {"author": f"<{random.choice(senders)}>", "subject": random.choice(subjects).format(**fill),
+                       "email_thread": body.format(**fill), "headers": {}}
+        if label == "ignore" and random.random() < 0.5:
+            email_input["headers"]["list-unsubscribe"] = "<mailto:u@x>"
+        # 少量噪声：用户偶尔会对同类邮件做出不同决定
+        if random.random() < 0.05:
+            label = random.choice(LABELS)
+        return email_input, label
+
+    def evaluate(name: str, train: List[Tuple[Dict, str]], test: List[Tuple[Dict, str]]):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model = TriageModel(os.path.join(tmp_dir, "examples.db"), min_examples=0)
+            start = time.perf_counter()
+            for email_input, label in train:
+                model.learn(email_input, label)
+            learn_us = (time.perf_counter() - start) / len(train) * 1e6
+
+            print(f"{name}: 训练 {len(train)} 条, 测试 {len(test)} 条")
+            for threshold in (0.0, 0.8, 0.9, 0.95):
+                model.confidence = threshold
+                start = time.perf_counter()
+                predictions = [model.predict(email_input) for email_input, _ in test]
+                predict_us = (time.perf_counter() - start) / len(test) * 1e6
+                answered = [(p["classification"], label) for p, (_, label) in zip(predictions, test) if p]
+                accuracy = sum(1 for p, y in answered if p == y) / max(len(answered), 1)
+                print(f"  阈值 {threshold:.2f}: 覆盖 {len(answered) / len(test):6.1%}, 准确率 {accuracy:6.1%}, "
+                      f"预测 {predict_us:.0f} µs/封")
+            print(f"  训练（含写库）: {learn_us:.0f} µs/条")
+            model._conn.close()
+
+    examples_path = sys.argv[1] if len(sys.argv) > 1 else TRIAGE_EXAMPLES_PATH
+    if os.path.exists(examples_path):
+        for user_id, examples in load_examples(examples_path).items():
+            split = int(len(examples) * 0.8)
+            if split < 10 or split == len(examples):
+                print(f"用户 {user_id or '(不区分用户)'} 只有 {len(examples)} 条样本，不够评估")
+                continue
+            evaluate(f"用户 {user_id or '(不区分用户)'} 的真实决策", examples[:split], examples[split:])
+    else:
+        print(f"没有找到样本库 {examples_path}，改用合成邮件评估（标签由模板决定，加 5% 噪声）")
+        evaluate("合成邮件", [sample() for _ in range(2000)], [sample() for _ in range(1000)])
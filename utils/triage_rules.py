@@ -0,0 +1,190 @@
+import json
+import os
+import re
+import threading
+from email.utils import parseaddr
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from utils.metrics import metrics
+
+load_dotenv()
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+TRIAGE_RULES_PATH = os.getenv("TRIAGE_RULES_PATH") or os.path.normpath(
+    os.path.join(CURRENT_DIR, "..", "triage_rules.json"))
+
+# 没有 triage_rules.json 时使用的默认规则，结构和 JSON 文件一致；
+# 只包含通用的规则，个人的白名单（学校、公司域名等）和自己的黑名单写在 triage_rules.json 里
+DEFAULT_RULES = {
+    # 白名单里的发件人/域名永远交给 LLM 判断，不走任何快速规则
+    "allow": {
+        "senders": [],
+        "domains": [],
+    },
+    "notify": {
+        "senders": [],
+        "domains": ["github.com", "service.netease.com", "service.mail.163.com"],
+        "subjects": [
+            r"账号安全|登录提醒|异地登录|新设备登录|密码(?:已)?修改",
+            r"(?:构建|部署|build|deploy(?:ment)?)\s*(?:成功|失败|succeeded|failed|passed)",
+            r"订阅(?:即将)?(?:到期|续订|续费)|renewal\s+(?:notice|reminder)",
+        ],
+    },
+    "ignore": {
+        "senders": [],
+        "domains": ["mail.taobao.com", "edm.jd.com"],
+        "subjects": [
+            r"双\s?11|双\s?12|(?<!\d)618(?!\d)|限时(?:特惠|折扣|秒杀)|优惠券|大促|清仓",
+            r"newsletter|weekly digest|unsubscribe",
+            r"^\s*(?:AD|广告)\s*[:：|]",
+        ],
+    },
+}
+
+# 群发/营销邮件的 Precedence 取值
+_BULK_PRECEDENCE = {"bulk", "list", "junk"}
+_NOREPLY_RE = re.compile(r"^(?:no[-_.]?reply|do[-_.]?not[-_.]?reply|notifications?|mailer-daemon|postmaster)\b",
+                         re.IGNORECASE)
+
+
+def _domain_suffixes(domain: str) -> List[str]:
+    """a.b.example.com -> [a.b.example.com, b.example.com, example.com]，子域名也能命中父域名规则"""
+    labels = domain.split(".")
+    return [".".join(labels[i:]) for i in range(len(labels) - 1)]
+
+
+class TriageRules:
+    """
+    LLM 之前的规则分拣：发件人/域名名单用集合查找，所有主题正则合并成一个带命名分组的正则，
+    一次扫描就能知道命中了哪条。没命中返回 None，交给 LLM 分拣。
+    只有名单和主题规则会判为 ignore；仅凭 List-Unsubscribe、Precedence 这类邮件头认出的群发邮件
+    判为 notify，仍然推给用户，用户在卡片上的选择会被分拣缓存和本地模型学到，下次优先于规则生效。
+    """
+
+    def __init__(self, rules: Dict):
+        self.allow_senders, self.allow_domains = self._names(rules.get("allow", {}))
+        self.sender_actions: Dict[str, str] = {}
+        self.domain_actions: Dict[str, str] = {}
+        subject_patterns: List[str] = []
+        self._subject_labels: Dict[str, Tuple[str, str]] = {}
+        for action in ("notify", "ignore"):
+            senders, domains = self._names(rules.get(action, {}))
+            self.sender_actions.update({sender: action for sender in senders})
+            self.domain_actions.update({domain: action for domain in domains})
+            for pattern in rules.get(action, {}).get("subjects", []):
+                group = f"r{len(subject_patterns)}"
+                self._subject_labels[group] = (action, pattern)
+                subject_patterns.append(f"(?P<{group}>{pattern})")
+        self._subject_re = re.compile("|".join(subject_patterns), re.IGNORECASE) if subject_patterns else None
+        self.rule_count = (len(self.allow_senders) + len(self.allow_domains) + len(self.sender_actions)
+                           + len(self.domain_actions) + len(subject_patterns) + 4)
+
+    @staticmethod
+    def _names(section: Dict) -> Tuple[set, set]:
+        return ({s.lower() for s in section.get("senders", [])},
+                {d.lower().lstrip("@.") for d in section.get("domains", [])})
+
+    def _match(self, email_input: Dict) -> Optional[Tuple[str, str]]:
+        sender = parseaddr(email_input.get("author", ""))[1].lower()
+        local_part, _, domain = sender.partition("@")
+        suffixes = _domain_suffixes(domain) if domain else []
+
+        if sender in self.allow_senders or any(s in self.allow_domains for s in suffixes):
+            return None
+        if sender in self.sender_actions:
+            return self.sender_actions[sender], f"发件人 {sender} 在{self.sender_actions[sender]}名单中"
+        for suffix in suffixes:
+            if suffix in self.domain_actions:
+                return self.domain_actions[suffix], f"发件域名 {suffix} 在{self.domain_actions[suffix]}名单中"
+
+        headers = email_input.get("headers") or {}
+        auto_submitted = headers.get("auto-submitted", "").strip().lower()
+        if auto_submitted and auto_submitted != "no":
+            return "notify", f"Auto-Submitted: {auto_submitted}，系统自动发出的通知"
+        # 订阅的邮件列表、课程通知也会带这些头，不能直接丢掉
+        if headers.get("list-unsubscribe"):
+            return "notify", "带有 List-Unsubscribe 头，属于群发订阅邮件"
+        if headers.get("precedence", "").strip().lower() in _BULK_PRECEDENCE:
+            return "notify", f"Precedence: {headers['precedence']}，属于群发邮件"
+
+        if self._subject_re is not None:
+            match = self._subject_re.search(email_input.get("subject", ""))
+            if match:
+                action, pattern = self._subject_labels[match.lastgroup]
+                return action, f"主题命中规则 /{pattern}/"
+
+        if _NOREPLY_RE.match(local_part):
+            return "notify", f"发件人 {sender} 是不接受回复的系统地址"
+        return None
+
+    def evaluate(self, email_input: Dict) -> Optional[Dict]:
+        """
+        命中时返回 RouterScheme 兼容的 {"reasoning", "classification", "confidence"}，confidence 固定为 1.0；
+        白名单里的发件人和没有命中任何规则的邮件返回 None。
+        """
+        matched = self._match(email_input)
+        if matched is None:
+            metrics.incr("triage_rules.miss")
+            return None
+        metrics.incr("triage_rules.hit")
+        classification, reason = matched
+        return {"reasoning": f"[规则分拣] {reason}", "classification": classification, "confidence": 1.0}
+
+
+def load_rules(path: str = TRIAGE_RULES_PATH) -> TriageRules:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return TriageRules(json.load(f))
+    return TriageRules(DEFAULT_RULES)
+
+
+_default_rules: Optional[TriageRules] = None
+_default_rules_lock = threading.Lock()
+
+
+def get_triage_rules() -> TriageRules:
+    global _default_rules
+    with _default_rules_lock:
+        if _default_rules is None:
+            _default_rules = load_rules()
+        return _default_rules
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    random.seed(0)
+    templates = [
+        # (发件人, 主题, 额外的头)
+        ("淘宝 <promo@mail.taobao.com>", "双11 爆款直降，优惠券限时领", {}),
+        ("京东 <news@edm.jd.com>", "你关注的商品降价了", {"list-unsubscribe": "<mailto:u@edm.jd.com>"}),
+        ("Medium Daily Digest <noreply@medium.com>", "Stories for you", {"list-unsubscribe": "<https://x>",
+                                                                          "precedence": "bulk"}),
+        ("GitHub <notifications@github.com>", "[repo] Run failed: CI", {"list-unsubscribe": "<https://x>"}),
+        ("网易邮件中心 <mail@service.netease.com>", "网易邮箱账号安全提醒", {}),
+        ("Jenkins <ci@build.example.com>", "部署成功: release-1.2", {"auto-submitted": "auto-generated"}),
+        ("某课程平台 <no-reply@course.example.com>", "您的作业已批改", {}),
+        ("王老师 <wang@nuaa.edu.cn>", "关于周五组会的安排", {}),
+        ("HR <hr@antgroup.com>", "【面试邀约】Python 开发工程师", {}),
+        ("同学 <classmate@qq.com>", "实验报告能借我参考一下吗", {}),
+    ]
+    weights = [14, 12, 10, 10, 6, 6, 6, 8, 6, 22]
+    corpus = []
+    for author, subject, headers in random.choices(templates, weights=weights, k=20000):
+        corpus.append({"author": author, "to": "me@163.com", "subject": subject,
+                       "email_thread": "", "headers": dict(headers)})
+
+    # 模拟一份 triage_rules.json：在默认规则上加了学校域名的白名单
+    engine = TriageRules({**DEFAULT_RULES, "allow": {"senders": [], "domains": ["nuaa.edu.cn"]}})
+    start = time.perf_counter()
+    results = [engine.evaluate(email) for email in corpus]
+    seconds = time.perf_counter() - start
+
+    resolved = [r for r in results if r]
+    by_class = {c: sum(1 for r in resolved if r["classification"] == c) for c in ("ignore", "notify")}
+    print(f"规则数 {engine.rule_count}, 邮件 {len(corpus)} 封, 耗时 {seconds * 1000:.1f} ms")
+    print(f"{len(corpus) / seconds:,.0f} 封/s, {len(corpus) * engine.rule_count / seconds:,.0f} 条规则/s（按最坏情况全部评估计）")
+    print(f"无需 LLM 即可分拣: {len(resolved) / len(corpus):.1%} (ignore {by_class['ignore']}, notify {by_class['notify']})")